@@ -44,6 +44,7 @@ Plist parsing example:
         print "Not a plist:", e
 """
 
+from array import array
 from collections import namedtuple
 import datetime
 import io
@@ -54,16 +55,19 @@ from struct import error as struct_error
 import sys
 import time
 
+# Assigned, rather than just checked, so the submodules can import them.
 try:
-    unicode
-    unicodeEmpty = r''
+    unicode = unicode
 except NameError:
     unicode = str
-    unicodeEmpty = ''
 try:
-    long
+    long = long
 except NameError:
     long = int
+try:
+    RecursionError = RecursionError
+except NameError:
+    RecursionError = RuntimeError
 try:
     {}.iteritems
     iteritems = lambda x: x.iteritems()
@@ -72,7 +76,12 @@ except AttributeError:
 
 __all__ = [
     'Uid', 'Data', 'readPlist', 'writePlist', 'readPlistFromString',
-    'writePlistToString', 'InvalidPlistException', 'NotBinaryPlistException'
+    'writePlistToString', 'InvalidPlistException', 'NotBinaryPlistException',
+    'PlistLimitExceeded',
+    'BinaryPlistIndex', 'writeSidecar', 'patch', 'Change', 'diff', 'apply',
+    'fingerprint', 'validate', 'PlistSession', 'compileSchema', 'transcode',
+    'estimateSize', 'estimateSizes', 'writeSharded', 'readSharded', 'PlistLogWriter',
+    'PlistLogReader'
 ]
 
 # Apple uses Jan 1, 2001 as a base for all plist date/times.
@@ -114,15 +123,29 @@ class InvalidPlistException(Exception):
 class NotBinaryPlistException(Exception):
     """Raised when a binary plist was expected but not encountered."""
 
-def readPlist(pathOrFile):
-    """Raises NotBinaryPlistException, InvalidPlistException"""
+class PlistLimitExceeded(InvalidPlistException):
+    """Raised when reading a plist would exceed one of the given limits."""
+
+def utcDatetime(value):
+    """Returns a timezone aware datetime as a naive datetime in UTC."""
+    offset = value.utcoffset()
+    value = value.replace(tzinfo=None)
+    if offset is not None:
+        value -= offset
+    return value
+
+def readPlist(pathOrFile, **options):
+    """Additional keyword options are passed through to PlistReader when
+       reading binary plists.
+       
+       Raises NotBinaryPlistException, InvalidPlistException"""
     didOpen = False
     result = None
     if isinstance(pathOrFile, (bytes, unicode)):
         pathOrFile = open(pathOrFile, 'rb')
         didOpen = True
     try:
-        reader = PlistReader(pathOrFile)
+        reader = PlistReader(pathOrFile, **options)
         result = reader.parse()
     except NotBinaryPlistException as e:
         try:
@@ -165,7 +188,15 @@ def wrapDataObject(o, for_binary=False):
             o[k] = wrapDataObject(o[k], for_binary)
     return o
 
-def writePlist(rootObject, pathOrFile, binary=True):
+def writePlist(rootObject, pathOrFile, binary=True, workers=None, **options):
+    """Additional keyword options are passed through to PlistWriter when
+       writing binary plists.
+       
+       If workers is more than 1 and rootObject is a list, tuple or dict,
+       the binary plist is written using that many processes, as described
+       in biplist.parallel."""
+    if binary and workers is not None and workers > 1 and isinstance(rootObject, (list, tuple, dict)):
+        return writeParallel(rootObject, pathOrFile, workers, **options)
     if not binary:
         rootObject = wrapDataObject(rootObject, binary)
         if hasattr(plistlib, "dump"):
@@ -181,16 +212,16 @@ def writePlist(rootObject, pathOrFile, binary=True):
         if isinstance(pathOrFile, (bytes, unicode)):
             pathOrFile = open(pathOrFile, 'wb')
             didOpen = True
-        writer = PlistWriter(pathOrFile)
+        writer = PlistWriter(pathOrFile, **options)
         result = writer.writeRoot(rootObject)
         if didOpen:
             pathOrFile.close()
         return result
 
-def readPlistFromString(data):
-    return readPlist(io.BytesIO(data))
+def readPlistFromString(data, **options):
+    return readPlist(io.BytesIO(data), **options)
 
-def writePlistToString(rootObject, binary=True):
+def writePlistToString(rootObject, binary=True, **options):
     if not binary:
         rootObject = wrapDataObject(rootObject, binary)
         if hasattr(plistlib, "dumps"):
@@ -201,10 +232,28 @@ def writePlistToString(rootObject, binary=True):
             return plistlib.writePlistToString(rootObject)
     else:
         ioObject = io.BytesIO()
-        writer = PlistWriter(ioObject)
+        writer = PlistWriter(ioObject, **options)
         writer.writeRoot(rootObject)
         return ioObject.getvalue()
 
+def estimateSize(rootObject, **options):
+    """Returns the size of rootObject written as a binary plist, without
+       writing it. Additional keyword options are passed through to
+       PlistWriter."""
+    return PlistWriter(None, **options).computeSize(rootObject)
+
+def estimateSizes(objects, **options):
+    """Returns a list of the sizes of each of the given objects written as
+       its own binary plist, such as the items of a list being split into
+       payloads, without writing them."""
+    writer = PlistWriter(None, **options)
+    writer.stringCache = {}
+    sizes = []
+    for rootObject in objects:
+        writer.reset()
+        sizes.append(writer.computeSize(rootObject))
+    return sizes
+
 def is_stream_binary_plist(stream):
     stream.seek(0)
     header = stream.read(7)
@@ -213,8 +262,83 @@ def is_stream_binary_plist(stream):
     else:
         return False
 
+def dirtying(method):
+    """Wraps a container method so that it marks the container as dirty."""
+    def wrapper(self, *args, **kwargs):
+        self.markDirty()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+class TrackedContainer(object):
+    """Mixin for containers read by a PlistReader with trackChanges, which
+       remember the object they were read from and whether they, or any
+       container inside them, have been modified."""
+    source = None
+    objectNumber = None
+    parent = None
+    # True if this container has been changed.
+    modified = False
+    # True if this container, or any container inside it, has been changed.
+    dirty = False
+    
+    def markDirty(self):
+        self.modified = True
+        container = self
+        while container is not None and not container.dirty:
+            container.dirty = True
+            container = container.parent
+
+class TrackedDict(TrackedContainer, dict):
+    __setitem__ = dirtying(dict.__setitem__)
+    __delitem__ = dirtying(dict.__delitem__)
+    clear = dirtying(dict.clear)
+    pop = dirtying(dict.pop)
+    popitem = dirtying(dict.popitem)
+    setdefault = dirtying(dict.setdefault)
+    update = dirtying(dict.update)
+    if hasattr(dict, '__ior__'):
+        __ior__ = dirtying(dict.__ior__)
+
+class TrackedList(TrackedContainer, list):
+    __setitem__ = dirtying(list.__setitem__)
+    __delitem__ = dirtying(list.__delitem__)
+    __iadd__ = dirtying(list.__iadd__)
+    __imul__ = dirtying(list.__imul__)
+    append = dirtying(list.append)
+    extend = dirtying(list.extend)
+    insert = dirtying(list.insert)
+    pop = dirtying(list.pop)
+    remove = dirtying(list.remove)
+    reverse = dirtying(list.reverse)
+    sort = dirtying(list.sort)
+    if hasattr(list, '__setslice__'):
+        __setslice__ = dirtying(list.__setslice__)
+        __delslice__ = dirtying(list.__delslice__)
+
+class TrackedSet(TrackedContainer, set):
+    __ior__ = dirtying(set.__ior__)
+    __iand__ = dirtying(set.__iand__)
+    __isub__ = dirtying(set.__isub__)
+    __ixor__ = dirtying(set.__ixor__)
+    add = dirtying(set.add)
+    clear = dirtying(set.clear)
+    discard = dirtying(set.discard)
+    pop = dirtying(set.pop)
+    remove = dirtying(set.remove)
+    update = dirtying(set.update)
+    intersection_update = dirtying(set.intersection_update)
+    difference_update = dirtying(set.difference_update)
+    symmetric_difference_update = dirtying(set.symmetric_difference_update)
+
 PlistTrailer = namedtuple('PlistTrailer', 'offsetSize, objectRefSize, offsetCount, topLevelObjectNumber, offsetTableOffset')
 PlistByteCounts = namedtuple('PlistByteCounts', 'nullBytes, boolBytes, intBytes, realBytes, dateBytes, dataBytes, stringBytes, uidBytes, arrayBytes, setBytes, dictBytes')
+# The index of each field of PlistByteCounts.
+byteCountIndexes = dict([(field, i) for i, field in enumerate(PlistByteCounts._fields)])
+# The PlistByteCounts field for each object format, other than 0b0000.
+formatByteCounts = {0b0001:'intBytes', 0b0010:'realBytes', 0b0011:'dateBytes', 0b0100:'dataBytes',
+                    0b0101:'stringBytes', 0b0110:'stringBytes', 0b1000:'uidBytes', 0b1010:'arrayBytes',
+                    0b1100:'setBytes', 0b1101:'dictBytes'}
 
 class PlistReader(object):
     file = None
@@ -222,11 +346,75 @@ class PlistReader(object):
     offsets = None
     trailer = None
     currentOffset = 0
+    currentObjectNumber = None
+    trackChanges = False
+    limits = None
+    objectHook = None
+    objectPairsHook = None
+    dates = 'datetime'
+    numpy = None
     
-    def __init__(self, fileOrStream):
-        """Raises NotBinaryPlistException."""
+    def __init__(self, fileOrStream, trackChanges=False, limits=None, objectHook=None, objectPairsHook=None,
+                 dates='datetime'):
+        """If trackChanges is True, arrays, sets and dictionaries are read
+           as TrackedList, TrackedSet and TrackedDict objects which remember
+           where they came from and whether they (or anything inside them)
+           have since been modified. When written with a PlistWriter, the
+           unmodified ones are copied from this plist without encoding them
+           again.
+           
+           limits is a dict which may contain any of:
+           - maxObjects: the number of objects in the plist, and the number
+             read, counting shared objects once for every reference.
+           - maxDepth: how deeply containers are nested.
+           - maxLength: the length of any string, data object or container.
+           - maxDecodedSize: the number of bytes read, counting shared
+             objects once for every reference.
+           - maxTime: the number of seconds reading may take.
+           PlistLimitExceeded is raised as soon as one is exceeded.
+           
+           As with the json module, objectHook is called with each
+           dictionary as it's read, and objectPairsHook with a list of each
+           dictionary's (key, value) pairs instead of the dictionary, which
+           is then never built. Their results take the dictionaries' places,
+           so objects can be converted in the same pass as they're read.
+           Only objectPairsHook is used if both are given, and the results
+           of objectPairsHook aren't tracked by trackChanges.
+           
+           dates controls how dates are read:
+           - 'datetime': as naive datetime.datetime objects in UTC. This is
+             the default.
+           - 'apple': as floats, in seconds since 2001-01-01 UTC, as they're
+             stored.
+           - 'posix': as floats, in seconds since 1970-01-01 UTC.
+           - 'datetime64': as numpy.datetime64 objects with microsecond
+             precision, and arrays containing only dates as numpy arrays of
+             them. This requires NumPy.
+           trackChanges can only be used with 'datetime'.
+           
+           Raises NotBinaryPlistException."""
         self.reset()
         self.file = fileOrStream
+        self.trackChanges = trackChanges
+        self.objectHook = objectHook
+        self.objectPairsHook = objectPairsHook
+        if dates not in ('datetime', 'apple', 'posix', 'datetime64'):
+            raise ValueError("Unknown date mode: %s" % repr(dates))
+        if trackChanges and dates != 'datetime':
+            raise ValueError("trackChanges can only be used with dates='datetime'")
+        if dates == 'datetime64':
+            try:
+                import numpy
+            except ImportError:
+                raise ValueError("dates='datetime64' requires NumPy")
+            self.numpy = numpy
+            self.appleEpoch64 = numpy.datetime64('2001-01-01T00:00:00', 'us')
+        self.dates = dates
+        if limits is not None:
+            for name in limits:
+                if name not in ('maxObjects', 'maxDepth', 'maxLength', 'maxDecodedSize', 'maxTime'):
+                    raise ValueError("Unknown limit: %s" % repr(name))
+            self.limits = limits
     
     def parse(self):
         return self.readRoot()
@@ -236,51 +424,139 @@ class PlistReader(object):
         self.contents = ''
         self.offsets = []
         self.currentOffset = 0
+        self.objectsRead = 0
+        self.decodedSize = 0
+        self.depth = 0
+        self.deadline = None
     
     def readRoot(self):
-        result = None
         self.reset()
         # Get the header, make sure it's a valid file.
         if not is_stream_binary_plist(self.file):
             raise NotBinaryPlistException()
         self.file.seek(0)
-        self.contents = self.file.read()
+        return self.readContents(self.file.read())
+    
+    def readContents(self, contents):
+        """Reads the root object from the contents of a binary plist."""
+        result = None
+        self.loadContents(contents)
+        if self.limits is not None and self.limits.get('maxTime') is not None:
+            self.deadline = time.time() + self.limits['maxTime']
+        try:
+            self.setCurrentOffsetToObjectNumber(self.trailer.topLevelObjectNumber)
+            result = self.readObject()
+        except (TypeError, IndexError, struct_error, RecursionError) as e:
+            raise InvalidPlistException(e)
+        return result
+    
+    def loadContents(self, contents, offsets=None):
+        """Reads the trailer and offset table from the given contents, which
+           may be any buffer supporting slicing (such as an mmap), without
+           reading any objects. If offsets is given, it is used in place of
+           the offset table in the contents."""
+        self.contents = contents
+        self.offsets = []
         if len(self.contents) < 32:
             raise InvalidPlistException("File is too short.")
         trailerContents = self.contents[-32:]
         try:
             self.trailer = PlistTrailer._make(unpack("!xxxxxxBBQQQ", trailerContents))
+            if offsets is not None:
+                self.offsets = offsets
+                return
             offset_size = self.trailer.offsetSize * self.trailer.offsetCount
             offset = self.trailer.offsetTableOffset
+            # Check the trailer before trusting its counts.
+            if (offset + offset_size > len(self.contents) - 32 or
+                    self.trailer.topLevelObjectNumber >= self.trailer.offsetCount):
+                raise InvalidPlistException("Invalid trailer.")
+            self.checkLimit('maxObjects', self.trailer.offsetCount)
             offset_contents = self.contents[offset:offset+offset_size]
-            offset_i = 0
-            while offset_i < self.trailer.offsetCount:
-                begin = self.trailer.offsetSize*offset_i
-                tmp_contents = offset_contents[begin:begin+self.trailer.offsetSize]
-                tmp_sized = self.getSizedInteger(tmp_contents, self.trailer.offsetSize)
-                self.offsets.append(tmp_sized)
-                offset_i += 1
-            self.setCurrentOffsetToObjectNumber(self.trailer.topLevelObjectNumber)
-            result = self.readObject()
+            if self.trailer.offsetSize in (1, 2, 4, 8) and len(offset_contents) == offset_size:
+                # Common widths can be unpacked in one go.
+                format = {1:'B', 2:'H', 4:'L', 8:'Q'}[self.trailer.offsetSize]
+                self.offsets = list(unpack('>%d%s' % (self.trailer.offsetCount, format), offset_contents))
+            else:
+                offset_i = 0
+                while offset_i < self.trailer.offsetCount:
+                    begin = self.trailer.offsetSize*offset_i
+                    tmp_contents = offset_contents[begin:begin+self.trailer.offsetSize]
+                    tmp_sized = self.getSizedInteger(tmp_contents, self.trailer.offsetSize)
+                    self.offsets.append(tmp_sized)
+                    offset_i += 1
         except TypeError as e:
             raise InvalidPlistException(e)
-        return result
+    
+    def checkLimit(self, name, value):
+        if self.limits is not None:
+            limit = self.limits.get(name)
+            if limit is not None and value > limit:
+                raise PlistLimitExceeded("%s of %s exceeded." % (name, limit))
+    
+    def checkLength(self, length, byteLength):
+        """Counts a string, data object or container, whose contents take
+           byteLength bytes, against the limits."""
+        self.checkLimit('maxLength', length)
+        self.decodedSize += byteLength
+        self.checkLimit('maxDecodedSize', self.decodedSize)
+    
+    def startObject(self):
+        """Counts an object read against the limits."""
+        self.objectsRead += 1
+        self.decodedSize += 1
+        self.checkLimit('maxObjects', self.objectsRead)
+        self.checkLimit('maxDecodedSize', self.decodedSize)
+        # Checking the time for every object would be slow.
+        if self.deadline is not None and self.objectsRead % 1000 == 0 and time.time() > self.deadline:
+            raise PlistLimitExceeded("maxTime of %s exceeded." % self.limits['maxTime'])
     
     def setCurrentOffsetToObjectNumber(self, objectNumber):
         self.currentOffset = self.offsets[objectNumber]
+        self.currentObjectNumber = objectNumber
+    
+    def readObjectHeader(self, objectNumber):
+        """Moves to the given object and reads its marker byte, without
+           reading the object itself. Returns a (format, extra) tuple, where
+           extra is the length of strings, data and containers. The current
+           offset is left at the start of the object's contents."""
+        self.setCurrentOffsetToObjectNumber(objectNumber)
+        marker_byte = unpack("!B", self.contents[self.currentOffset:self.currentOffset+1])[0]
+        format = (marker_byte >> 4) & 0x0f
+        extra = marker_byte & 0x0f
+        self.currentOffset += 1
+        if extra == 0b1111 and format in (0b0100, 0b0101, 0b0110, 0b1010, 0b1100, 0b1101):
+            extra = self.readLength()
+        return (format, extra)
+    
+    def readLength(self):
+        """Reads the length following a marker whose length doesn't fit in
+           it, which must be a 1, 2, 4 or 8 byte int."""
+        marker = self.contents[self.currentOffset:self.currentOffset+1]
+        if len(marker) != 1 or not 0x10 <= ord(marker) <= 0x13:
+            raise InvalidPlistException("Invalid length at offset: %d" % self.currentOffset)
+        self.currentOffset += 1
+        if self.limits is not None:
+            self.startObject()
+        length = self.readInteger(1 << (ord(marker) & 0x0f))
+        if length < 0:
+            raise InvalidPlistException("Negative length at offset: %d" % (self.currentOffset - 9))
+        return length
     
     def readObject(self):
         result = None
+        objectNumber = self.currentObjectNumber
         tmp_byte = self.contents[self.currentOffset:self.currentOffset+1]
         marker_byte = unpack("!B", tmp_byte)[0]
         format = (marker_byte >> 4) & 0x0f
         extra = marker_byte & 0x0f
         self.currentOffset += 1
+        if self.limits is not None:
+            self.startObject()
         
         def proc_extra(extra):
             if extra == 0b1111:
-                #self.currentOffset += 1
-                extra = self.readObject()
+                extra = self.readLength()
             return extra
         
         # bool, null, or fill byte
@@ -297,11 +573,12 @@ class PlistReader(object):
                 raise InvalidPlistException("Invalid object found at offset: %d" % (self.currentOffset - 1))
         # int
         elif format == 0b0001:
-            extra = proc_extra(extra)
+            # Up to 16 bytes wide, checked before the width is computed.
+            if extra > 4:
+                raise InvalidPlistException("Invalid integer width at offset: %d" % (self.currentOffset - 1))
             result = self.readInteger(pow(2, extra))
         # real
         elif format == 0b0010:
-            extra = proc_extra(extra)
             result = self.readReal(extra)
         # date
         elif format == 0b0011 and extra == 0b0011:
@@ -325,18 +602,85 @@ class PlistReader(object):
         elif format == 0b1010:
             extra = proc_extra(extra)
             result = self.readArray(extra)
+            if self.trackChanges:
+                result = self.trackedContainer(TrackedList(result), objectNumber)
         # set
         elif format == 0b1100:
             extra = proc_extra(extra)
-            result = set(self.readArray(extra))
+            if self.trackChanges:
+                result = self.trackedContainer(TrackedSet(self.readArray(extra)), objectNumber)
+            else:
+                result = set(self.readArray(extra))
         # dict
         elif format == 0b1101:
             extra = proc_extra(extra)
-            result = self.readDict(extra)
+            if self.objectPairsHook is not None:
+                result = self.objectPairsHook(self.readDictItems(extra))
+            else:
+                result = self.readDict(extra)
+                if self.trackChanges:
+                    result = self.trackedContainer(TrackedDict(result), objectNumber)
+                if self.objectHook is not None:
+                    result = self.objectHook(result)
         else:    
             raise InvalidPlistException("Invalid object found: {format: %s, extra: %s}" % (bin(format), bin(extra)))
         return result
     
+    def objectLength(self, objectNumber):
+        """Returns the number of bytes used by the given object, not
+           counting any objects it refers to."""
+        format, extra = self.readObjectHeader(objectNumber)
+        length = self.currentOffset - self.offsets[objectNumber]
+        if format == 0b0000:
+            pass
+        elif format in (0b0001, 0b0010):
+            length += pow(2, extra)
+        elif format == 0b0011:
+            length += 8
+        elif format in (0b0100, 0b0101):
+            length += extra
+        elif format == 0b0110:
+            length += extra*2
+        elif format == 0b1000:
+            length += extra+1
+        elif format in (0b1010, 0b1100):
+            length += extra*self.trailer.objectRefSize
+        elif format == 0b1101:
+            length += extra*2*self.trailer.objectRefSize
+        else:
+            raise InvalidPlistException("Invalid object found: {format: %s, extra: %s}" % (bin(format), bin(extra)))
+        return length
+    
+    def readRawObject(self, objectNumber, remap=None, objectRefSize=None):
+        """Returns the encoded bytes of the given object. If remap is given,
+           it's called with each object reference in a container to get the
+           reference to write instead, using objectRefSize bytes."""
+        start = self.offsets[objectNumber]
+        length = self.objectLength(objectNumber)
+        if remap is None:
+            return self.contents[start:start+length]
+        format, count = self.readObjectHeader(objectNumber)
+        if format not in (0b1010, 0b1100, 0b1101):
+            return self.contents[start:start+length]
+        result = bytearray(self.contents[start:self.currentOffset])
+        if format == 0b1101:
+            count *= 2
+        for ref in self.readRefs(count):
+            result += pack('>Q', remap(ref))[8-objectRefSize:]
+        return bytes(result)
+    
+    def trackedContainer(self, container, objectNumber):
+        container.source = self
+        container.objectNumber = objectNumber
+        if isinstance(container, TrackedDict):
+            children = container.values()
+        else:
+            children = container
+        for child in children:
+            if isinstance(child, TrackedContainer):
+                child.parent = container
+        return container
+    
     def readInteger(self, byteSize):
         result = 0
         original_offset = self.currentOffset
@@ -347,17 +691,28 @@ class PlistReader(object):
     
     def readReal(self, length):
         result = 0.0
+        if length not in (2, 3):
+            raise InvalidPlistException("Unknown real width: %d" % length)
         to_read = pow(2, length)
         data = self.contents[self.currentOffset:self.currentOffset+to_read]
         if length == 2: # 4 bytes
             result = unpack('>f', data)[0]
         elif length == 3: # 8 bytes
             result = unpack('>d', data)[0]
-        else:
-            raise InvalidPlistException("Unknown real of length %d bytes" % to_read)
         return result
     
     def readRefs(self, count):    
+        size = self.trailer.objectRefSize
+        if self.limits is not None:
+            self.checkLength(count, size*count)
+        if size in (1, 2, 4, 8):
+            # Common widths can be unpacked in one go.
+            data = self.contents[self.currentOffset:self.currentOffset+size*count]
+            if len(data) == size*count:
+                self.currentOffset += size*count
+                return list(unpack('>%d%s' % (count, {1:'B', 2:'H', 4:'L', 8:'Q'}[size]), data))
+        if self.currentOffset + size*count > len(self.contents):
+            raise InvalidPlistException("Object references run past the end of the plist.")
         refs = []
         i = 0
         while i < count:
@@ -371,18 +726,27 @@ class PlistReader(object):
     def readArray(self, count):
         result = []
         values = self.readRefs(count)
+        if self.numpy is not None and values:
+            dates = self.readDateArray(values)
+            if dates is not None:
+                return dates
+        self.depth += 1
+        self.checkLimit('maxDepth', self.depth)
         i = 0
         while i < len(values):
             self.setCurrentOffsetToObjectNumber(values[i])
             value = self.readObject()
             result.append(value)
             i += 1
+        self.depth -= 1
         return result
     
     def readDict(self, count):
         result = {}
         keys = self.readRefs(count)
         values = self.readRefs(count)
+        self.depth += 1
+        self.checkLimit('maxDepth', self.depth)
         i = 0
         while i < len(keys):
             self.setCurrentOffsetToObjectNumber(keys[i])
@@ -391,29 +755,78 @@ class PlistReader(object):
             value = self.readObject()
             result[key] = value
             i += 1
+        self.depth -= 1
+        return result
+    
+    def readDictItems(self, count):
+        """Reads a dictionary as a list of (key, value) pairs."""
+        keys = self.readRefs(count)
+        values = self.readRefs(count)
+        self.depth += 1
+        self.checkLimit('maxDepth', self.depth)
+        result = []
+        for key, value in zip(keys, values):
+            self.setCurrentOffsetToObjectNumber(key)
+            key = self.readObject()
+            self.setCurrentOffsetToObjectNumber(value)
+            result.append((key, self.readObject()))
+        self.depth -= 1
         return result
     
     def readAsciiString(self, length):
+        if self.limits is not None:
+            self.checkLength(length, length)
         result = unpack("!%ds" % length, self.contents[self.currentOffset:self.currentOffset+length])[0]
         self.currentOffset += length
         return str(result.decode('ascii'))
     
     def readUnicode(self, length):
         actual_length = length*2
+        if self.limits is not None:
+            self.checkLength(length, actual_length)
         data = self.contents[self.currentOffset:self.currentOffset+actual_length]
+        if len(data) != actual_length:
+            raise InvalidPlistException("String runs past the end of the plist.")
         # unpack not needed?!! data = unpack(">%ds" % (actual_length), data)[0]
         self.currentOffset += actual_length
         return data.decode('utf_16_be')
     
     def readDate(self):
         result = unpack(">d", self.contents[self.currentOffset:self.currentOffset+8])[0]
-        # Use timedelta to workaround time_t size limitation on 32-bit python.
-        result = datetime.timedelta(seconds=result) + apple_reference_date
         self.currentOffset += 8
-        return result
+        if self.dates == 'apple':
+            return result
+        elif self.dates == 'posix':
+            return result + 978307200
+        elif self.dates == 'datetime64':
+            return self.appleEpoch64 + self.numpy.timedelta64(int(round(result * 1000000)), 'us')
+        # Use timedelta to workaround time_t size limitation on 32-bit python.
+        return datetime.timedelta(seconds=result) + apple_reference_date
+    
+    def readDateArray(self, refs):
+        """Reads the objects with the given object numbers as a
+           numpy.datetime64 array if they're all dates, or returns None."""
+        contents = self.contents
+        offsets = self.offsets
+        data = []
+        for ref in refs:
+            offset = offsets[ref]
+            if contents[offset:offset+1] != b'\x33':
+                return None
+            data.append(contents[offset+1:offset+9])
+        if self.limits is not None:
+            for ref in refs:
+                self.startObject()
+        numpy = self.numpy
+        seconds = numpy.frombuffer(b''.join(data), dtype='>f8')
+        return self.appleEpoch64 + numpy.round(seconds * 1000000).astype('int64').astype('timedelta64[us]')
     
     def readData(self, length):
+        if self.limits is not None:
+            self.checkLength(length, length)
         result = self.contents[self.currentOffset:self.currentOffset+length]
+        if len(result) != length:
+            raise InvalidPlistException("Data runs past the end of the plist.")
         self.currentOffset += length
         return Data(result)
     
@@ -466,11 +879,15 @@ class FloatWrapper(object):
     _instances = {}
     def __new__(klass, value):
         # Ensure FloatWrapper(x) for a given float x is always the same object
-        wrapper = klass._instances.get(value)
+        key = value
+        if not value:
+            # 0.0 and -0.0 are equal, but are written differently.
+            key = (value, math.copysign(1.0, value))
+        wrapper = klass._instances.get(key)
         if wrapper is None:
             wrapper = object.__new__(klass)
             wrapper.value = value
-            klass._instances[value] = wrapper
+            klass._instances[key] = wrapper
         return wrapper
     def __repr__(self):
         return "<FloatWrapper: %s>" % self.value
@@ -480,10 +897,13 @@ class StringWrapper(object):
     
     encodedValue = None
     encoding = None
+    # The marker, length and encoded value, once written.
+    encodedObject = None
     
-    def __new__(cls, value):
-        '''Ensure we only have a only one instance for any string,
-         and that we encode ascii as 1-byte-per character when possible'''
+    def __new__(cls, value, interned=True):
+        '''Ensure we only have a only one instance for any string (unless
+         interned is False), and that we encode ascii as 1-byte-per
+         character when possible'''
         
         encodedValue = None
         
@@ -492,6 +912,11 @@ class StringWrapper(object):
                encodedValue = value.encode(encoding)
             except: pass
             if encodedValue is not None:
+                if not interned:
+                    wrapper = super(StringWrapper, cls).__new__(cls)
+                    wrapper.encodedValue = encodedValue
+                    wrapper.encoding = encoding
+                    return wrapper
                 if encodedValue not in cls.__instances:
                     cls.__instances[encodedValue] = super(StringWrapper, cls).__new__(cls)
                     cls.__instances[encodedValue].encodedValue = encodedValue
@@ -517,38 +942,171 @@ class StringWrapper(object):
     def __repr__(self):
         return '<StringWrapper (%s): %s>' % (self.encoding, self.encodedValue)
 
+class SourceObject(object):
+    """An object in a plist which has been read, to be copied from there
+       rather than encoded again."""
+    references = None
+    header = None
+    def __init__(self, reader, objectNumber):
+        self.reader = reader
+        self.objectNumber = objectNumber
+    def __repr__(self):
+        return "<SourceObject: %d>" % self.objectNumber
+
+class SourceTable(object):
+    """The objects copied from a plist which has been read, found by
+       PlistWriter.countSource."""
+    def __init__(self, reader):
+        self.reader = reader
+        # Each object's number in the plist being written: None until it's
+        # counted, then -1 until a reference to it is written.
+        self.numbers = [None] * len(reader.offsets)
+        # For containers, the length of their marker and count and their
+        # object references; for other objects, their length.
+        self.layouts = {}
+
 class PlistWriter(object):
     header = b'bplist00bybiplist1.0'
     file = None
-    byteCounts = None
+    byteTotals = None
     trailer = None
-    computedUniques = None
-    writtenReferences = None
-    referencePositions = None
+    objectNumbers = None
+    offsets = None
     wrappedTrue = None
     wrappedFalse = None
+    optimize = False
+    bytesSaved = 0
+    compactReals = False
+    realTolerance = None
+    dedup = 'scalars'
+    reuseSource = True
+    canonical = False
+    default = None
+    encoders = None
+    hasEncoders = False
+    numpy = None
+    # Wrapped short strings keyed by value, kept across plists when set.
+    stringCache = None
+    # The scalars counted by countObjects, by type.
+    countedScalars = None
     
-    def __init__(self, file):
+    def __init__(self, file, optimize=False, compactReals=False, realTolerance=None, dedup='scalars',
+                 reuseSource=True, canonical=False, default=None, encoders=None):
+        """If optimize is True, the object reference and offset widths are
+           chosen as the smallest number of bytes which can hold them
+           (rather than the nearest power of two), the largest string or
+           data object is moved to the end of the object table so that it
+           does not inflate the offset width, and the number of bytes saved
+           compared to the default layout is stored in bytesSaved.
+           
+           If compactReals is True, reals which survive a round trip through
+           single precision unchanged are written as 4 byte floats. Setting
+           realTolerance to a relative error (e.g. 1e-6) also writes reals
+           as 4 byte floats when the loss of precision is within it. This
+           is lossy and should only be used for data like telemetry.
+           
+           dedup controls which objects share a single entry in the object
+           table:
+           - 'none': nothing is shared. Fastest for data with little
+             repetition, such as random identifiers.
+           - 'scalars': equal strings, numbers, dates and data are shared.
+             This is the default.
+           - 'identity': as 'scalars', and containers which are the same
+             Python object are also shared.
+           - 'deep': as 'scalars', and containers with equal contents are
+             also shared.
+           
+           Unmodified containers read with PlistReader's trackChanges option
+           are copied straight from the plist they were read from, rather
+           than encoded again: each object in them is copied with its object
+           references renumbered, so only objects which are still used are
+           written. If reuseSource is 'append' and the root was read this
+           way, the whole object table of its plist is copied instead, and
+           only modified containers and new objects are added after it, with
+           the modified containers taking over their old object numbers.
+           This is faster still, but leaves the old versions unused in the
+           file, so is only done while they add up to less than a quarter of
+           the plist. If reuseSource is False, everything is encoded again.
+           Options which change how objects are encoded don't apply to the
+           copied objects.
+           
+           If canonical is True, equal root objects are always written as
+           the same bytes: dictionary items are written in order of their
+           keys, set members are sorted, and nothing is copied from source
+           plists. The order is the same for every plist, but isn't meant
+           to be meaningful. dedup='identity' can't be used, as it depends
+           on which containers are the same Python object.
+           
+           Objects with no plist representation are converted as they're
+           wrapped, so no converted copy of the root is built first: by the
+           function in encoders, a dict keyed by type, for their type or the
+           nearest of its base classes, or else by default, as with the
+           json module. Either returns a value which can be written, such as
+           a dict of the object's fields.
+           
+           Dates may be naive datetimes in UTC, timezone aware datetimes, or
+           numpy.datetime64 objects or arrays.
+        """
+        if dedup not in ('none', 'scalars', 'identity', 'deep'):
+            raise ValueError("Unknown dedup policy: %s" % repr(dedup))
+        if canonical and dedup == 'identity':
+            raise ValueError("dedup='identity' can't be used for canonical output")
+        self.dedup = dedup
+        self.canonical = canonical
         self.reset()
         self.file = file
+        self.optimize = optimize
+        self.compactReals = compactReals
+        self.realTolerance = realTolerance
+        self.reuseSource = False if canonical else reuseSource
         self.wrappedTrue = BoolWrapper(True)
         self.wrappedFalse = BoolWrapper(False)
+        self.default = default
+        self.encoders = encoders
+        self.hasEncoders = bool(encoders) or default is not None
+        # NumPy objects can only be written if it's already been imported.
+        self.numpy = sys.modules.get('numpy')
 
     def reset(self):
-        self.byteCounts = PlistByteCounts(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        # The bytes which will be written for each type of object, as in
+        # PlistByteCounts, not counting object references.
+        self.byteTotals = [0] * len(PlistByteCounts._fields)
         self.trailer = PlistTrailer(0, 0, 0, 0, 0)
         
-        # A set of all the uniques which have been computed.
-        self.computedUniques = set()
-        # A list of all the uniques which have been written.
-        self.writtenReferences = {}
-        # A dict of the positions of the written uniques.
-        self.referencePositions = {}
+        # The number of objects which will be written.
+        self.objectCount = 0
+        # The number of object references they contain.
+        self.computedReferences = 0
+        # The uniques which have been computed, mapped to their object
+        # numbers once references to them have been written.
+        self.objectNumbers = {}
+        # The positions of the written objects, by object number.
+        self.offsets = array('Q')
+        # The number of object references written inside containers.
+        self.referenceCount = 0
+        # The largest leaf object, which is written last when optimizing.
+        self.deferredObject = None
+        self.deferredObjectSize = 0
+        # The number of bytes the deferred object is written as.
+        self.deferredObjectBytes = 0
+        self.bytesSaved = 0
+        # Wrapped containers, keyed by id() or contents depending on dedup.
+        self.wrappedContainers = {}
+        # SourceObjects, keyed by the id() of their reader and object number.
+        self.sourceObjects = {}
+        # SourceTables, keyed by the id() of their reader.
+        self.sourceTables = {}
+        # When writing incrementally, the reader whose object table is being
+        # copied, and the modified containers from it, keyed by object number.
+        self.incrementalSource = None
+        self.reservedObjects = {}
+        # The object number given to the next new object.
+        self.nextObjectNumber = 0
         
     def positionOfObjectReference(self, obj):
         """If the given object has been written already, return its
            position in the offset table. Otherwise, return None."""
-        return self.writtenReferences.get(obj)
+        return self.objectNumbers.get(obj)
         
     def writeRoot(self, root):
         """
@@ -559,89 +1117,515 @@ class PlistWriter(object):
           - need to do this in order to know how large the object refs
             will be in the list/dict/set reference lists
         - write objects
-          - keep objects in writtenReferences
-          - keep positions of object references in referencePositions
+          - keep objects' numbers in objectNumbers
+          - keep positions of objects in offsets
           - write object references with the length computed previously
         - computer object reference length
         - write object reference positions
         - write trailer
         """
-        output = self.header
-        wrapped_root = self.wrapRoot(root)
+        if (self.reuseSource == 'append' and isinstance(root, TrackedContainer) and
+                root.source is not None and self.writeIncrementalRoot(root)):
+            return
+        self.writeWrappedRoot(self.wrapRoot(root))
+
+    def writeWrappedRoot(self, wrapped_root):
+        """Writes a root made of wrapped objects, as returned by wrapRoot."""
+        # A bytearray is extended in place, rather than copied on each write.
+        output = bytearray(self.header)
         self.computeOffsets(wrapped_root, asReference=True, isRoot=True)
-        self.trailer = self.trailer._replace(**{'objectRefSize':self.intSize(len(self.computedUniques))})
-        self.writeObjectReference(wrapped_root, output)
+        objectCount = self.objectCount
+        if self.optimize:
+            objectRefSize = self.referenceSize(objectCount - 1)
+            if self.deferredObject is wrapped_root:
+                self.deferredObject = None
+        else:
+            objectRefSize = self.intSize(objectCount)
+        self.trailer = self.trailer._replace(**{'objectRefSize':objectRefSize})
+        self.offsets = array('Q', [0]) * objectCount
+        # Number the root object, but don't write a reference to it.
+        self.writeObjectReference(wrapped_root, bytearray())
+        self.referenceCount = 0
         output = self.writeObject(wrapped_root, output, setReferencePosition=True)
+        if self.deferredObject is not None:
+            output = self.writeObject(self.deferredObject, output, setReferencePosition=True)
         
-        # output size at this point is an upper bound on how big the
-        # object reference offsets need to be.
+        if self.optimize:
+            # The start of the last object written is the largest offset.
+            offsetSize = self.referenceSize(max(self.offsets))
+        else:
+            # output size at this point is an upper bound on how big the
+            # object reference offsets need to be.
+            offsetSize = self.intSize(len(output))
         self.trailer = self.trailer._replace(**{
-            'offsetSize':self.intSize(len(output)),
-            'offsetCount':len(self.computedUniques),
+            'offsetSize':offsetSize,
+            'offsetCount':objectCount,
             'offsetTableOffset':len(output),
             'topLevelObjectNumber':0
             })
         
+        if self.optimize:
+            # Work out how large the default layout would have been.
+            defaultRefSize = self.intSize(objectCount)
+            defaultLength = len(output) + self.referenceCount * (defaultRefSize - objectRefSize)
+            defaultOffsetSize = self.intSize(defaultLength)
+            self.bytesSaved = (defaultLength - len(output)) + objectCount * (defaultOffsetSize - offsetSize)
+        
+        output = self.writeOffsetTable(output)
+        output += pack('!xxxxxxBBQQQ', *self.trailer)
+        self.file.write(output)
+
+    def writeIncrementalRoot(self, root):
+        """Writes a root read with trackChanges by copying the object table
+           it was read from, followed by the modified containers and new
+           objects. Returns False, without writing anything, if the changes
+           can't be written this way."""
+        source = root.source
+        self.incrementalSource = source
+        wrapped_root = self.wrapRoot(root)
+        unused = 0
+        for objectNumber in self.reservedObjects:
+            unused += source.objectLength(objectNumber)
+        if unused * 4 > len(source.contents):
+            self.reset()
+            return False
+        # The modified containers are numbered already, so only the new
+        # objects inside them are counted.
+        for objectNumber, (container, wrapped) in iteritems(self.reservedObjects):
+            self.objectNumbers[wrapped] = objectNumber
+        for (container, wrapped) in self.reservedObjects.values():
+            self.computeOffsets(wrapped)
+        self.deferredObject = None
+        objectRefSize = source.trailer.objectRefSize
+        sourceCount = len(source.offsets)
+        if sourceCount + self.objectCount > 1 << (8 * objectRefSize):
+            self.reset()
+            return False
+        self.trailer = self.trailer._replace(**{'objectRefSize':objectRefSize})
+        self.nextObjectNumber = sourceCount
+        self.offsets = array('Q', source.offsets) + array('Q', [0]) * self.objectCount
+        
+        output = bytearray(source.contents[:source.trailer.offsetTableOffset])
+        for (container, wrapped) in self.reservedObjects.values():
+            output = self.writeObject(wrapped, output, setReferencePosition=True)
+        
+        if self.optimize:
+            offsetSize = self.referenceSize(len(output))
+        else:
+            offsetSize = self.intSize(len(output))
+        self.trailer = self.trailer._replace(**{
+            'offsetSize':offsetSize,
+            'offsetCount':sourceCount + self.objectCount,
+            'offsetTableOffset':len(output),
+            'topLevelObjectNumber':root.objectNumber
+            })
         output = self.writeOffsetTable(output)
         output += pack('!xxxxxxBBQQQ', *self.trailer)
         self.file.write(output)
+        return True
+
+    def computeSize(self, root):
+        """Returns the number of bytes writeRoot(root) would write, working
+           out the sizes of the objects without encoding them. Like
+           writeRoot, this can only be called once until reset()."""
+        if self.reuseSource == 'append' and isinstance(root, TrackedContainer) and root.source is not None:
+            # How much is copied depends on the changes made.
+            return self.measureByWriting(root)
+        if self.countObjects(root):
+            deferredLast = self.deferredObject is not None
+        else:
+            self.reset()
+            wrapped_root = self.wrapRoot(root)
+            self.computeOffsets(wrapped_root, asReference=True, isRoot=True)
+            deferredLast = self.deferredObject is not None and self.deferredObject is not wrapped_root
+        size = self.countedSize(deferredLast)
+        if size is None:
+            # The largest offset depends on the order objects are written.
+            self.reset()
+            return self.measureByWriting(root)
+        return size
+
+    def countedSize(self, deferredLast):
+        """Returns the size of the plist counted by computeOffsets or
+           countObjects, or None if it can only be found by writing it.
+           deferredLast is whether a deferred object will be written last."""
+        objectCount = self.objectCount
+        if self.optimize:
+            objectRefSize = self.referenceSize(objectCount - 1)
+        else:
+            objectRefSize = self.intSize(objectCount)
+        length = len(self.header) + sum(self.byteTotals) + self.computedReferences * objectRefSize
+        if not self.optimize:
+            offsetSize = self.intSize(length)
+        elif deferredLast:
+            # The deferred object is written last, so has the largest offset.
+            offsetSize = self.referenceSize(length - self.deferredObjectBytes)
+        else:
+            return None
+        return length + objectCount * offsetSize + 32
+
+    def countObjects(self, root):
+        """Counts the bytes, objects and object references writeRoot(root)
+           would write, as computeOffsets does, without wrapping root first.
+           Returns False if root is anything other than a dict, list or
+           tuple of dicts, lists, tuples, strings, numbers, dates, data,
+           Uids and None, or the options change how these are wrapped, in
+           which case computeOffsets must be used."""
+        if (self.dedup not in ('scalars', 'none') or self.compactReals or self.realTolerance is not None or
+                type(root) not in (dict, list, tuple)):
+            return False
+        # Objects which are shared when they're equal, as their wrappers
+        # are: strings (by encoding), data, ints, floats, dates, Uids, and
+        # bools and None.
+        self.countedScalars = tuple([set() for i in range(7)])
+        return self.countValues([root])
+
+    def countValues(self, values):
+        """Counts values, as items of a container counted by countObjects,
+           and everything inside them. Returns False if any of them can't
+           be counted this way."""
+        strings, datas, ints, floats, dates, uids, others = self.countedScalars
+        dedup = self.dedup == 'scalars'
+        optimize = self.optimize
+        intSize = self.intSize
+        dataTypes = (Data,) if bytes is str else (Data, bytes)
+        totals = self.byteTotals
+        (nullBytes, boolBytes, intBytes, realBytes, dateBytes, dataBytes, stringBytes, uidBytes, arrayBytes,
+         setBytes, dictBytes) = range(len(totals))
+        objectCount = self.objectCount
+        references = self.computedReferences
+        deferredSize = self.deferredObjectSize
+        containers = []
+        while True:
+            for value in values:
+                valueType = type(value)
+                if valueType is dict or valueType is list or valueType is tuple:
+                    objectCount += 1
+                    containers.append(value)
+                elif valueType is str or valueType is unicode:
+                    try:
+                        encoded = value.encode('ascii')
+                        length = len(encoded)
+                    except UnicodeError:
+                        encoded = value.encode('utf_16_be')
+                        length = len(encoded) // 2
+                    if dedup:
+                        if encoded in strings:
+                            continue
+                        strings.add(encoded)
+                    objectCount += 1
+                    size = (1 if length < 0b1111 else 2 + intSize(length)) + len(encoded)
+                    totals[stringBytes] += size
+                    if optimize and len(encoded) > deferredSize:
+                        deferredSize = len(encoded)
+                        self.deferredObjectBytes = size
+                elif valueType is int or valueType is long:
+                    if dedup:
+                        if value in ints:
+                            continue
+                        ints.add(value)
+                    objectCount += 1
+                    totals[intBytes] += 1 + intSize(value)
+                elif valueType is float:
+                    if dedup:
+                        key = value if value else (value, math.copysign(1.0, value))
+                        if key in floats:
+                            continue
+                        floats.add(key)
+                    objectCount += 1
+                    totals[realBytes] += 9
+                elif valueType in dataTypes:
+                    if dedup:
+                        if value in datas:
+                            continue
+                        datas.add(value)
+                    objectCount += 1
+                    length = len(value)
+                    size = (1 if length < 0b1111 else 2 + intSize(length)) + length
+                    totals[dataBytes] += size
+                    if optimize and length > deferredSize:
+                        deferredSize = length
+                        self.deferredObjectBytes = size
+                elif valueType is datetime.datetime:
+                    if dedup:
+                        if value.tzinfo is not None:
+                            value = utcDatetime(value)
+                        if value in dates:
+                            continue
+                        dates.add(value)
+                    objectCount += 1
+                    totals[dateBytes] += 9
+                elif valueType is Uid:
+                    if dedup:
+                        if value in uids:
+                            continue
+                        uids.add(value)
+                    objectCount += 1
+                    totals[uidBytes] += 1 + intSize(value.integer)
+                elif valueType is bool or value is None:
+                    if dedup:
+                        if value in others:
+                            continue
+                        others.add(value)
+                    objectCount += 1
+                    totals[nullBytes if value is None else boolBytes] += 1
+                else:
+                    return False
+            if not containers:
+                break
+            container = containers.pop()
+            count = len(container)
+            header = 1 if count < 0b1111 else 2 + intSize(count)
+            if type(container) is dict:
+                totals[dictBytes] += header
+                references += 2 * count
+                keys = list(container)
+                for key in keys:
+                    if type(key) is not str and type(key) is not unicode:
+                        return False
+                if dedup and count > 1:
+                    # Different strings can have the same encoding, and so
+                    # the same wrapper, if one isn't ASCII.
+                    encodedKeys = set()
+                    for key in keys:
+                        try:
+                            encodedKeys.add(key.encode('ascii'))
+                        except UnicodeError:
+                            encodedKeys.add(key.encode('utf_16_be'))
+                    if len(encodedKeys) != count:
+                        return False
+                values = keys + list(container.values())
+            else:
+                totals[arrayBytes] += header
+                references += count
+                values = container
+        self.objectCount = objectCount
+        self.computedReferences = references
+        self.deferredObjectSize = deferredSize
+        if deferredSize:
+            # Only the deferred object's size is needed.
+            self.deferredObject = True
+        return True
+
+    def measureByWriting(self, root):
+        """Returns the number of bytes writeRoot(root) writes."""
+        file = self.file
+        self.file = io.BytesIO()
+        try:
+            self.writeRoot(root)
+            return len(self.file.getvalue())
+        finally:
+            self.file = file
 
     def wrapRoot(self, root):
         if isinstance(root, bool):
             if root is True:
-                return self.wrappedTrue
+                wrapped = self.wrappedTrue
             else:
-                return self.wrappedFalse
+                wrapped = self.wrappedFalse
         elif isinstance(root, float):
-            return FloatWrapper(root)
-        elif isinstance(root, set):
+            wrapped = FloatWrapper(root)
+        elif isinstance(root, (set, dict, list, tuple)):
+            return self.wrapContainer(root)
+        elif isinstance(root, (str, unicode)) and not isinstance(root, Data):
+            if self.dedup == 'none':
+                # Without deduplication an uninterned wrapper is already unique.
+                return StringWrapper(root, interned=False)
+            if self.stringCache is None:
+                return StringWrapper(root)
+            wrapped = self.stringCache.get(root)
+            if wrapped is None:
+                wrapped = StringWrapper(root)
+                if len(root) <= 64 and len(self.stringCache) < 4096:
+                    self.stringCache[root] = wrapped
+            return wrapped
+        elif isinstance(root, bytes):
+            wrapped = Data(root)
+        elif isinstance(root, datetime.datetime) and root.tzinfo is not None:
+            wrapped = utcDatetime(root)
+        elif (self.numpy is not None and isinstance(root, (self.numpy.ndarray, self.numpy.datetime64)) and
+                root.dtype.kind == 'M'):
+            # Converted to datetimes in bulk.
+            return self.wrapRoot(root.astype('datetime64[us]').tolist())
+        elif self.hasEncoders and root is not None and not isinstance(root, (int, long, datetime.datetime, Uid)):
+            return self.wrapRoot(self.encode(root))
+        else:
+            wrapped = root
+        if self.dedup == 'none':
+            # Give every occurrence its own entry in the object table.
+            return HashableWrapper(wrapped)
+        return wrapped
+
+    def encode(self, obj):
+        """Converts an object with no plist representation using encoders
+           or default."""
+        encoder = None
+        if self.encoders:
+            for cls in type(obj).__mro__:
+                encoder = self.encoders.get(cls)
+                if encoder is not None:
+                    break
+        if encoder is None:
+            encoder = self.default
+        if encoder is None:
+            raise InvalidPlistException("Unknown object type: %s (%s)" % (type(obj).__name__, repr(obj)))
+        encoded = encoder(obj)
+        if encoded is obj:
+            raise InvalidPlistException("%s was encoded as itself" % repr(obj))
+        return encoded
+
+    def wrapContainer(self, root):
+        incremental = False
+        if isinstance(root, TrackedContainer) and self.reuseSource:
+            if not root.dirty:
+                return self.wrapSource(root.source, root.objectNumber)
+            if root.source is self.incrementalSource:
+                if not root.modified:
+                    # Its own references are unchanged, but containers
+                    # inside it need writing again.
+                    for value in (root.values() if isinstance(root, dict) else root):
+                        if isinstance(value, TrackedContainer) and value.dirty:
+                            self.wrapRoot(value)
+                    return self.wrapSource(root.source, root.objectNumber)
+                reserved = self.reservedObjects.get(root.objectNumber)
+                if reserved is not None and reserved[0] is root:
+                    return reserved[1]
+                incremental = reserved is None
+        if self.dedup == 'identity':
+            wrapped = self.wrappedContainers.get(id(root))
+            if wrapped is not None:
+                return wrapped
+        wrap = self.wrapRoot
+        if isinstance(root, TrackedContainer) and self.reuseSource and root.source is not None:
+            # Values which were in the old version refer to the old objects,
+            # rather than being added again.
+            scalars = self.sourceScalars(root.source, root.objectNumber)
+            def wrap(value):
+                wrapped = self.wrapRoot(value)
+                unwrapped = wrapped.value if isinstance(wrapped, HashableWrapper) else wrapped
+                if isinstance(unwrapped, (SourceObject, set, dict, list, tuple)):
+                    return wrapped
+                # Equal values, such as 0.0 and -0.0, can be encoded
+                # differently, so they're matched by their encoding.
+                objectNumber = scalars.get(bytes(self.writeObject(wrapped, bytearray())))
+                if objectNumber is None:
+                    return wrapped
+                return self.wrapSource(root.source, objectNumber)
+        if isinstance(root, set):
             n = set()
             for value in root:
-                n.add(self.wrapRoot(value))
-            return HashableWrapper(n)
+                n.add(wrap(value))
         elif isinstance(root, dict):
             n = {}
             for key, value in iteritems(root):
-                n[self.wrapRoot(key)] = self.wrapRoot(value)
-            return HashableWrapper(n)
+                n[wrap(key)] = wrap(value)
         elif isinstance(root, list):
             n = []
             for value in root:
-                n.append(self.wrapRoot(value))
-            return HashableWrapper(n)
-        elif isinstance(root, tuple):
-            n = tuple([self.wrapRoot(value) for value in root])
-            return HashableWrapper(n)
-        elif isinstance(root, (str, unicode)) and not isinstance(root, Data):
-            return StringWrapper(root)
-        elif isinstance(root, bytes):
-            return Data(root)
+                n.append(wrap(value))
         else:
-            return root
+            n = tuple([wrap(value) for value in root])
+        wrapped = HashableWrapper(n)
+        if incremental:
+            # The new version takes over the old version's object number.
+            self.reservedObjects[root.objectNumber] = (root, wrapped)
+        elif self.dedup == 'identity':
+            self.wrappedContainers[id(root)] = wrapped
+        elif self.dedup == 'deep':
+            # The children have already been replaced by their canonical
+            # wrappers, so hashing a container only hashes one level.
+            if isinstance(n, set):
+                key = ('set', frozenset(n))
+            elif isinstance(n, dict):
+                key = ('dict', frozenset(iteritems(n)))
+            else:
+                key = ('array', tuple(n))
+            wrapped = self.wrappedContainers.setdefault(key, wrapped)
+        return wrapped
+
+    def wrapSource(self, reader, objectNumber):
+        """Returns the SourceObject for the given object, so that objects
+           shared in the source plist are only written once."""
+        key = (id(reader), objectNumber)
+        wrapped = self.sourceObjects.get(key)
+        if wrapped is None:
+            wrapped = SourceObject(reader, objectNumber)
+            self.sourceObjects[key] = wrapped
+        return wrapped
+    
+    def sourceScalars(self, reader, objectNumber):
+        """Returns a dict mapping encoded bytes to object number for the
+           objects other than containers referred to by a container."""
+        scalars = {}
+        for ref in self.sourceReferences(self.wrapSource(reader, objectNumber)):
+            format, extra = reader.readObjectHeader(ref.objectNumber)
+            if format not in (0b1010, 0b1100, 0b1101):
+                scalars[bytes(reader.readRawObject(ref.objectNumber))] = ref.objectNumber
+        return scalars
+
+    def sourceReferences(self, obj):
+        """Returns the SourceObjects referred to by a SourceObject, reading
+           them and its marker and length the first time."""
+        if obj.references is None:
+            reader = obj.reader
+            format, count = reader.readObjectHeader(obj.objectNumber)
+            obj.header = reader.contents[reader.offsets[obj.objectNumber]:reader.currentOffset]
+            if format == 0b1101:
+                count *= 2
+            elif format not in (0b1010, 0b1100):
+                count = 0
+            obj.references = [self.wrapSource(reader, ref) for ref in reader.readRefs(count)]
+        return obj.references
+    
+    @property
+    def byteCounts(self):
+        """The bytes which will be written for each type of object, found
+           by computeOffsets. Containers are counted without their object
+           references."""
+        return PlistByteCounts(*self.byteTotals)
 
     def incrementByteCount(self, field, incr=1):
-        self.byteCounts = self.byteCounts._replace(**{field:self.byteCounts.__getattribute__(field) + incr})
+        self.byteTotals[byteCountIndexes[field]] += incr
 
     def computeOffsets(self, obj, asReference=False, isRoot=False):
         def check_key(key):
+            if isinstance(key, HashableWrapper):
+                key = key.value
             if key is None:
                 raise InvalidPlistException('Dictionary keys cannot be null in plists.')
+            elif isinstance(key, SourceObject):
+                if key.reader.readObjectHeader(key.objectNumber)[0] not in (0b0101, 0b0110):
+                    raise InvalidPlistException('Keys must be strings.')
             elif isinstance(key, Data):
                 raise InvalidPlistException('Data cannot be dictionary keys in plists.')
             elif not isinstance(key, StringWrapper):
                 raise InvalidPlistException('Keys must be strings.')
         
         def proc_size(size):
+            # The marker and, for longer objects, the length which follows.
             if size > 0b1110:
-                size += self.intSize(size)
-            return size
+                return 2 + self.intSize(size)
+            return 1
         # If this should be a reference, then we keep a record of it in the
         # uniques table.
+        if isinstance(obj, SourceObject):
+            if obj.reader is not self.incrementalSource:
+                self.countSource(obj)
+            # Otherwise it's already in the copied object table.
+            return
         if asReference:
-            if obj in self.computedUniques:
+            if self.dedup == 'none':
+                # Every wrapped object is already unique.
+                self.objectCount += 1
+            elif obj in self.objectNumbers:
                 return
             else:
-                self.computedUniques.add(obj)
+                self.objectNumbers[obj] = None
+                self.objectCount += 1
+        
+        wrapped = obj
+        if isinstance(obj, HashableWrapper):
+            obj = obj.value
         
         if obj is None:
             self.incrementByteCount('nullBytes')
@@ -657,36 +1641,197 @@ class PlistWriter(object):
             size = self.realSize(obj)
             self.incrementByteCount('realBytes', incr=1+size)
         elif isinstance(obj, datetime.datetime):    
-            self.incrementByteCount('dateBytes', incr=2)
+            self.incrementByteCount('dateBytes', incr=9)
         elif isinstance(obj, Data):
-            size = proc_size(len(obj))
-            self.incrementByteCount('dataBytes', incr=1+size)
+            size = proc_size(len(obj)) + len(obj)
+            self.incrementByteCount('dataBytes', incr=size)
+            if self.optimize:
+                self.deferIfLargest(wrapped, len(obj), size)
         elif isinstance(obj, StringWrapper):
-            size = proc_size(len(obj))
-            self.incrementByteCount('stringBytes', incr=1+size)
-        elif isinstance(obj, HashableWrapper):
-            obj = obj.value
-            if isinstance(obj, set):
-                size = proc_size(len(obj))
-                self.incrementByteCount('setBytes', incr=1+size)
-                for value in obj:
-                    self.computeOffsets(value, asReference=True)
-            elif isinstance(obj, (list, tuple)):
-                size = proc_size(len(obj))
-                self.incrementByteCount('arrayBytes', incr=1+size)
-                for value in obj:
-                    asRef = True
-                    self.computeOffsets(value, asReference=True)
-            elif isinstance(obj, dict):
-                size = proc_size(len(obj))
-                self.incrementByteCount('dictBytes', incr=1+size)
-                for key, value in iteritems(obj):
-                    check_key(key)
-                    self.computeOffsets(key, asReference=True)
-                    self.computeOffsets(value, asReference=True)
+            size = proc_size(len(obj)) + len(obj.encodedValue)
+            self.incrementByteCount('stringBytes', incr=size)
+            if self.optimize:
+                self.deferIfLargest(wrapped, len(obj.encodedValue), size)
+        elif isinstance(obj, set):
+            self.incrementByteCount('setBytes', incr=proc_size(len(obj)))
+            self.computedReferences += len(obj)
+            for value in obj:
+                self.computeOffsets(value, asReference=True)
+        elif isinstance(obj, (list, tuple)):
+            self.incrementByteCount('arrayBytes', incr=proc_size(len(obj)))
+            self.computedReferences += len(obj)
+            for value in obj:
+                self.computeOffsets(value, asReference=True)
+        elif isinstance(obj, dict):
+            self.incrementByteCount('dictBytes', incr=proc_size(len(obj)))
+            self.computedReferences += 2 * len(obj)
+            for key, value in iteritems(obj):
+                check_key(key)
+                self.computeOffsets(key, asReference=True)
+                self.computeOffsets(value, asReference=True)
         else:
             raise InvalidPlistException("Unknown object type: %s (%s)" % (type(obj).__name__, repr(obj)))
 
+    def countSource(self, obj):
+        """Counts the bytes, objects and object references copied for a
+           SourceObject and the objects it refers to, as computeOffsets does
+           for encoded objects. Each object is only read once."""
+        reader = obj.reader
+        table = self.sourceTables.get(id(reader))
+        if table is None:
+            table = self.sourceTables[id(reader)] = SourceTable(reader)
+        contents = reader.contents
+        offsets = reader.offsets
+        numbers = table.numbers
+        layouts = table.layouts
+        totals = self.byteTotals
+        refSize = reader.trailer.objectRefSize
+        refFormat = {1:'B', 2:'H', 4:'L', 8:'Q'}.get(refSize)
+        pending = [obj.objectNumber]
+        while pending:
+            objectNumber = pending.pop()
+            if numbers[objectNumber] is not None:
+                continue
+            numbers[objectNumber] = -1
+            self.objectCount += 1
+            start = offsets[objectNumber]
+            marker = unpack_from('>B', contents, start)[0]
+            format = marker >> 4
+            extra = marker & 0b1111
+            if format in (0b1010, 0b1100, 0b1101):
+                if extra == 0b1111:
+                    format, extra = reader.readObjectHeader(objectNumber)
+                    headerLength = reader.currentOffset - start
+                else:
+                    headerLength = 1
+                count = 2 * extra if format == 0b1101 else extra
+                if refFormat is not None:
+                    refs = unpack_from('>%d%s' % (count, refFormat), contents, start + headerLength)
+                else:
+                    reader.currentOffset = start + headerLength
+                    refs = reader.readRefs(count)
+                layouts[objectNumber] = (headerLength, refs)
+                totals[byteCountIndexes[formatByteCounts[format]]] += headerLength
+                self.computedReferences += count
+                pending.extend(refs)
+                continue
+            if format == 0b0000:
+                field = 'boolBytes' if extra in (0b1000, 0b1001) else 'nullBytes'
+                length = 1
+            else:
+                field = formatByteCounts.get(format, 'nullBytes')
+                if format in (0b0001, 0b0010):
+                    length = 1 + (1 << extra)
+                elif format == 0b0011:
+                    length = 9
+                elif format == 0b1000:
+                    length = 2 + extra
+                elif extra < 0b1111 and format in (0b0100, 0b0101):
+                    length = 1 + extra
+                elif extra < 0b1111 and format == 0b0110:
+                    length = 1 + 2 * extra
+                else:
+                    length = reader.objectLength(objectNumber)
+            layouts[objectNumber] = length
+            totals[byteCountIndexes[field]] += length
+
+    def writeSource(self, obj, output):
+        """Copies a SourceObject counted by countSource, and the objects it
+           refers to which haven't been written yet, to the output, in the
+           order writeObject would write them. Returns output."""
+        reader = obj.reader
+        table = self.sourceTables[id(reader)]
+        contents = reader.contents
+        offsets = reader.offsets
+        numbers = table.numbers
+        layouts = table.layouts
+        refSize = self.trailer.objectRefSize
+        refFormat = {1:'B', 2:'H', 4:'L', 8:'Q'}.get(refSize)
+        pending = [obj.objectNumber]
+        while pending:
+            objectNumber = pending.pop()
+            self.offsets[numbers[objectNumber]] = len(output)
+            start = offsets[objectNumber]
+            layout = layouts[objectNumber]
+            if not isinstance(layout, tuple):
+                output += contents[start:start + layout]
+                continue
+            headerLength, refs = layout
+            output += contents[start:start + headerLength]
+            renumbered = []
+            new = []
+            for ref in refs:
+                number = numbers[ref]
+                if number < 0:
+                    number = numbers[ref] = self.nextObjectNumber
+                    self.nextObjectNumber += 1
+                    new.append(ref)
+                renumbered.append(number)
+            if refFormat is not None:
+                output += pack('>%d%s' % (len(renumbered), refFormat), *renumbered)
+            else:
+                for number in renumbered:
+                    output += self.binaryInt(number, byteSize=refSize)
+            self.referenceCount += len(refs)
+            # Each new object is written, along with the new objects it
+            # refers to, before the next one.
+            new.reverse()
+            pending.extend(new)
+        return output
+
+    def deferIfLargest(self, obj, size, encodedSize):
+        """Makes obj the object to be written at the end if it's larger
+           than the current one. encodedSize is the number of bytes it's
+           written as."""
+        if size > self.deferredObjectSize or (self.canonical and self.deferredObject is not None and
+                size == self.deferredObjectSize and
+                self.canonicalKey(obj) > self.canonicalKey(self.deferredObject)):
+            self.deferredObject = obj
+            self.deferredObjectSize = size
+            self.deferredObjectBytes = encodedSize
+
+    def canonicalKey(self, obj):
+        """Returns a key which sorts wrapped objects in the same order
+           whatever order they're found in."""
+        if isinstance(obj, HashableWrapper):
+            obj = obj.value
+        if obj is None:
+            return (0,)
+        elif isinstance(obj, BoolWrapper):
+            return (1, obj.value)
+        elif isinstance(obj, Uid):
+            return (2, obj.integer)
+        elif isinstance(obj, (int, long)):
+            return (3, obj)
+        elif isinstance(obj, FloatWrapper):
+            # NaN doesn't compare equal to anything, so sorts first.
+            if obj.value != obj.value:
+                return (4, 0)
+            return (4, 1, obj.value)
+        elif isinstance(obj, datetime.datetime):
+            return (5, obj)
+        elif isinstance(obj, Data):
+            return (6, bytes(obj))
+        elif isinstance(obj, StringWrapper):
+            return (7, obj.encodedValue.decode(obj.encoding))
+        elif isinstance(obj, bytes):
+            return (7, obj.decode('ascii'))
+        elif isinstance(obj, (list, tuple)):
+            return (8, tuple([self.canonicalKey(value) for value in obj]))
+        elif isinstance(obj, set):
+            return (9, tuple(sorted([self.canonicalKey(value) for value in obj])))
+        elif isinstance(obj, dict):
+            return (10, tuple(sorted([(self.canonicalKey(key), self.canonicalKey(value))
+                                      for key, value in iteritems(obj)])))
+        raise InvalidPlistException("Unknown object type: %s (%s)" % (type(obj).__name__, repr(obj)))
+
+    def isDeferred(self, obj):
+        """Returns True if obj is the object to be written at the end."""
+        deferred = self.deferredObject
+        # Equal objects share an entry in objectNumbers, so are the same
+        # object in the plist even when they have different wrappers.
+        return deferred is not None and (obj is deferred or obj == deferred)
+
     def writeObjectReference(self, obj, output):
         """Tries to write an object reference, adding it to the references
            table. Does not write the actual object bytes or set the reference
@@ -694,14 +1839,32 @@ class PlistWriter(object):
            (True if it was, False if it already was in the reference table)
            and the new output.
         """
-        position = self.positionOfObjectReference(obj)
-        if position is None:
-            self.writtenReferences[obj] = len(self.writtenReferences)
-            output += self.binaryInt(len(self.writtenReferences) - 1, byteSize=self.trailer.objectRefSize)
-            return (True, output)
+        self.referenceCount += 1
+        size = self.trailer.objectRefSize
+        if isinstance(obj, SourceObject):
+            if obj.reader is self.incrementalSource:
+                output += self.binaryInt(obj.objectNumber, byteSize=size)
+                return (False, output)
+            numbers = self.sourceTables[id(obj.reader)].numbers
+            position = numbers[obj.objectNumber]
+            isNew = position < 0
+            if isNew:
+                position = numbers[obj.objectNumber] = self.nextObjectNumber
+                self.nextObjectNumber += 1
         else:
-            output += self.binaryInt(position, byteSize=self.trailer.objectRefSize)
-            return (False, output)
+            position = self.objectNumbers.get(obj)
+            isNew = position is None
+            if isNew:
+                position = self.nextObjectNumber
+                self.nextObjectNumber += 1
+                self.objectNumbers[obj] = position
+        if size == 1:
+            output.append(position)
+        elif size == 2:
+            output += pack('>H', position)
+        else:
+            output += self.binaryInt(position, byteSize=size)
+        return (isNew, output)
 
     def writeObject(self, obj, output, setReferencePosition=False):
         """Serializes the given object to the output. Returns output.
@@ -722,8 +1885,14 @@ class PlistWriter(object):
             # Make one argument a float to ensure the right calculation.
             return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10.0**6) / 10.0**6
        
+        if isinstance(obj, SourceObject):
+            return self.writeSource(obj, output)
+        
         if setReferencePosition:
-            self.referencePositions[obj] = len(output)
+            self.offsets[self.objectNumbers[obj]] = len(output)
+        
+        if isinstance(obj, HashableWrapper):
+            obj = obj.value
         
         if obj is None:
             output += pack('!B', 0b00000000)
@@ -742,8 +1911,10 @@ class PlistWriter(object):
             output += pack('!B', (0b0001 << 4) | int(root))
             output += self.binaryInt(obj, as_number=True)
         elif isinstance(obj, FloatWrapper):
-            # just use doubles
-            output += pack('!B', (0b0010 << 4) | 3)
+            if self.realSize(obj) == 4:
+                output += pack('!B', (0b0010 << 4) | 2)
+            else:
+                output += pack('!B', (0b0010 << 4) | 3)
             output += self.binaryReal(obj)
         elif isinstance(obj, datetime.datetime):
             try:
@@ -756,69 +1927,69 @@ class PlistWriter(object):
             output += proc_variable_length(0b0100, len(obj))
             output += obj
         elif isinstance(obj, StringWrapper):
-            output += proc_variable_length(obj.encodingMarker, len(obj))
-            output += obj.encodedValue
+            encodedObject = obj.encodedObject
+            if encodedObject is None:
+                encodedObject = bytes(proc_variable_length(obj.encodingMarker, len(obj))) + obj.encodedValue
+                obj.encodedObject = encodedObject
+            output += encodedObject
         elif isinstance(obj, bytes):
             output += proc_variable_length(0b0101, len(obj))
             output += obj
-        elif isinstance(obj, HashableWrapper):
-            obj = obj.value
-            if isinstance(obj, (set, list, tuple)):
-                if isinstance(obj, set):
-                    output += proc_variable_length(0b1100, len(obj))
-                else:
-                    output += proc_variable_length(0b1010, len(obj))
-            
-                objectsToWrite = []
-                for objRef in obj:
-                    (isNew, output) = self.writeObjectReference(objRef, output)
-                    if isNew:
-                        objectsToWrite.append(objRef)
-                for objRef in objectsToWrite:
-                    output = self.writeObject(objRef, output, setReferencePosition=True)
-            elif isinstance(obj, dict):
-                output += proc_variable_length(0b1101, len(obj))
-                keys = []
-                values = []
-                objectsToWrite = []
-                for key, value in iteritems(obj):
-                    keys.append(key)
-                    values.append(value)
-                for key in keys:
-                    (isNew, output) = self.writeObjectReference(key, output)
-                    if isNew:
-                        objectsToWrite.append(key)
-                for value in values:
-                    (isNew, output) = self.writeObjectReference(value, output)
-                    if isNew:
-                        objectsToWrite.append(value)
-                for objRef in objectsToWrite:
-                    output = self.writeObject(objRef, output, setReferencePosition=True)
+        elif isinstance(obj, (set, list, tuple)):
+            if isinstance(obj, set):
+                output += proc_variable_length(0b1100, len(obj))
+            else:
+                output += proc_variable_length(0b1010, len(obj))
+        
+            if self.canonical and isinstance(obj, set):
+                obj = sorted(obj, key=self.canonicalKey)
+            objectsToWrite = []
+            for objRef in obj:
+                (isNew, output) = self.writeObjectReference(objRef, output)
+                if isNew and not self.isDeferred(objRef):
+                    objectsToWrite.append(objRef)
+            for objRef in objectsToWrite:
+                output = self.writeObject(objRef, output, setReferencePosition=True)
+        elif isinstance(obj, dict):
+            output += proc_variable_length(0b1101, len(obj))
+            keys = []
+            values = []
+            objectsToWrite = []
+            items = iteritems(obj)
+            if self.canonical:
+                items = sorted(items, key=lambda item: self.canonicalKey(item[0]))
+            for key, value in items:
+                keys.append(key)
+                values.append(value)
+            for key in keys:
+                (isNew, output) = self.writeObjectReference(key, output)
+                if isNew and not self.isDeferred(key):
+                    objectsToWrite.append(key)
+            for value in values:
+                (isNew, output) = self.writeObjectReference(value, output)
+                if isNew and not self.isDeferred(value):
+                    objectsToWrite.append(value)
+            for objRef in objectsToWrite:
+                output = self.writeObject(objRef, output, setReferencePosition=True)
         return output
     
     def writeOffsetTable(self, output):
         """Writes all of the object reference offsets."""
-        all_positions = []
-        writtenReferences = list(self.writtenReferences.items())
-        writtenReferences.sort(key=lambda x: x[1])
-        for obj,order in writtenReferences:
-            # Porting note: Elsewhere we deliberately replace empty unicdoe strings
-            # with empty binary strings, but the empty unicode string
-            # goes into writtenReferences.  This isn't an issue in Py2
-            # because u'' and b'' have the same hash; but it is in
-            # Py3, where they don't.
-            if bytes != str and obj == unicodeEmpty:
-                obj = b''
-            position = self.referencePositions.get(obj)
-            if position is None:
-                raise InvalidPlistException("Error while writing offsets table. Object not found. %s" % obj)
-            output += self.binaryInt(position, self.trailer.offsetSize)
-            all_positions.append(position)
+        offsetSize = self.trailer.offsetSize
+        if offsetSize in (1, 2, 4, 8):
+            # Common widths can be packed in one go.
+            format = {1:'B', 2:'H', 4:'L', 8:'Q'}[offsetSize]
+            output += pack('>%d%s' % (len(self.offsets), format), *self.offsets)
+        else:
+            for position in self.offsets:
+                output += self.binaryInt(position, offsetSize)
         return output
     
     def binaryReal(self, obj):
-        # just use doubles
-        result = pack('>d', obj.value)
+        if self.realSize(obj) == 4:
+            result = pack('>f', obj.value)
+        else:
+            result = pack('>d', obj.value)
         return result
     
     def binaryInt(self, obj, byteSize=None, as_number=False):
@@ -836,6 +2007,9 @@ class PlistWriter(object):
                 result += pack('>q', obj)
             else:
                 result += pack('>Q', obj)
+        elif byteSize < 8:
+            # Odd sized reference or offset, as chosen by referenceSize().
+            result += pack('>Q', obj)[-byteSize:]
         elif byteSize <= 16:
             try:
                 result = pack('>Q', 0) + pack('>Q', obj)
@@ -866,5 +2040,40 @@ class PlistWriter(object):
         else:
             raise InvalidPlistException("Core Foundation can't handle integers with size greater than 8 bytes.")
     
+    def referenceSize(self, obj):
+        """Returns the smallest number of bytes, from 1 to 8, which can hold
+           the given unsigned object reference or offset."""
+        size = 1
+        while obj > 0xFF and size < 8:
+            obj >>= 8
+            size += 1
+        return size
+    
     def realSize(self, obj):
+        """Returns the number of bytes used to store the given FloatWrapper."""
+        if not self.compactReals and self.realTolerance is None:
+            return 8
+        value = obj.value
+        try:
+            single = unpack('>f', pack('>f', value))[0]
+        except (OverflowError, struct_error):
+            # Too large for single precision.
+            return 8
+        if single == value or (single != single and value != value):
+            return 4
+        elif self.realTolerance is not None and abs(single - value) <= self.realTolerance * abs(value):
+            return 4
         return 8
+
+# Imported last, as these modules build on the classes above.
+from biplist.index import BinaryPlistIndex, writeSidecar
+from biplist.edit import patch
+from biplist.compare import Change, diff, apply, fingerprint
+from biplist.validation import validate
+from biplist.session import PlistSession
+from biplist.schema import compileSchema
+from biplist.parallel import writeParallel
+from biplist.transcode import transcode
+from biplist.shard import writeSharded, readSharded
+from biplist.recordlog import PlistLogWriter, PlistLogReader
+from biplist import keyedarchive
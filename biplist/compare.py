@@ -0,0 +1,255 @@
+"""Comparing binary plists.
+
+fingerprint() returns a hash of a binary plist's contents which only
+depends on the values in it, and not on how they were encoded: the same
+plist written by different writers, with objects in a different order,
+different integer widths or dictionary items in a different order, has
+the same fingerprint. Each object's fingerprint is worked out from its
+encoded bytes and the fingerprints of the objects it refers to, once per
+object number, so objects shared in the plist are only hashed once, and
+only dictionary keys and other leaf values are decoded.
+
+diff() walks the object tables of two binary plists in step, skipping
+subtrees with the same fingerprint without decoding them. Only the keys
+and values which differ are decoded.
+
+A diff is a list of Changes, each with an operation, a path (a tuple of
+keys and array indexes, as used by BinaryPlistIndex) and a value:
+
+    Change('set', path, value)    the value at path was replaced, or was
+                                  added to a dictionary or array
+    Change('delete', path, None)  the dictionary key or last array item at
+                                  path was removed
+
+Arrays are compared item by item, so inserting an item near the start of
+an array shows up as every later item being replaced.
+
+apply() applies a diff to a plist, returning the new plist. Objects which
+aren't changed are copied from the original plist rather than being
+encoded again.
+
+Diff example:
+
+    from biplist import diff, apply
+    changes = diff("old.plist", "new.plist")
+    for change in changes:
+        print change.op, change.path
+    open("merged.plist", "wb").write(apply("old.plist", changes))
+
+Fingerprint example:
+
+    from biplist import fingerprint
+    print fingerprint("example.plist")
+    print fingerprint("example.plist", perKey=True)['version']
+"""
+
+from collections import namedtuple
+import hashlib
+from struct import pack
+
+from biplist import (Data, PlistReader, Uid, InvalidPlistException, NotBinaryPlistException, long,
+                     readPlist, unicode, writePlistToString)
+from biplist.edit import setPath
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET, openPlistContents
+
+__all__ = ['Change', 'diff', 'apply', 'fingerprint']
+
+Change = namedtuple('Change', ['op', 'path', 'value'])
+
+def frame(fingerprint):
+    return pack('>L', len(fingerprint)) + fingerprint
+
+class ObjectTable(object):
+    """The objects in one binary plist, with their fingerprints."""
+    def __init__(self, contents):
+        if contents[:7] != b'bplist0':
+            raise NotBinaryPlistException()
+        self.reader = PlistReader(None)
+        self.reader.loadContents(contents)
+        self.fingerprints = [None] * len(self.reader.offsets)
+
+    def refs(self, objectNumber):
+        """Returns (format, refs) for the given object. refs is empty for
+           anything other than a container."""
+        reader = self.reader
+        format, count = reader.readObjectHeader(objectNumber)
+        if format == FORMAT_DICT:
+            count *= 2
+        elif format not in (FORMAT_ARRAY, FORMAT_SET):
+            return format, []
+        return format, reader.readRefs(count)
+
+    def fingerprint(self, objectNumber):
+        """Returns the fingerprint of the given object. Containers'
+           fingerprints are hashes; other objects' are their values in a
+           canonical form."""
+        fingerprint = self.fingerprints[objectNumber]
+        if fingerprint is not None:
+            return fingerprint
+        reader = self.reader
+        format, extra = reader.readObjectHeader(objectNumber)
+        start = reader.currentOffset
+        contents = reader.contents
+        if format == FORMAT_DICT:
+            refs = reader.readRefs(extra * 2)
+            items = sorted([frame(self.fingerprint(refs[i])) + frame(self.fingerprint(refs[extra + i]))
+                            for i in range(extra)])
+            fingerprint = b'#' + hashlib.sha1(b'dict' + b''.join(items)).digest()
+        elif format == FORMAT_SET:
+            members = sorted([frame(self.fingerprint(ref)) for ref in reader.readRefs(extra)])
+            fingerprint = b'#' + hashlib.sha1(b'set' + b''.join(members)).digest()
+        elif format == FORMAT_ARRAY:
+            items = [frame(self.fingerprint(ref)) for ref in reader.readRefs(extra)]
+            fingerprint = b'#' + hashlib.sha1(b'array' + b''.join(items)).digest()
+        # The most common leaf objects are put in canonical form straight
+        # from their encoded bytes.
+        elif format == 0b0101:
+            # ASCII strings are already UTF-8.
+            fingerprint = b's' + bytes(contents[start:start + extra])
+        elif format == 0b0110:
+            fingerprint = b's' + contents[start:start + extra * 2].decode('utf_16_be').encode('utf-8')
+        elif format == 0b0100:
+            fingerprint = b'D' + bytes(contents[start:start + extra])
+        elif format == 0b0001:
+            fingerprint = b'i' + str(reader.readInteger(pow(2, extra))).encode('ascii')
+        elif format == 0b0010 and extra in (2, 3):
+            fingerprint = b'r' + pack('>d', reader.readReal(extra))
+        elif format == 0b0011:
+            # Read as a number, as datetimes lose precision.
+            fingerprint = b'd' + bytes(contents[start:start + 8])
+        else:
+            fingerprint = scalarFingerprint(self.read(objectNumber))
+        self.fingerprints[objectNumber] = fingerprint
+        return fingerprint
+
+    def read(self, objectNumber):
+        self.reader.setCurrentOffsetToObjectNumber(objectNumber)
+        try:
+            return self.reader.readObject()
+        except TypeError as e:
+            raise InvalidPlistException(e)
+
+def scalarFingerprint(value):
+    if value is None:
+        return b'n'
+    elif value is True:
+        return b't'
+    elif value is False:
+        return b'f'
+    elif isinstance(value, Uid):
+        return b'u' + str(value.integer).encode('ascii')
+    elif isinstance(value, (int, long)):
+        return b'i' + str(value).encode('ascii')
+    elif isinstance(value, Data):
+        return b'D' + bytes(value)
+    elif isinstance(value, (bytes, unicode)):
+        if isinstance(value, bytes):
+            value = value.decode('ascii')
+        return b's' + value.encode('utf-8')
+    raise InvalidPlistException("Unexpected object: %s" % repr(value))
+
+def diffObjects(a, b, aNumber, bNumber, path, changes):
+    if a.fingerprint(aNumber) == b.fingerprint(bNumber):
+        return
+    aFormat, aRefs = a.refs(aNumber)
+    bFormat, bRefs = b.refs(bNumber)
+    if aFormat == bFormat == FORMAT_DICT:
+        diffDicts(a, b, aRefs, bRefs, path, changes)
+    elif aFormat == bFormat == FORMAT_ARRAY:
+        for i in range(min(len(aRefs), len(bRefs))):
+            diffObjects(a, b, aRefs[i], bRefs[i], path + (i,), changes)
+        for i in range(len(aRefs), len(bRefs)):
+            changes.append(Change('set', path + (i,), b.read(bRefs[i])))
+        for i in reversed(range(len(bRefs), len(aRefs))):
+            changes.append(Change('delete', path + (i,), None))
+    else:
+        changes.append(Change('set', path, b.read(bNumber)))
+
+def diffDicts(a, b, aRefs, bRefs, path, changes):
+    aCount = len(aRefs) // 2
+    bCount = len(bRefs) // 2
+    # Keys are matched by fingerprint, so only keys which are new or
+    # deleted, or have changed values, are decoded.
+    aKeys = dict((a.fingerprint(aRefs[i]), i) for i in range(aCount))
+    for i in range(bCount):
+        j = aKeys.pop(b.fingerprint(bRefs[i]), None)
+        if j is None:
+            changes.append(Change('set', path + (b.read(bRefs[i]),), b.read(bRefs[bCount + i])))
+        elif a.fingerprint(aRefs[aCount + j]) != b.fingerprint(bRefs[bCount + i]):
+            diffObjects(a, b, aRefs[aCount + j], bRefs[bCount + i],
+                        path + (b.read(bRefs[i]),), changes)
+    for j in sorted(aKeys.values()):
+        changes.append(Change('delete', path + (a.read(aRefs[j]),), None))
+
+def diff(a, b):
+    """Returns the list of Changes which turn the binary plist a into b.
+       a and b are paths, files or binary plist data.
+
+       Raises NotBinaryPlistException, InvalidPlistException"""
+    aContents, aToClose = openPlistContents(a)
+    try:
+        bContents, bToClose = openPlistContents(b)
+        try:
+            aTable = ObjectTable(aContents)
+            bTable = ObjectTable(bContents)
+            changes = []
+            diffObjects(aTable, bTable, aTable.reader.trailer.topLevelObjectNumber,
+                        bTable.reader.trailer.topLevelObjectNumber, (), changes)
+            return changes
+        finally:
+            for f in bToClose:
+                f.close()
+    finally:
+        for f in aToClose:
+            f.close()
+
+def fingerprint(pathOrFile, perKey=False):
+    """Returns the fingerprint of the binary plist at pathOrFile as a hex
+       string. If perKey is True, the root must be a dictionary, and a dict
+       mapping each of its keys to the fingerprint of its value is returned
+       instead. pathOrFile may also be the plist's data.
+
+       Raises NotBinaryPlistException, InvalidPlistException, KeyError"""
+    contents, toClose = openPlistContents(pathOrFile)
+    try:
+        table = ObjectTable(contents)
+        root = table.reader.trailer.topLevelObjectNumber
+        if not perKey:
+            return hashlib.sha1(table.fingerprint(root)).hexdigest()
+        format, refs = table.refs(root)
+        if format != FORMAT_DICT:
+            raise KeyError("The root is not a dictionary")
+        count = len(refs) // 2
+        return dict((table.read(refs[i]), hashlib.sha1(table.fingerprint(refs[count + i])).hexdigest())
+                    for i in range(count))
+    finally:
+        for f in toClose:
+            f.close()
+
+def apply(pathOrFile, changes):
+    """Applies a diff to the plist at pathOrFile, returning the result as
+       binary plist data.
+
+       Raises NotBinaryPlistException, InvalidPlistException, KeyError,
+       IndexError"""
+    root = readPlist(pathOrFile, trackChanges=True)
+    for change in changes:
+        if change.op == 'set':
+            root = setPath(root, change.path, change.value)
+        elif change.op == 'delete':
+            if not change.path:
+                raise KeyError(change.path)
+            container = root
+            for component in change.path[:-1]:
+                if isinstance(container, list):
+                    component = int(component)
+                container = container[component]
+            component = change.path[-1]
+            if isinstance(container, list):
+                component = int(component)
+                if component != len(container) - 1:
+                    raise IndexError(component)
+            del container[component]
+        else:
+            raise ValueError("Unknown change: %s" % repr(change.op))
+    return writePlistToString(root)
@@ -0,0 +1,346 @@
+"""Updating values in existing binary plist files.
+
+patch() changes values in a binary plist without reading and writing the
+whole file. Each new value is written over the old one when it fits and
+nothing else refers to the old one. Otherwise the new value is added to
+the end of the object table, and the reference to the old value is
+replaced with a reference to the new one. When anything is added, the
+offset table and trailer are rewritten after the new objects; nothing
+before them moves.
+
+Finding whether anything else refers to an object means reading every
+object reference in the plist, so this is done once per patch, and only
+when a new value is small enough to be written over the old one.
+
+If the new objects can't be referred to with the plist's object reference
+width, the plist is read and written out again in full.
+
+Patching is not atomic: a crash part way through a patch can leave the
+file unreadable.
+
+Patch example:
+
+    from biplist import patch
+    patch("example.plist", {'version':'1.1', 'counters.launches':12})
+"""
+
+from operator import itemgetter
+from struct import pack
+
+from biplist import (PlistReader, PlistWriter, InvalidPlistException, readPlist, writePlist,
+                     writePlistToString, unicode)
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET, openContents, splitPath
+
+__all__ = ['patch']
+
+class NeedsRewrite(Exception):
+    """Raised when a patch can't be applied without rewriting the file."""
+
+class PatchedContents(object):
+    """The contents of a plist as it will be after patching: the original
+       contents up to the offset table, with any overwritten bytes, followed
+       by the newly added objects."""
+    def __init__(self, original, base):
+        self.original = original
+        self.base = base
+        self.overlays = {}
+        self.appended = bytearray()
+
+    def __len__(self):
+        return self.base + len(self.appended)
+
+    def __getitem__(self, index):
+        start, stop = index.start, index.stop
+        if start >= self.base:
+            return bytes(self.appended[start-self.base:stop-self.base])
+        data = self.original[start:min(stop, self.base)]
+        for position, value in self.overlays.items():
+            if position < stop and position + len(value) > start:
+                low = max(position, start)
+                high = min(position + len(value), stop, self.base)
+                data = bytearray(data)
+                data[low-start:high-start] = value[low-position:high-position]
+                data = bytes(data)
+        if stop > self.base:
+            data += bytes(self.appended[:stop-self.base])
+        return data
+
+    def write(self, position, value):
+        if position >= self.base:
+            self.appended[position-self.base:position-self.base+len(value)] = value
+        else:
+            self.overlays[position] = value
+
+class PlistPatcher(object):
+    def __init__(self, contents):
+        self.reader = PlistReader(None)
+        self.reader.loadContents(contents)
+        self.trailer = self.reader.trailer
+        self.offsets = list(self.reader.offsets)
+        self.originalCount = len(self.offsets)
+        self.topLevelObjectNumber = self.trailer.topLevelObjectNumber
+        self.contents = PatchedContents(contents, self.trailer.offsetTableOffset)
+        self.reader.contents = self.contents
+        self.reader.offsets = self.offsets
+        # The references in the original plist, read when first needed, and
+        # the number of times each object's been referred to by copies of
+        # containers.
+        self.references = None
+        self.copiedReferences = {}
+        self.writer = PlistWriter(None)
+
+    def readReferences(self):
+        """Returns a list of every object reference in the containers of the
+           original plist. Only the marker byte of other objects is read."""
+        contents = self.contents.original
+        offsets = self.offsets[:self.originalCount]
+        size = self.trailer.objectRefSize
+        # The marker bytes of every object, gathered in one call.
+        markers = itemgetter(*offsets)(contents)
+        if len(offsets) == 1:
+            markers = (markers,)
+        if not isinstance(markers[0], int):
+            markers = bytearray(b''.join(markers))
+        chunks = []
+        total = 0
+        for objectNumber, marker in enumerate(markers):
+            format = marker >> 4
+            if format not in (FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET):
+                continue
+            count = marker & 0xf
+            if count == 0b1111:
+                format, count = self.reader.readObjectHeader(objectNumber)
+                start = self.reader.currentOffset
+            else:
+                start = offsets[objectNumber] + 1
+            if format == FORMAT_DICT:
+                count *= 2
+            chunks.append(contents[start:start + count * size])
+            total += count
+        reader = PlistReader(None)
+        reader.contents = b''.join(chunks)
+        reader.trailer = self.trailer
+        reader.currentOffset = 0
+        return reader.readRefs(total)
+
+    def referenceCount(self, objectNumber):
+        """Returns the number of references to an object in the original
+           plist, or copied from it, reading the references the first time."""
+        if self.references is None:
+            self.references = self.readReferences()
+        count = self.references.count(objectNumber) + self.copiedReferences.get(objectNumber, 0)
+        if objectNumber == self.trailer.topLevelObjectNumber:
+            count += 1
+        return count
+
+    def containerHeader(self, format, count):
+        if count < 0b1111:
+            return pack('!B', (format << 4) | count)
+        return pack('!B', (format << 4) | 0b1111) + bytes(self.writer.writeObject(count, bytearray()))
+
+    def appendObject(self, data):
+        objectNumber = len(self.offsets)
+        if objectNumber >= 1 << (8 * self.trailer.objectRefSize):
+            raise NeedsRewrite()
+        self.offsets.append(len(self.contents))
+        self.contents.appended += data
+        return objectNumber
+
+    def appendValue(self, value):
+        """Adds the objects for value to the end of the object table and
+           returns the object number of its root."""
+        source = PlistReader(None)
+        source.loadContents(writePlistToString(value))
+        first = len(self.offsets)
+        remap = lambda ref: first + ref
+        for objectNumber in range(len(source.offsets)):
+            self.appendObject(source.readRawObject(objectNumber, remap, self.trailer.objectRefSize))
+        return first + source.trailer.topLevelObjectNumber
+
+    def overwrite(self, objectNumber, value):
+        """Writes value over the given object, if it's only referred to
+           once and the new value is no longer. Returns True on success."""
+        if isinstance(value, (dict, list, tuple, set)) or objectNumber >= self.originalCount:
+            return False
+        source = PlistReader(None)
+        source.loadContents(writePlistToString(value))
+        data = source.readRawObject(source.trailer.topLevelObjectNumber)
+        if len(data) > self.reader.objectLength(objectNumber):
+            return False
+        # Checked last, as it reads every reference in the plist.
+        if self.referenceCount(objectNumber) != 1:
+            return False
+        self.contents.write(self.offsets[objectNumber], data)
+        return True
+
+    def slot(self, objectNumber, component):
+        """Returns (position of the reference, referenced object number) for
+           the given key or index in a container. The referenced object
+           number is None if there's no such key, or the index is one past
+           the end of an array."""
+        reader = self.reader
+        format, count = reader.readObjectHeader(objectNumber)
+        start = reader.currentOffset
+        size = self.trailer.objectRefSize
+        if format == FORMAT_DICT:
+            if not isinstance(component, (bytes, unicode)):
+                raise KeyError(component)
+            keys = reader.readRefs(count)
+            values = reader.readRefs(count)
+            for i, key in enumerate(keys):
+                reader.setCurrentOffsetToObjectNumber(key)
+                if reader.readObject() == component:
+                    return (start + (count + i) * size, values[i])
+            return (None, None)
+        elif format == FORMAT_ARRAY:
+            try:
+                i = int(component)
+            except ValueError:
+                raise KeyError(component)
+            if i < 0 or i > count:
+                raise IndexError(component)
+            if i == count:
+                return (None, None)
+            reader.currentOffset = start + i * size
+            return (start + i * size, reader.readRefs(1)[0])
+        raise KeyError("%s is not inside a dictionary or array" % repr(component))
+
+    def extend(self, objectNumber, component, value):
+        """Adds a new object with the given key or array item added to the
+           container, returning the new object's number."""
+        reader = self.reader
+        format, count = reader.readObjectHeader(objectNumber)
+        size = self.trailer.objectRefSize
+        if format == FORMAT_DICT:
+            keys = reader.readRefs(count) + [self.appendValue(component)]
+            values = reader.readRefs(count) + [self.appendValue(value)]
+            refs = keys + values
+        else:
+            refs = reader.readRefs(count) + [self.appendValue(value)]
+        # The old container may still be referred to elsewhere, so its
+        # children are now shared with the copy.
+        for ref in refs:
+            if ref < self.originalCount:
+                self.copiedReferences[ref] = self.copiedReferences.get(ref, 0) + 1
+        data = bytearray(self.containerHeader(format, count + 1))
+        for ref in refs:
+            data += pack('>Q', ref)[8-size:]
+        return self.appendObject(bytes(data))
+
+    def set(self, path, value):
+        components = splitPath(path)
+        if not components:
+            if not self.overwrite(self.topLevelObjectNumber, value):
+                self.topLevelObjectNumber = self.appendValue(value)
+            return
+        chain = [self.topLevelObjectNumber]
+        for component in components[:-1]:
+            position, objectNumber = self.slot(chain[-1], component)
+            if objectNumber is None:
+                raise KeyError(path)
+            chain.append(objectNumber)
+        position, objectNumber = self.slot(chain[-1], components[-1])
+        if objectNumber is not None:
+            if not self.overwrite(objectNumber, value):
+                self.setReference(position, self.appendValue(value))
+            return
+        # Add a new copy of the container with the new item, then point
+        # its parent at the copy.
+        newObjectNumber = self.extend(chain[-1], components[-1], value)
+        if len(chain) == 1:
+            self.topLevelObjectNumber = newObjectNumber
+        else:
+            position, objectNumber = self.slot(chain[-2], components[-2])
+            self.setReference(position, newObjectNumber)
+
+    def setReference(self, position, objectNumber):
+        size = self.trailer.objectRefSize
+        self.contents.write(position, pack('>Q', objectNumber)[8-size:])
+
+    def save(self, f):
+        """Writes the changes to the given file, which must be open for
+           reading and writing."""
+        for position, value in sorted(self.contents.overlays.items()):
+            f.seek(position)
+            f.write(value)
+        if not self.contents.appended and self.topLevelObjectNumber == self.trailer.topLevelObjectNumber:
+            return
+        offsetTableOffset = len(self.contents)
+        offsetSize = max(self.trailer.offsetSize, self.writer.referenceSize(self.offsets[-1]))
+        f.seek(self.contents.base)
+        f.write(self.contents.appended)
+        if offsetSize in (1, 2, 4, 8):
+            format = {1:'B', 2:'H', 4:'L', 8:'Q'}[offsetSize]
+            f.write(pack('>%d%s' % (len(self.offsets), format), *self.offsets))
+        else:
+            f.write(b''.join([pack('>Q', offset)[8-offsetSize:] for offset in self.offsets]))
+        f.write(pack('!xxxxxxBBQQQ', offsetSize, self.trailer.objectRefSize, len(self.offsets),
+                     self.topLevelObjectNumber, offsetTableOffset))
+        f.truncate()
+
+def setPath(root, path, value):
+    """Sets the value at the given path in decoded plist objects, returning
+       the new root."""
+    components = splitPath(path)
+    if not components:
+        return value
+    container = root
+    for component in components[:-1]:
+        if isinstance(container, list):
+            component = int(component)
+        container = container[component]
+    component = components[-1]
+    if isinstance(container, list):
+        component = int(component)
+        if component == len(container):
+            container.append(value)
+            return root
+    container[component] = value
+    return root
+
+def patch(pathOrFile, updates):
+    """Sets the values at the paths in updates, a dict mapping paths (as
+       used by BinaryPlistIndex) to new values. New keys may be added to
+       dictionaries, and new items to the end of arrays. pathOrFile must be
+       a path or a file opened for reading and writing.
+
+       Returns True if the file was patched, or False if it had to be
+       rewritten in full.
+
+       Raises NotBinaryPlistException, InvalidPlistException, KeyError,
+       IndexError"""
+    didOpen = False
+    if isinstance(pathOrFile, (bytes, unicode)):
+        pathOrFile = open(pathOrFile, 'r+b')
+        didOpen = True
+    try:
+        contents, toClose = openContents(pathOrFile)
+        try:
+            if contents[:7] != b'bplist0':
+                raise InvalidPlistException("Only binary plists can be patched.")
+            patcher = PlistPatcher(contents)
+            try:
+                for path, value in updates.items():
+                    patcher.set(path, value)
+            except NeedsRewrite:
+                patcher = None
+            except TypeError as e:
+                raise InvalidPlistException(e)
+        finally:
+            for f in toClose:
+                f.close()
+        if patcher is not None:
+            patcher.save(pathOrFile)
+            pathOrFile.flush()
+            return True
+        pathOrFile.seek(0)
+        root = readPlist(pathOrFile)
+        for path, value in updates.items():
+            root = setPath(root, path, value)
+        pathOrFile.seek(0)
+        writePlist(root, pathOrFile)
+        pathOrFile.truncate()
+        return False
+    finally:
+        if didOpen:
+            pathOrFile.close()
@@ -0,0 +1,562 @@
+"""Random access to the objects in a binary plist.
+
+A BinaryPlistIndex opens a binary plist once, reads its trailer and offset
+table, and then answers lookups by path by following object references,
+decoding only the objects along the path and the value being returned.
+Dictionary keys are indexed the first time each dictionary is looked into.
+
+Paths are either strings of keys separated by dots ('a.b.0') or sequences
+of keys and array indexes (('a', 'b', 0)). The empty path refers to the
+root object.
+
+The offset table and dictionary keys can also be saved to a sidecar file
+next to the plist (example.plist.bpidx by default). When a valid sidecar is
+found, opening the index only maps the two files into memory, so lookups
+can start without first reading anything in proportion to the number of
+objects. The sidecar records the size, modification time and inode of the
+plist along with checksums of its start and end, and of its whole
+contents. When the size, time and inode all match, only the start and end
+are checked; otherwise, or when the plist isn't opened from a file, the
+whole plist is checksummed. A sidecar which doesn't match the plist is
+ignored.
+
+view() returns the object at a path as a read only view which decodes
+objects as they're accessed: dictionaries as PlistDictViews (Mappings) and
+arrays as PlistArrayViews (Sequences), with the containers inside them
+returned as views in turn, and other objects decoded. Iterating over a
+dictionary view decodes its keys as they're reached, without indexing the
+dictionary; looking up a key indexes it as above, unless there's a
+sidecar. Views can only be used while their index is open.
+
+As the plist and its sidecar are mapped into memory read only, processes
+which open the same files share one copy of them in the page cache, rather
+than each decoding its own copy of the plist. With a sidecar, lookups by
+key don't build anything in proportion to the size of the plist, so
+forked workers each opening an index (or inheriting one opened before
+forking) use little memory of their own.
+
+Index example:
+
+    from biplist import BinaryPlistIndex, writeSidecar
+    writeSidecar("example.plist")
+    with BinaryPlistIndex("example.plist") as index:
+        print index.get('list.0')
+        print index.keys()
+
+Shared view example:
+
+    writeSidecar("catalog.plist")
+    index = BinaryPlistIndex("catalog.plist")
+    # ... fork workers, which use:
+    catalog = index.view()
+    print catalog['products'][10]['name']
+"""
+
+import hashlib
+import mmap
+import os
+from struct import calcsize, pack, unpack, unpack_from
+import threading
+import zlib
+try:
+    from collections.abc import ItemsView, Mapping, Sequence, ValuesView
+except ImportError:
+    from collections import ItemsView, Mapping, Sequence, ValuesView
+import operator
+
+from biplist import PlistReader, InvalidPlistException, NotBinaryPlistException, unicode
+
+__all__ = ['BinaryPlistIndex', 'writeSidecar']
+
+SIDECAR_SUFFIX = '.bpidx'
+SIDECAR_MAGIC = b'bpidx002'
+# magic, source size, source modification time in nanoseconds, source
+# inode, stamp checksum, source checksum, object count, dictionary entry
+# count
+SIDECAR_HEADER = '>8sQQQLLQQ'
+SIDECAR_HEADER_SIZE = calcsize(SIDECAR_HEADER)
+# Size of the start and end of the plist covered by the stamp checksum.
+STAMP_SIZE = 4096
+NOT_A_DICT = 0xFFFFFFFFFFFFFFFF
+
+FORMAT_ARRAY = 0b1010
+FORMAT_SET = 0b1100
+FORMAT_DICT = 0b1101
+
+def splitPath(path):
+    """Returns the components of a path given as a dotted string or as a
+       sequence of keys and indexes."""
+    if path is None:
+        return ()
+    if isinstance(path, (bytes, unicode)):
+        if not path:
+            return ()
+        if isinstance(path, bytes) and not isinstance(path, str):
+            path = path.decode('utf-8')
+        return tuple(path.split('.'))
+    return tuple(path)
+
+def openContents(pathOrFile):
+    """Maps the given path or file into memory, returning a tuple of the
+       contents and a list of the things which need closing afterwards.
+       Falls back to reading the file if it can't be mapped."""
+    toClose = []
+    if isinstance(pathOrFile, (bytes, unicode)):
+        pathOrFile = open(pathOrFile, 'rb')
+        toClose.append(pathOrFile)
+    try:
+        contents = mmap.mmap(pathOrFile.fileno(), 0, access=mmap.ACCESS_READ)
+        toClose.insert(0, contents)
+    except (AttributeError, IOError, OSError, ValueError):
+        # Not a real file (e.g. BytesIO), or an empty one.
+        pathOrFile.seek(0)
+        contents = pathOrFile.read()
+    return contents, toClose
+
+def openPlistContents(pathOrData):
+    """As openContents, but binary plist data, as bytes starting with the
+       bplist header, is used as the contents rather than as a path."""
+    if isinstance(pathOrData, (bytes, bytearray)) and pathOrData[:6] == b'bplist':
+        return pathOrData, []
+    return openContents(pathOrData)
+
+def keyHash(key):
+    """Returns a 64 bit hash of a dictionary key which is stable between
+       processes."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return unpack('>Q', hashlib.sha1(key).digest()[:8])[0]
+
+def stampChecksum(contents):
+    return zlib.crc32(contents[:STAMP_SIZE] + contents[-STAMP_SIZE:]) & 0xffffffff
+
+def fileStamp(pathOrFile):
+    """Returns (modification time in nanoseconds, inode) for a path or
+       file, or None if it isn't a file."""
+    try:
+        if isinstance(pathOrFile, (bytes, unicode)):
+            st = os.stat(pathOrFile)
+        else:
+            st = os.fstat(pathOrFile.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    # As stored in the sidecar.
+    return (mtime & 0xFFFFFFFFFFFFFFFF, st.st_ino & 0xFFFFFFFFFFFFFFFF)
+
+def sourceChecksum(contents):
+    checksum = 0
+    for start in range(0, len(contents), 1 << 20):
+        checksum = zlib.crc32(contents[start:start + (1 << 20)], checksum)
+    return checksum & 0xffffffff
+
+class UnsignedTable(object):
+    """A read only sequence of 8 byte unsigned integers in a buffer."""
+    def __init__(self, contents, start, count, width=1):
+        self.contents = contents
+        self.start = start
+        self.count = count
+        self.width = width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return unpack_from('>Q', self.contents, self.start + 8 * self.width * i)[0]
+
+    def row(self, i):
+        """Returns the width integers at row i."""
+        return unpack_from('>%dQ' % self.width, self.contents, self.start + 8 * self.width * i)
+
+class Sidecar(object):
+    """The offset table and dictionary key hashes of a plist, as saved by
+       writeSidecar()."""
+    def __init__(self, contents, plistContents, verify=False, plistStamp=None):
+        """plistStamp is the fileStamp() of the plist. Unless it matches the
+           one recorded and verify is False, the whole plist is checksummed.
+           
+           Raises InvalidPlistException if the sidecar doesn't belong to
+           the given plist contents."""
+        self.contents = contents
+        if len(contents) < SIDECAR_HEADER_SIZE:
+            raise InvalidPlistException("Sidecar is too short.")
+        (magic, sourceSize, mtime, inode, stamp, checksum, objectCount,
+         entryCount) = unpack_from(SIDECAR_HEADER, contents)
+        if magic != SIDECAR_MAGIC:
+            raise InvalidPlistException("Not a sidecar index.")
+        if len(contents) != SIDECAR_HEADER_SIZE + 8 * (2 * objectCount + 3 * entryCount):
+            raise InvalidPlistException("Sidecar is truncated.")
+        if sourceSize != len(plistContents) or stamp != stampChecksum(plistContents):
+            raise InvalidPlistException("Sidecar doesn't match the plist.")
+        # A rewrite of the same size may only change the middle of the
+        # plist, so the stamp alone isn't enough.
+        if (verify or plistStamp != (mtime, inode)) and checksum != sourceChecksum(plistContents):
+            raise InvalidPlistException("Sidecar checksum doesn't match the plist.")
+        start = SIDECAR_HEADER_SIZE
+        self.offsets = UnsignedTable(contents, start, objectCount)
+        start += 8 * objectCount
+        self.dictStarts = UnsignedTable(contents, start, objectCount)
+        start += 8 * objectCount
+        # (key hash, key object number, value object number), sorted by
+        # hash within each dictionary.
+        self.entries = UnsignedTable(contents, start, entryCount, width=3)
+
+    def candidates(self, objectNumber, count, key):
+        """Returns the (key, value) object numbers of the entries in the
+           given dictionary whose keys have the same hash as key."""
+        first = self.dictStarts[objectNumber]
+        if first == NOT_A_DICT:
+            return None
+        target = keyHash(key)
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entries[middle] < target:
+                low = middle + 1
+            else:
+                high = middle
+        result = []
+        while low < first + count:
+            entry = self.entries.row(low)
+            if entry[0] != target:
+                break
+            result.append(entry[1:])
+            low += 1
+        return result
+
+def sidecarPathForPlist(path):
+    if isinstance(path, bytes) and not isinstance(path, str):
+        return path + SIDECAR_SUFFIX.encode('ascii')
+    return path + SIDECAR_SUFFIX
+
+def writeSidecar(plistPath, sidecarPath=None):
+    """Saves the offset table and dictionary keys of the plist at plistPath
+       to sidecarPath (plistPath + '.bpidx' by default), so later indexes
+       can open it without reading them again."""
+    if sidecarPath is None:
+        sidecarPath = sidecarPathForPlist(plistPath)
+    # Taken first, so a change while it's being read isn't missed.
+    mtime, inode = fileStamp(plistPath)
+    with BinaryPlistIndex(plistPath, sidecar=False) as index:
+        reader = index.threadReader()
+        contents = index.contents
+        objectCount = len(reader.offsets)
+        dictStarts = []
+        entries = []
+        for objectNumber in range(objectCount):
+            format, refs = index.containerRefs(objectNumber)
+            if format != FORMAT_DICT:
+                dictStarts.append(NOT_A_DICT)
+                continue
+            dictEntries = []
+            for key, value in zip(*refs):
+                reader.setCurrentOffsetToObjectNumber(key)
+                dictEntries.append((keyHash(reader.readObject()), key, value))
+            dictEntries.sort()
+            dictStarts.append(len(entries))
+            entries.extend(dictEntries)
+        tmpPath = sidecarPath + ('.tmp' if isinstance(sidecarPath, str) else b'.tmp')
+        with open(tmpPath, 'wb') as f:
+            f.write(pack(SIDECAR_HEADER, SIDECAR_MAGIC, len(contents), mtime, inode, stampChecksum(contents),
+                         sourceChecksum(contents), objectCount, len(entries)))
+            f.write(pack('>%dQ' % objectCount, *reader.offsets))
+            f.write(pack('>%dQ' % objectCount, *dictStarts))
+            for i in range(0, len(entries), 4096):
+                chunk = entries[i:i + 4096]
+                f.write(pack('>%dQ' % (3 * len(chunk)), *[n for entry in chunk for n in entry]))
+        os.rename(tmpPath, sidecarPath)
+    return sidecarPath
+
+class BinaryPlistIndex(object):
+    """Answers repeated lookups against a single binary plist. Safe to
+       share between threads."""
+    contents = None
+    reader = None
+    sidecar = None
+    rootObjectNumber = 0
+
+    def __init__(self, pathOrFile, sidecar=True, verify=False):
+        """If sidecar is True, the sidecar next to the plist is used if it
+           exists and matches the plist; it may also be the path of the
+           sidecar, or False not to use one. If verify is True, the whole
+           plist is checksummed before a sidecar is trusted, even if its
+           modification time and inode match.
+           
+           Raises NotBinaryPlistException, InvalidPlistException"""
+        self.contents, self.toClose = openContents(pathOrFile)
+        try:
+            if self.contents[:7] != b'bplist0':
+                raise NotBinaryPlistException()
+            if sidecar is True:
+                sidecar = None
+                if isinstance(pathOrFile, (bytes, unicode)):
+                    sidecar = sidecarPathForPlist(pathOrFile)
+            if sidecar and os.path.exists(sidecar):
+                self.sidecar = self.openSidecar(sidecar, verify, fileStamp(pathOrFile))
+            self.reader = PlistReader(None)
+            if self.sidecar is not None:
+                self.reader.loadContents(self.contents, offsets=self.sidecar.offsets)
+            else:
+                self.reader.loadContents(self.contents)
+        except:
+            self.close()
+            raise
+        self.rootObjectNumber = self.reader.trailer.topLevelObjectNumber
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Maps dictionary object numbers to {key: value object number}.
+        self.dictIndexes = {}
+
+    def openSidecar(self, path, verify, plistStamp):
+        """Returns the Sidecar at path, or None if it's not valid for this
+           plist."""
+        contents, toClose = openContents(path)
+        try:
+            sidecar = Sidecar(contents, self.contents, verify, plistStamp)
+        except InvalidPlistException:
+            for f in toClose:
+                f.close()
+            return None
+        self.toClose.extend(toClose)
+        return sidecar
+
+    def close(self):
+        for f in self.toClose:
+            f.close()
+        self.toClose = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def threadReader(self):
+        """Returns a PlistReader for the current thread, sharing this
+           index's contents and offset table."""
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            reader = PlistReader(None)
+            reader.contents = self.reader.contents
+            reader.offsets = self.reader.offsets
+            reader.trailer = self.reader.trailer
+            self.local.reader = reader
+        return reader
+
+    def containerRefs(self, objectNumber):
+        """Returns (format, refs) for the container with the given object
+           number. For dictionaries, refs is a tuple of (keys, values)."""
+        reader = self.threadReader()
+        format, count = reader.readObjectHeader(objectNumber)
+        if format == FORMAT_DICT:
+            return format, (reader.readRefs(count), reader.readRefs(count))
+        elif format in (FORMAT_ARRAY, FORMAT_SET):
+            return format, reader.readRefs(count)
+        return format, None
+
+    def dictIndex(self, objectNumber):
+        """Returns the {key: value object number} index of a dictionary,
+           building it the first time, or None if it's not a dictionary."""
+        index = self.dictIndexes.get(objectNumber)
+        if index is None:
+            format, refs = self.containerRefs(objectNumber)
+            if format != FORMAT_DICT:
+                return None
+            with self.lock:
+                index = self.dictIndexes.get(objectNumber)
+                if index is None:
+                    reader = self.threadReader()
+                    index = {}
+                    for key, value in zip(*refs):
+                        reader.setCurrentOffsetToObjectNumber(key)
+                        index[reader.readObject()] = value
+                    self.dictIndexes[objectNumber] = index
+        return index
+
+    def childObjectNumber(self, objectNumber, component):
+        """Returns the object number of the given key or index within a
+           container. Raises KeyError or IndexError if there is none."""
+        reader = self.threadReader()
+        format, count = reader.readObjectHeader(objectNumber)
+        if format == FORMAT_DICT:
+            if not isinstance(component, (bytes, unicode)):
+                raise KeyError(component)
+            if self.sidecar is not None and objectNumber not in self.dictIndexes:
+                candidates = self.sidecar.candidates(objectNumber, count, component)
+                if candidates is not None:
+                    for key, value in candidates:
+                        reader.setCurrentOffsetToObjectNumber(key)
+                        if reader.readObject() == component:
+                            return value
+                    raise KeyError(component)
+            return self.dictIndex(objectNumber)[component]
+        elif format in (FORMAT_ARRAY, FORMAT_SET):
+            try:
+                i = int(component)
+            except ValueError:
+                raise KeyError(component)
+            if i < 0 or i >= count:
+                raise IndexError(component)
+            # Only the one reference is read.
+            reader.currentOffset += i * reader.trailer.objectRefSize
+            return reader.readRefs(1)[0]
+        raise KeyError("%s is not inside a container" % repr(component))
+
+    def objectNumberForPath(self, path):
+        objectNumber = self.rootObjectNumber
+        for component in splitPath(path):
+            objectNumber = self.childObjectNumber(objectNumber, component)
+        return objectNumber
+
+    def readObjectNumber(self, objectNumber):
+        reader = self.threadReader()
+        reader.setCurrentOffsetToObjectNumber(objectNumber)
+        try:
+            return reader.readObject()
+        except TypeError as e:
+            raise InvalidPlistException(e)
+
+    def get(self, path=None, default=None):
+        """Returns the decoded object at the given path, or default if
+           there's nothing there."""
+        try:
+            objectNumber = self.objectNumberForPath(path)
+        except (KeyError, IndexError):
+            return default
+        return self.readObjectNumber(objectNumber)
+
+    def __getitem__(self, path):
+        return self.readObjectNumber(self.objectNumberForPath(path))
+
+    def __contains__(self, path):
+        try:
+            self.objectNumberForPath(path)
+        except (KeyError, IndexError):
+            return False
+        return True
+
+    def keys(self, path=None):
+        """Returns the keys of the dictionary at the given path."""
+        index = self.dictIndex(self.objectNumberForPath(path))
+        if index is None:
+            raise KeyError("%s is not a dictionary" % repr(path))
+        return list(index.keys())
+
+    def len(self, path=None):
+        """Returns the number of items in the container at the given path,
+           without reading the items."""
+        format, count = self.threadReader().readObjectHeader(self.objectNumberForPath(path))
+        if format not in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+            raise KeyError("%s is not a container" % repr(path))
+        return count
+
+    def view(self, path=None):
+        """Returns the object at the given path, as a view if it's a
+           dictionary or array."""
+        return self.viewObjectNumber(self.objectNumberForPath(path))
+
+    def viewObjectNumber(self, objectNumber):
+        format, count = self.threadReader().readObjectHeader(objectNumber)
+        if format == FORMAT_DICT:
+            return PlistDictView(self, objectNumber, count)
+        elif format == FORMAT_ARRAY:
+            return PlistArrayView(self, objectNumber, count)
+        return self.readObjectNumber(objectNumber)
+
+    def subtree(self, path):
+        """Returns an index rooted at the object at the given path, which
+           shares this index's contents and caches."""
+        objectNumber = self.objectNumberForPath(path)
+        subtree = object.__new__(BinaryPlistIndex)
+        subtree.__dict__.update(self.__dict__)
+        subtree.rootObjectNumber = objectNumber
+        # The subtree doesn't own the file.
+        subtree.toClose = []
+        return subtree
+
+class PlistDictView(Mapping):
+    """A read only view of a dictionary in a BinaryPlistIndex."""
+    def __init__(self, index, objectNumber, count):
+        self.index = index
+        self.objectNumber = objectNumber
+        self.count = count
+
+    def __getitem__(self, key):
+        return self.index.viewObjectNumber(self.index.childObjectNumber(self.objectNumber, key))
+
+    def __iter__(self):
+        for key, value in self.iterRefs():
+            yield key
+
+    def iterRefs(self):
+        """Yields (key, value object number) for each item, decoding the
+           keys as they're reached rather than indexing the dictionary."""
+        dictIndex = self.index.dictIndexes.get(self.objectNumber)
+        if dictIndex is not None:
+            for item in dictIndex.items():
+                yield item
+            return
+        format, (keys, values) = self.index.containerRefs(self.objectNumber)
+        for key, value in zip(keys, values):
+            yield self.index.readObjectNumber(key), value
+
+    def items(self):
+        return PlistItemsView(self)
+
+    def values(self):
+        return PlistValuesView(self)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<PlistDictView of object %d, %d items>" % (self.objectNumber, self.count)
+
+class PlistItemsView(ItemsView):
+    def __iter__(self):
+        view = self._mapping
+        for key, value in view.iterRefs():
+            yield (key, view.index.viewObjectNumber(value))
+
+class PlistValuesView(ValuesView):
+    def __iter__(self):
+        view = self._mapping
+        for key, value in view.iterRefs():
+            yield view.index.viewObjectNumber(value)
+
+class PlistArrayView(Sequence):
+    """A read only view of an array in a BinaryPlistIndex."""
+    def __init__(self, index, objectNumber, count):
+        self.index = index
+        self.objectNumber = objectNumber
+        self.count = count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        try:
+            i = operator.index(i)
+        except TypeError:
+            raise TypeError("array indices must be integers or slices, not %s" % type(i).__name__)
+        if i < 0:
+            i += self.count
+        return self.index.viewObjectNumber(self.index.childObjectNumber(self.objectNumber, i))
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, PlistArrayView)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "<PlistArrayView of object %d, %d items>" % (self.objectNumber, self.count)
@@ -0,0 +1,424 @@
+"""Reading and writing NSKeyedArchiver archives.
+
+An NSKeyedArchiver archive is a plist whose $objects array holds every
+archived object, with objects referring to each other by Uid (an index into
+$objects), and whose $top dictionary refers to the root objects.
+
+unarchive() reads $top and $objects straight from the object table of a
+binary plist, rather than reading the whole plist and then resolving the
+Uids. Only the objects reachable from the requested root are decoded, each
+only once however many times it's referred to, so objects shared in the
+archive are shared in the result.
+
+Archived objects are decoded by the decoder registered for their class,
+or for the nearest of its superclasses which has one. Decoders are given
+an ArchivedFields, whose items are the object's decoded fields, and return
+the decoded object. Decoders are registered for the common Foundation
+classes: NSArray, NSSet, NSDictionary, NSString, NSData, NSDate, NSNull and
+NSUUID, and their mutable subclasses. Objects of other classes are
+returned as ArchivedObjects: dicts of their decoded fields, which also
+record their class names. These may refer to each other in cycles.
+
+archive() does the reverse, building the wrapped objects PlistWriter
+writes for $objects directly as it assigns Uids, so nothing is wrapped or
+deduplicated a second time when the archive is written. Python dicts,
+lists, tuples, sets, datetimes and UUIDs are archived as the Foundation
+classes above, and strings, numbers and data are stored directly in
+$objects, shared between everything referring to equal values. Objects of
+other types are archived by the encoder registered for their type, which
+returns an ArchivedObject of the fields to archive. Integer, real and
+boolean fields are stored inline; other fields refer to archived objects.
+Each class's description is only archived once.
+
+Unarchive example:
+
+    from biplist import keyedarchive
+    keyedarchive.registerDecoder('Person', lambda fields: Person(fields['name']))
+    root = keyedarchive.unarchive("archive.plist")
+
+Archive example:
+
+    def encodePerson(person):
+        fields = keyedarchive.ArchivedObject(name=person.name)
+        fields.className = 'Person'
+        return fields
+    keyedarchive.registerEncoder(Person, encodePerson)
+    data = keyedarchive.archive([Person('Ann')])
+"""
+
+import datetime
+import io
+import uuid
+
+from biplist import (Data, FloatWrapper, HashableWrapper, PlistReader, PlistWriter, StringWrapper, Uid,
+                     InvalidPlistException, NotBinaryPlistException, apple_reference_date, long,
+                     unicode, utcDatetime)
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET, openContents
+
+__all__ = ['ArchivedFields', 'ArchivedObject', 'registerDecoder', 'registerEncoder', 'unarchive', 'archive']
+
+FORMAT_UID = 0b1000
+
+# Marks objects being decoded by a decoder, which can't refer back to them.
+decoding = object()
+
+# Decoders, keyed by class name.
+classDecoders = {}
+
+def registerDecoder(className, decoder):
+    """Registers a function to decode archived objects of the given class,
+       and its subclasses without decoders of their own. It's given an
+       ArchivedFields and returns the decoded object."""
+    classDecoders[className] = decoder
+
+# Encoders, keyed by Python type.
+typeEncoders = {}
+
+def registerEncoder(cls, encoder):
+    """Registers a function to encode objects of the given type, and its
+       subclasses without encoders of their own. It's given the object and
+       returns an ArchivedObject of the fields to archive."""
+    typeEncoders[cls] = encoder
+
+class ArchivedObject(dict):
+    """An archived object of a class with no decoder: a dict of its
+       decoded fields. If classes isn't set when archiving, the class is
+       archived as a subclass of NSObject."""
+    className = None
+    # The names of the object's class and its superclasses.
+    classes = None
+
+    def __repr__(self):
+        return "<ArchivedObject %s: %s>" % (self.className, dict.__repr__(self))
+
+class ArchivedFields(object):
+    """The fields of an archived object, which are decoded as they're
+       looked up."""
+    def __init__(self, unarchiver, className, classes, refs):
+        self.unarchiver = unarchiver
+        self.className = className
+        self.classes = classes
+        self.refs = refs
+
+    def __getitem__(self, key):
+        return self.unarchiver.decodeValue(self.refs[key])
+
+    def __contains__(self, key):
+        return key in self.refs
+
+    def get(self, key, default=None):
+        if key not in self.refs:
+            return default
+        return self[key]
+
+    def keys(self):
+        return list(self.refs.keys())
+
+class KeyedUnarchiver(object):
+    def __init__(self, contents, decoders):
+        if contents[:7] != b'bplist0':
+            raise NotBinaryPlistException()
+        self.reader = PlistReader(None)
+        self.reader.loadContents(contents)
+        self.decoders = decoders
+        root = self.dictRefs(self.reader.trailer.topLevelObjectNumber)
+        if root is None or '$objects' not in root or '$top' not in root:
+            raise InvalidPlistException("Not a keyed archive.")
+        format, count = self.reader.readObjectHeader(root['$objects'])
+        if format != FORMAT_ARRAY:
+            raise InvalidPlistException("$objects is not an array.")
+        self.objects = self.reader.readRefs(count)
+        self.top = self.dictRefs(root['$top'])
+        if self.top is None:
+            raise InvalidPlistException("$top is not a dictionary.")
+        # Decoded objects and class names, keyed by index in $objects.
+        self.decoded = {}
+        self.classNames = {}
+
+    def read(self, objectNumber):
+        self.reader.setCurrentOffsetToObjectNumber(objectNumber)
+        return self.reader.readObject()
+
+    def dictRefs(self, objectNumber):
+        """Returns a dict mapping the keys of a dictionary to the object
+           numbers of their values, or None if it's not a dictionary."""
+        format, count = self.reader.readObjectHeader(objectNumber)
+        if format != FORMAT_DICT:
+            return None
+        keys = self.reader.readRefs(count)
+        values = self.reader.readRefs(count)
+        return dict(zip([self.read(key) for key in keys], values))
+
+    def uid(self, objectNumber):
+        """Returns the integer value of a Uid, or None if it's not a Uid."""
+        format, extra = self.reader.readObjectHeader(objectNumber)
+        if format != FORMAT_UID:
+            return None
+        return self.reader.readInteger(extra + 1)
+
+    def decodeValue(self, objectNumber):
+        """Decodes a plist object, replacing Uids with the archived objects
+           they refer to."""
+        format, count = self.reader.readObjectHeader(objectNumber)
+        if format == FORMAT_UID:
+            return self.decodeObject(self.reader.readInteger(count + 1))
+        elif format == FORMAT_ARRAY:
+            return [self.decodeValue(ref) for ref in self.reader.readRefs(count)]
+        elif format == FORMAT_SET:
+            return set([self.decodeValue(ref) for ref in self.reader.readRefs(count)])
+        elif format == FORMAT_DICT:
+            refs = self.dictRefs(objectNumber)
+            return dict((key, self.decodeValue(ref)) for key, ref in refs.items())
+        return self.read(objectNumber)
+
+    def classOf(self, index):
+        """Returns (class name, class names) for the class object at the
+           given index in $objects."""
+        names = self.classNames.get(index)
+        if names is None:
+            refs = self.dictRefs(self.objectNumber(index))
+            if refs is None or '$classname' not in refs:
+                raise InvalidPlistException("Invalid class for archived object.")
+            className = self.read(refs['$classname'])
+            classes = [className]
+            if '$classes' in refs:
+                classes = self.read(refs['$classes'])
+            names = (className, classes)
+            self.classNames[index] = names
+        return names
+
+    def objectNumber(self, index):
+        if not 0 <= index < len(self.objects):
+            raise InvalidPlistException("Uid %d is not in $objects." % index)
+        return self.objects[index]
+
+    def decodeObject(self, index):
+        """Returns the archived object at the given index in $objects."""
+        if index in self.decoded:
+            decoded = self.decoded[index]
+            if decoded is decoding:
+                raise InvalidPlistException("Archived object %d contains itself." % index)
+            return decoded
+        objectNumber = self.objectNumber(index)
+        refs = self.dictRefs(objectNumber)
+        if refs is None or '$class' not in refs:
+            value = self.decodeValue(objectNumber)
+            if value == '$null':
+                value = None
+            self.decoded[index] = value
+            return value
+        classIndex = self.uid(refs.pop('$class'))
+        if classIndex is None:
+            raise InvalidPlistException("Invalid class for archived object.")
+        className, classes = self.classOf(classIndex)
+        for name in classes:
+            decoder = self.decoders.get(name)
+            if decoder is not None:
+                self.decoded[index] = decoding
+                value = decoder(ArchivedFields(self, className, classes, refs))
+                self.decoded[index] = value
+                return value
+        # Recorded before the fields are decoded, so that they can refer
+        # back to it.
+        value = ArchivedObject()
+        value.className = className
+        value.classes = classes
+        self.decoded[index] = value
+        for key, ref in refs.items():
+            value[key] = self.decodeValue(ref)
+        return value
+
+def unarchive(pathOrFile, topKey='root', decoders=None):
+    """Decodes the object stored under topKey in the $top dictionary of the
+       binary NSKeyedArchiver archive at pathOrFile. If topKey is None, a
+       dict of all of the objects in $top is returned instead. decoders is
+       a dict of decoders to use, keyed by class name, in addition to the
+       registered ones.
+
+       Raises NotBinaryPlistException, InvalidPlistException, KeyError"""
+    contents, toClose = openContents(pathOrFile)
+    try:
+        allDecoders = classDecoders
+        if decoders:
+            allDecoders = dict(classDecoders)
+            allDecoders.update(decoders)
+        unarchiver = KeyedUnarchiver(contents, allDecoders)
+        try:
+            if topKey is None:
+                return dict((key, unarchiver.decodeValue(ref)) for key, ref in unarchiver.top.items())
+            return unarchiver.decodeValue(unarchiver.top[topKey])
+        except TypeError as e:
+            raise InvalidPlistException(e)
+    finally:
+        for f in toClose:
+            f.close()
+
+def decodeArray(fields):
+    return fields['NS.objects']
+
+def decodeSet(fields):
+    return set(fields['NS.objects'])
+
+def decodeDictionary(fields):
+    return dict(zip(fields['NS.keys'], fields['NS.objects']))
+
+def decodeString(fields):
+    return fields['NS.string']
+
+def decodeData(fields):
+    return Data(fields['NS.data'])
+
+def decodeDate(fields):
+    return apple_reference_date + datetime.timedelta(seconds=fields['NS.time'])
+
+def decodeNull(fields):
+    return None
+
+def decodeUUID(fields):
+    return uuid.UUID(bytes=bytes(fields['NS.uuidbytes']))
+
+registerDecoder('NSArray', decodeArray)
+registerDecoder('NSMutableArray', decodeArray)
+registerDecoder('NSSet', decodeSet)
+registerDecoder('NSMutableSet', decodeSet)
+registerDecoder('NSDictionary', decodeDictionary)
+registerDecoder('NSMutableDictionary', decodeDictionary)
+registerDecoder('NSString', decodeString)
+registerDecoder('NSMutableString', decodeString)
+registerDecoder('NSData', decodeData)
+registerDecoder('NSMutableData', decodeData)
+registerDecoder('NSDate', decodeDate)
+registerDecoder('NSNull', decodeNull)
+registerDecoder('NSUUID', decodeUUID)
+
+class KeyedArchiver(object):
+    def __init__(self, writer, encoders):
+        self.writer = writer
+        self.encoders = encoders
+        # The wrapped objects for $objects, starting with nil.
+        self.objects = [StringWrapper('$null')]
+        # Uids of archived objects: strings, numbers and data keyed by type
+        # and value, and other objects by id().
+        self.uids = {}
+        self.classUids = {}
+        # Keeps objects keyed by id() alive until archiving is finished.
+        self.archived = []
+
+    def classUid(self, className, classes):
+        key = (className, tuple(classes))
+        uid = self.classUids.get(key)
+        if uid is None:
+            uid = Uid(len(self.objects))
+            self.objects.append(HashableWrapper({
+                StringWrapper('$classname'):StringWrapper(className),
+                StringWrapper('$classes'):HashableWrapper([StringWrapper(name) for name in classes])
+            }))
+            self.classUids[key] = uid
+        return uid
+
+    def encode(self, value):
+        """Archives value, if it hasn't been already, returning its Uid."""
+        if value is None:
+            return Uid(0)
+        if isinstance(value, (bool, int, long, float, unicode, bytes)):
+            key = (type(value), value)
+        else:
+            key = id(value)
+        uid = self.uids.get(key)
+        if uid is not None:
+            return uid
+        uid = Uid(len(self.objects))
+        self.uids[key] = uid
+        if isinstance(key, tuple):
+            self.objects.append(self.wrapScalar(value))
+            return uid
+        # Reserved before encoding the object, so that it can refer back to
+        # itself.
+        self.objects.append(None)
+        self.archived.append(value)
+        self.objects[uid.integer] = self.encodeObject(value)
+        return uid
+
+    def wrapScalar(self, value):
+        if isinstance(value, bool):
+            return self.writer.wrappedTrue if value else self.writer.wrappedFalse
+        elif isinstance(value, float):
+            return FloatWrapper(value)
+        elif isinstance(value, (int, long, Data)):
+            return value
+        elif isinstance(value, (str, unicode)):
+            return StringWrapper(value)
+        return Data(value)
+
+    def encodeObject(self, value):
+        if isinstance(value, dict) and not isinstance(value, ArchivedObject):
+            fields = {'NS.keys':[self.encode(key) for key in value.keys()],
+                      'NS.objects':[self.encode(item) for item in value.values()]}
+            return self.wrapFields('NSDictionary', fields)
+        elif isinstance(value, (list, tuple)):
+            return self.wrapFields('NSArray', {'NS.objects':[self.encode(item) for item in value]})
+        elif isinstance(value, (set, frozenset)):
+            return self.wrapFields('NSSet', {'NS.objects':[self.encode(item) for item in value]})
+        elif isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = utcDatetime(value)
+            return self.wrapFields('NSDate', {'NS.time':(value - apple_reference_date).total_seconds()})
+        elif isinstance(value, uuid.UUID):
+            return self.wrapFields('NSUUID', {'NS.uuidbytes':Data(value.bytes)})
+        if not isinstance(value, ArchivedObject):
+            for cls in type(value).__mro__:
+                encoder = self.encoders.get(cls)
+                if encoder is not None:
+                    break
+            else:
+                raise InvalidPlistException("No encoder for %s (%s)" % (type(value).__name__, repr(value)))
+            value = encoder(value)
+        fields = {}
+        for key, field in value.items():
+            if isinstance(field, (bool, int, long, float)):
+                # Stored inline, as NSCoder's encodeInteger:forKey: etc. do.
+                fields[key] = field
+            else:
+                fields[key] = self.encode(field)
+        return self.wrapFields(value.className, fields, value.classes)
+
+    def wrapFields(self, className, fields, classes=None):
+        """Returns the wrapped dictionary for an archived object with the
+           given fields."""
+        if not classes:
+            classes = [className, 'NSObject']
+        wrapped = {StringWrapper('$class'):self.classUid(className, classes)}
+        for key, field in fields.items():
+            if isinstance(field, list):
+                field = HashableWrapper(field)
+            elif not isinstance(field, (Uid, Data)):
+                field = self.wrapScalar(field)
+            wrapped[StringWrapper(key)] = field
+        return HashableWrapper(wrapped)
+
+def archive(rootObject, topKey='root', encoders=None, **options):
+    """Archives rootObject with NSKeyedArchiver's format, under topKey in
+       $top, returning it as binary plist data. encoders is a dict of
+       encoders to use, keyed by type, in addition to the registered ones.
+       Additional keyword options are passed through to PlistWriter.
+       dedup='none' can't be used, as equal values in $objects share one
+       wrapped object.
+
+       Raises InvalidPlistException, ValueError"""
+    if options.get('dedup') == 'none':
+        raise ValueError("dedup='none' can't be used for keyed archives")
+    allEncoders = typeEncoders
+    if encoders:
+        allEncoders = dict(typeEncoders)
+        allEncoders.update(encoders)
+    ioObject = io.BytesIO()
+    writer = PlistWriter(ioObject, **options)
+    archiver = KeyedArchiver(writer, allEncoders)
+    rootUid = archiver.encode(rootObject)
+    writer.writeWrappedRoot(HashableWrapper({
+        StringWrapper('$archiver'):StringWrapper('NSKeyedArchiver'),
+        StringWrapper('$version'):100000,
+        StringWrapper('$top'):HashableWrapper({StringWrapper(topKey):rootUid}),
+        StringWrapper('$objects'):HashableWrapper(archiver.objects),
+    }))
+    return ioObject.getvalue()
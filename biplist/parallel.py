@@ -0,0 +1,183 @@
+"""Writing large binary plists with several processes.
+
+writePlist(rootObject, pathOrFile, workers=N) splits a root array or
+dictionary into N partitions, writes each as a binary plist in its own
+process, and merges the results into one plist. The partitions' object
+tables are copied into the merged table with their object references
+renumbered, and a new root is written referring to the partitions' items.
+
+Unless dedup='none' is given, strings, numbers, dates and data which are
+written by more than one partition are only kept once in the merged plist,
+as PlistWriter would have written them; equal containers in different
+partitions aren't shared.
+
+The partitions, and any keyword options for PlistWriter, are pickled to be
+sent to the worker processes, so encoders and default must be functions
+defined at the top level of a module. canonical can't be used, as each
+process orders only its own partition.
+
+Parallel example:
+
+    from biplist import writePlist
+    writePlist(records, "records.plist", workers=16)
+"""
+
+from array import array
+import multiprocessing
+from struct import pack
+
+from biplist import PlistReader, PlistWriter, unicode, writePlistToString
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET
+
+__all__ = ['writeParallel', 'mergePartitions']
+
+def encodePartition(args):
+    partition, options = args
+    return writePlistToString(partition, **options)
+
+def partitionRoot(rootObject, count):
+    """Splits a list, tuple or dict into up to count partitions of the same
+       type, in order. An empty root has no partitions."""
+    if isinstance(rootObject, dict):
+        items = list(rootObject.items())
+    else:
+        items = list(rootObject)
+    if not items:
+        return []
+    size = (len(items) + count - 1) // count
+    partitions = [items[i:i + size] for i in range(0, len(items), size)]
+    if isinstance(rootObject, dict):
+        return [dict(partition) for partition in partitions]
+    return partitions
+
+def packRefs(writer, refs, objectRefSize):
+    if objectRefSize in (1, 2, 4, 8):
+        return pack('>%d%s' % (len(refs), {1:'B', 2:'H', 4:'L', 8:'Q'}[objectRefSize]), *refs)
+    return b''.join([writer.binaryInt(ref, byteSize=objectRefSize) for ref in refs])
+
+def mergePartitions(parts, isDict=False, dedup='scalars', optimize=False):
+    """Merges binary plists whose roots are all arrays, or all dictionaries
+       if isDict is True, into one binary plist whose root holds all of
+       their items, in order. Returns the merged plist data."""
+    writer = PlistWriter(None)
+    readers = []
+    for data in parts:
+        reader = PlistReader(None)
+        reader.loadContents(data)
+        readers.append(reader)
+
+    # Number the objects, leaving out the partitions' roots. Objects other
+    # than containers with the same encoding share one number, unless
+    # dedup is 'none'.
+    numbering = []
+    # The reader, its numbering, and the start and end of each merged
+    # object, by merged object number, after the root, with the encoded
+    # bytes of leaves.
+    merged = []
+    leaves = {}
+    for reader in readers:
+        offsets = reader.offsets
+        contents = reader.contents
+        # PlistWriter leaves no gaps between objects, so each one ends
+        # where the next one in the file starts.
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        ends = [0] * len(offsets)
+        for objectNumber, nextNumber in zip(order, order[1:]):
+            ends[objectNumber] = offsets[nextNumber]
+        ends[order[-1]] = reader.trailer.offsetTableOffset
+        numbers = [0] * len(offsets)
+        root = reader.trailer.topLevelObjectNumber
+        for objectNumber, start in enumerate(offsets):
+            if objectNumber == root:
+                continue
+            end = ends[objectNumber]
+            if ord(contents[start:start + 1]) >> 4 in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+                numbers[objectNumber] = len(merged) + 1
+                merged.append((reader, numbers, start, end, None))
+                continue
+            data = contents[start:end]
+            if dedup != 'none':
+                number = leaves.get(data)
+                if number is not None:
+                    numbers[objectNumber] = number
+                    continue
+                leaves[data] = len(merged) + 1
+            numbers[objectNumber] = len(merged) + 1
+            merged.append((reader, numbers, start, end, data))
+        numbering.append(numbers)
+
+    objectCount = len(merged) + 1
+    if optimize:
+        objectRefSize = writer.referenceSize(objectCount - 1)
+    else:
+        objectRefSize = writer.intSize(objectCount)
+
+    # The new root refers to all the items of the partitions' roots.
+    keys = []
+    values = []
+    for reader, numbers in zip(readers, numbering):
+        format, count = reader.readObjectHeader(reader.trailer.topLevelObjectNumber)
+        if isDict:
+            keys.extend([numbers[ref] for ref in reader.readRefs(count)])
+        values.extend([numbers[ref] for ref in reader.readRefs(count)])
+    output = bytearray(writer.header)
+    writer.offsets = array('Q', [0]) * objectCount
+    writer.offsets[0] = len(output)
+    format = 0b1101 if isDict else 0b1010
+    if len(values) < 0b1111:
+        output += pack('!B', (format << 4) | len(values))
+    else:
+        output += pack('!B', (format << 4) | 0b1111)
+        output = writer.writeObject(len(values), output)
+    output += packRefs(writer, keys + values, objectRefSize)
+
+    for number, (reader, numbers, start, end, data) in enumerate(merged):
+        writer.offsets[number + 1] = len(output)
+        if data is not None:
+            output += data
+            continue
+        contents = reader.contents
+        refsStart = start + 1
+        if ord(contents[start:start + 1]) & 0x0f == 0x0f:
+            refsStart += 1 + (1 << (ord(contents[refsStart:refsStart + 1]) & 0x0f))
+        output += contents[start:refsStart]
+        reader.currentOffset = refsStart
+        refs = reader.readRefs((end - refsStart) // reader.trailer.objectRefSize)
+        output += packRefs(writer, [numbers[ref] for ref in refs], objectRefSize)
+
+    if optimize:
+        offsetSize = writer.referenceSize(max(writer.offsets))
+    else:
+        offsetSize = writer.intSize(len(output))
+    writer.trailer = writer.trailer._replace(offsetSize=offsetSize, objectRefSize=objectRefSize,
+                                             offsetCount=objectCount, topLevelObjectNumber=0,
+                                             offsetTableOffset=len(output))
+    output = writer.writeOffsetTable(output)
+    output += pack('!xxxxxxBBQQQ', *writer.trailer)
+    return bytes(output)
+
+def writeParallel(rootObject, pathOrFile, workers, **options):
+    """Writes rootObject, a list, tuple or dict, as a binary plist using
+       the given number of worker processes. Additional keyword options
+       are passed through to PlistWriter."""
+    if options.get('canonical'):
+        raise ValueError("canonical output can't be written in parallel")
+    # Checks the options before starting any processes.
+    PlistWriter(None, **options)
+    partitions = partitionRoot(rootObject, workers)
+    if len(partitions) < 2:
+        data = writePlistToString(rootObject, **options)
+    else:
+        pool = multiprocessing.Pool(len(partitions))
+        try:
+            parts = pool.map(encodePartition, [(partition, options) for partition in partitions])
+        finally:
+            pool.close()
+            pool.join()
+        data = mergePartitions(parts, isDict=isinstance(rootObject, dict), dedup=options.get('dedup', 'scalars'),
+                               optimize=options.get('optimize', False))
+    if isinstance(pathOrFile, (bytes, unicode)):
+        with open(pathOrFile, 'wb') as f:
+            f.write(data)
+    else:
+        pathOrFile.write(data)
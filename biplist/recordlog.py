@@ -0,0 +1,302 @@
+"""Appending many small binary plists to one file.
+
+A PlistLogWriter appends records to a log file, each encoded as a binary
+plist by a PlistSession and framed by its length and CRC-32:
+
+    'bplog001'                      once, at the start of the file
+    length, crc32, plist data       for each record, the length and
+                                    checksum as 4 byte big endian integers
+
+Alongside the log, an index file (the log's path + '.index') holds the
+offset of each record's frame as an 8 byte big endian integer, so a
+PlistLogReader can find any record by number without reading the ones
+before it. Appended records are buffered, and written out when the buffer
+fills, when sync() or close() is called, and at least every syncInterval
+seconds while records are being appended, when both files are also synced
+to disk.
+
+If the writer is interrupted, the last record may be only partly written,
+and the index may be missing the last records or refer to records which
+were never completed. Opening the log checks the records after the last
+one the index agrees with: a PlistLogWriter truncates the log after the
+last complete record and brings the index up to date, and a PlistLogReader
+ignores the incomplete record without changing either file.
+
+Readers map both files into memory. Records are decoded one at a time
+with a PlistReader kept for the reader's lifetime, or in batches with
+scan(). Only one writer may append to a log at a time; readers opened
+while it's appending can call refresh() to see the records written since.
+
+Log example:
+
+    from biplist import PlistLogWriter, PlistLogReader
+    with PlistLogWriter("events.bplog") as log:
+        for event in events:
+            log.append(event)
+
+    with PlistLogReader("events.bplog") as log:
+        print len(log), log[-1]
+        for batch in log.scan(start=1000):
+            process(batch)
+"""
+
+import os
+from struct import pack, unpack_from
+import time
+import zlib
+
+from biplist import InvalidPlistException
+from biplist.index import UnsignedTable, openContents
+from biplist.session import PlistSession
+
+__all__ = ['PlistLogWriter', 'PlistLogReader']
+
+LOG_MAGIC = b'bplog001'
+INDEX_SUFFIX = '.index'
+FRAME_HEADER_SIZE = 8
+# The most buffered record data before it's written to the file.
+BUFFER_SIZE = 1 << 16
+
+def indexPathForLog(path):
+    if isinstance(path, bytes) and not isinstance(path, str):
+        return path + INDEX_SUFFIX.encode('ascii')
+    return path + INDEX_SUFFIX
+
+def frameEnd(contents, offset):
+    """Returns the end of the record framed at offset, or None if it's
+       incomplete or doesn't match its checksum."""
+    if offset + FRAME_HEADER_SIZE > len(contents):
+        return None
+    length, checksum = unpack_from('>LL', contents, offset)
+    end = offset + FRAME_HEADER_SIZE + length
+    if end > len(contents) or zlib.crc32(contents[offset + FRAME_HEADER_SIZE:end]) & 0xffffffff != checksum:
+        return None
+    return end
+
+def recoverOffsets(contents, indexContents):
+    """Returns the number of entries in the index which refer to complete
+       records, the offsets of the complete records after them, and the
+       end of the last complete record."""
+    if contents[:len(LOG_MAGIC)] != LOG_MAGIC:
+        raise InvalidPlistException("Not a plist log.")
+    indexed = UnsignedTable(indexContents, 0, len(indexContents) // 8)
+    count = len(indexed)
+    end = None
+    # Only the end of the index can be ahead of the log.
+    while count:
+        end = frameEnd(contents, indexed[count - 1])
+        if end is not None:
+            break
+        count -= 1
+    if end is None:
+        end = len(LOG_MAGIC)
+    offsets = []
+    while True:
+        nextEnd = frameEnd(contents, end)
+        if nextEnd is None:
+            break
+        offsets.append(end)
+        end = nextEnd
+    return count, offsets, end
+
+class PlistLogWriter(object):
+    """Appends records to a plist log, creating it if necessary."""
+    def __init__(self, path, syncInterval=1.0, **options):
+        """Additional keyword options are passed through to PlistWriter.
+           If syncInterval is None, records are only synced to disk by
+           sync() and close().
+
+           Raises InvalidPlistException if the file isn't a plist log."""
+        self.syncInterval = syncInterval
+        self.session = PlistSession(writeOptions=options)
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        self.indexFile = None
+        self.buffer = bytearray()
+        self.indexBuffer = bytearray()
+        try:
+            if not exists:
+                self.file.write(LOG_MAGIC)
+                self.file.flush()
+            self.recover(indexPathForLog(path))
+        except:
+            self.file.close()
+            if self.indexFile is not None:
+                self.indexFile.close()
+            raise
+
+    def recover(self, indexPath):
+        """Truncates the log after its last complete record, and the index
+           to the records in the log, adding any it's missing. The index is
+           only created once the log's been checked."""
+        contents, toClose = openContents(self.file)
+        indexExists = os.path.exists(indexPath)
+        if indexExists:
+            indexContents, indexToClose = openContents(indexPath)
+            toClose.extend(indexToClose)
+        else:
+            indexContents = b''
+        try:
+            count, offsets, end = recoverOffsets(contents, indexContents)
+        finally:
+            for f in toClose:
+                f.close()
+        self.indexFile = open(indexPath, 'r+b' if indexExists else 'w+b')
+        self.file.seek(end)
+        self.file.truncate()
+        self.indexFile.seek(8 * count)
+        self.indexFile.truncate()
+        if offsets:
+            self.indexFile.write(pack('>%dQ' % len(offsets), *offsets))
+        self.sync()
+        self.position = end
+        self.count = count + len(offsets)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, record):
+        """Appends a record, returning its number.
+
+           Raises InvalidPlistException"""
+        data = self.session.encode(record)
+        self.indexBuffer += pack('>Q', self.position + len(self.buffer))
+        self.buffer += pack('>LL', len(data), zlib.crc32(data) & 0xffffffff)
+        self.buffer += data
+        self.count += 1
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+        if self.syncInterval is not None and time.time() - self.lastSync >= self.syncInterval:
+            self.sync()
+        return self.count - 1
+
+    def flush(self):
+        """Writes the buffered records to the log, then their offsets to the
+           index."""
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.position += len(self.buffer)
+            self.buffer = bytearray()
+            self.indexFile.write(self.indexBuffer)
+            self.indexFile.flush()
+            self.indexBuffer = bytearray()
+
+    def sync(self):
+        """Writes the buffered records and syncs the log and its index to
+           disk."""
+        self.flush()
+        os.fsync(self.file.fileno())
+        os.fsync(self.indexFile.fileno())
+        self.lastSync = time.time()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.sync()
+            finally:
+                self.file.close()
+                self.indexFile.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class PlistLogReader(object):
+    """Reads records from a plist log by number, or in order."""
+    def __init__(self, path, **options):
+        """Additional keyword options are passed through to PlistReader.
+
+           Raises InvalidPlistException if the file isn't a plist log."""
+        self.path = path
+        self.session = PlistSession(readOptions=options)
+        self.toClose = []
+        self.refresh()
+
+    def refresh(self):
+        """Maps the log and its index into memory again, to read records
+           appended since it was opened."""
+        contents, toClose = openContents(self.path)
+        indexPath = indexPathForLog(self.path)
+        if os.path.exists(indexPath):
+            indexContents, indexToClose = openContents(indexPath)
+            toClose.extend(indexToClose)
+        else:
+            indexContents = b''
+        try:
+            count, offsets, end = recoverOffsets(contents, indexContents)
+        except:
+            for f in toClose:
+                f.close()
+            raise
+        self.close()
+        self.contents = contents
+        self.toClose = toClose
+        self.indexed = UnsignedTable(indexContents, 0, count)
+        # The offsets of the complete records missing from the index.
+        self.unindexed = offsets
+        self.end = end
+
+    def __len__(self):
+        return len(self.indexed) + len(self.unindexed)
+
+    def offset(self, number):
+        if number < len(self.indexed):
+            return self.indexed[number]
+        return self.unindexed[number - len(self.indexed)]
+
+    def recordData(self, number):
+        """Returns the binary plist data of the given record."""
+        if number < 0:
+            number += len(self)
+        if number < 0 or number >= len(self):
+            raise IndexError(number)
+        offset = self.offset(number)
+        length = unpack_from('>L', self.contents, offset)[0]
+        return self.contents[offset + FRAME_HEADER_SIZE:offset + FRAME_HEADER_SIZE + length]
+
+    def __getitem__(self, number):
+        """Returns the given record.
+
+           Raises InvalidPlistException"""
+        return self.session.decode(self.recordData(number))
+
+    def __iter__(self):
+        for batch in self.scan():
+            for record in batch:
+                yield record
+
+    def scan(self, start=0, stop=None, batchSize=1024):
+        """Yields lists of up to batchSize records, in order, numbered from
+           start up to, but not including, stop (or the end). Records are
+           found by following their frames from start, rather than through
+           the index. Negative start and stop count from the end, as in
+           slices."""
+        start, stop, step = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return
+        contents = self.contents
+        decode = self.session.decode
+        offset = self.offset(start)
+        for batchStart in range(start, stop, batchSize):
+            batch = []
+            for i in range(min(batchSize, stop - batchStart)):
+                length = unpack_from('>L', contents, offset)[0]
+                offset += FRAME_HEADER_SIZE
+                batch.append(decode(contents[offset:offset + length]))
+                offset += length
+            yield batch
+
+    def close(self):
+        for f in self.toClose:
+            f.close()
+        self.toClose = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
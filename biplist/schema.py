@@ -0,0 +1,196 @@
+"""Writing records with a fixed shape.
+
+compileSchema() takes a dictionary describing records which always have
+the same keys, with values of the same types, and returns a RecordEncoder
+which writes records of that shape as binary plists. Everything which
+doesn't depend on the values is worked out once, when the schema is
+compiled: the keys are encoded, each field's encoding function is chosen,
+and the dictionaries, whose object references are always the same, are
+encoded in full. Encoding a record only encodes its values and writes the
+offset table and trailer.
+
+A schema maps each key to a type (bool, int, float, str or unicode, bytes
+or Data, datetime.datetime, or type(None)), to an example value of that
+type, or to a nested schema dictionary. An example record can be used as
+its own schema.
+
+Unlike PlistWriter, equal values in different fields aren't shared in
+the object table, so the plists can be slightly larger.
+
+Schema example:
+
+    from biplist import compileSchema
+    encoder = compileSchema({'id':int, 'name':str, 'position':{'x':float, 'y':float}})
+    data = encoder.encode({'id':1, 'name':'a', 'position':{'x':0.5, 'y':2.0}})
+"""
+
+import datetime
+from struct import pack
+from struct import error as struct_error
+
+from biplist import Data, PlistWriter, StringWrapper, InvalidPlistException, apple_reference_date, long, unicode
+
+__all__ = ['compileSchema', 'RecordEncoder']
+
+def encodeLength(format, length):
+    if length < 0b1111:
+        return pack('>B', (format << 4) | length)
+    return pack('>B', (format << 4) | 0b1111) + encodeInt(length)
+
+def encodeInt(value):
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise TypeError("Expected an integer, not %s" % repr(value))
+    if 0 <= value <= 0xFF:
+        return pack('>BB', 0x10, value)
+    elif 0 <= value <= 0xFFFF:
+        return pack('>BH', 0x11, value)
+    elif 0 <= value <= 0xFFFFFFFF:
+        return pack('>BL', 0x12, value)
+    elif -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+        return pack('>Bq', 0x13, value)
+    return bytes(PlistWriter(None).writeObject(value, bytearray()))
+
+def encodeBool(value):
+    if not isinstance(value, bool):
+        raise TypeError("Expected a bool, not %s" % repr(value))
+    return b'\x09' if value else b'\x08'
+
+def encodeReal(value):
+    if not isinstance(value, float):
+        raise TypeError("Expected a float, not %s" % repr(value))
+    return pack('>Bd', 0x23, value)
+
+def encodeString(value):
+    try:
+        data = value.encode('ascii')
+        return encodeLength(0b0101, len(data)) + data
+    except UnicodeError:
+        data = value.encode('utf_16_be')
+        return encodeLength(0b0110, len(data) // 2) + data
+
+def encodeData(value):
+    return encodeLength(0b0100, len(value)) + value
+
+def encodeDate(value):
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return pack('>Bd', 0x33, (value - apple_reference_date).total_seconds())
+
+def encodeNull(value):
+    if value is not None:
+        raise TypeError("Expected None, not %s" % repr(value))
+    return b'\x00'
+
+fieldEncoders = [
+    (bool, encodeBool),
+    ((int, long), encodeInt),
+    (float, encodeReal),
+    (datetime.datetime, encodeDate),
+    (Data, encodeData),
+    ((str, unicode), encodeString),
+    (bytes, encodeData),
+    (type(None), encodeNull),
+]
+
+def fieldEncoder(spec):
+    """Returns the encoding function for a field described by a type or
+       an example value."""
+    cls = spec if isinstance(spec, type) else type(spec)
+    for types, encoder in fieldEncoders:
+        if issubclass(cls, types):
+            return encoder
+    raise ValueError("Unsupported field type: %s" % cls.__name__)
+
+class RecordEncoder(object):
+    """Writes records matching a compiled schema as binary plists."""
+    def __init__(self, spec):
+        # Each dictionary in the schema, in object number order, as a list
+        # of keys and the indexes of the dictionaries they contain.
+        self.shapes = []
+        # The index of the dictionary, key and encoding function for each
+        # value, in object number order.
+        self.fields = []
+        self.addShapes(spec)
+        self.keyCount = sum([len(keys) for keys, children in self.shapes])
+        self.objectCount = len(self.shapes) + self.keyCount + len(self.fields)
+        self.writer = writer = PlistWriter(None)
+        self.objectRefSize = writer.intSize(self.objectCount)
+
+        # The dictionaries and keys never change, so they're written first.
+        # Dictionaries are numbered first, then keys, then values.
+        prefix = bytearray(writer.header)
+        self.offsets = []
+        keyNumber = len(self.shapes)
+        valueNumber = keyNumber + self.keyCount
+        for keys, children in self.shapes:
+            self.offsets.append(len(prefix))
+            refs = list(range(keyNumber, keyNumber + len(keys)))
+            keyNumber += len(keys)
+            for key in keys:
+                if key in children:
+                    refs.append(children[key])
+                else:
+                    refs.append(valueNumber)
+                    valueNumber += 1
+            prefix += encodeLength(0b1101, len(keys))
+            prefix += b''.join([writer.binaryInt(ref, byteSize=self.objectRefSize) for ref in refs])
+        for keys, children in self.shapes:
+            for key in keys:
+                self.offsets.append(len(prefix))
+                wrapped = StringWrapper(key)
+                prefix += encodeLength(wrapped.encodingMarker, len(wrapped)) + wrapped.encodedValue
+        self.prefix = bytes(prefix)
+
+    def addShapes(self, spec):
+        """Adds the dictionaries in the schema, breadth first."""
+        if not isinstance(spec, dict):
+            raise ValueError("A schema must be a dictionary")
+        specs = [spec]
+        for spec in specs:
+            keys = list(spec.keys())
+            children = {}
+            for key in keys:
+                if not isinstance(key, (str, unicode)):
+                    raise ValueError("Schema keys must be strings: %s" % repr(key))
+                if isinstance(spec[key], dict):
+                    children[key] = len(specs)
+                    specs.append(spec[key])
+                else:
+                    self.fields.append((len(self.shapes), key, fieldEncoder(spec[key])))
+            self.shapes.append((keys, children))
+
+    def encode(self, record):
+        """Returns record, which must match the schema, as binary plist
+           data.
+
+           Raises InvalidPlistException"""
+        output = bytearray(self.prefix)
+        offsets = list(self.offsets)
+        try:
+            # The record's dictionaries, in the same order as shapes.
+            dicts = [record]
+            for index, (keys, children) in enumerate(self.shapes):
+                d = dicts[index]
+                if not isinstance(d, dict) or len(d) != len(keys):
+                    raise InvalidPlistException("Record doesn't match the schema: %s" % repr(d))
+                if children:
+                    # In the order the nested dictionaries were numbered.
+                    dicts.extend([d[key] for key in keys if key in children])
+            for index, key, encoder in self.fields:
+                offsets.append(len(output))
+                output += encoder(dicts[index][key])
+        except KeyError as e:
+            raise InvalidPlistException("Record doesn't match the schema: missing %s" % repr(e.args[0]))
+        except (TypeError, ValueError, AttributeError, struct_error) as e:
+            raise InvalidPlistException("Record doesn't match the schema: %s" % e)
+        offsetSize = self.writer.intSize(len(output))
+        offsetTableOffset = len(output)
+        output += pack('>%d%s' % (len(offsets), {1:'B', 2:'H', 4:'L', 8:'Q'}[offsetSize]), *offsets)
+        output += pack('!xxxxxxBBQQQ', offsetSize, self.objectRefSize, self.objectCount, 0, offsetTableOffset)
+        return bytes(output)
+
+def compileSchema(spec):
+    """Returns a RecordEncoder for records shaped like spec.
+
+       Raises ValueError"""
+    return RecordEncoder(spec)
@@ -0,0 +1,337 @@
+"""Writing and reading many small binary plists.
+
+A PlistSession keeps one PlistWriter and one PlistReader for encoding and
+decoding any number of binary plists, such as the messages of an RPC
+protocol, rather than building a new writer, reader and file object for
+each one.
+
+Plists made only of dicts, lists, tuples, strings, numbers, bools, None,
+data and naive datetimes are encoded and decoded directly by the session,
+in a single pass over the objects, rather than through the writer's wrap,
+count and write passes or the reader's per-object dispatch. Short strings,
+numbers and other values are encoded and decoded once per session, the
+first time they're seen, and looked up after that, so dictionary keys and
+other values which recur from message to message cost a dictionary lookup
+each. The plists written are the same as PlistWriter's. Anything else, or
+any options which change how objects are laid out or read, goes through
+the writer and reader.
+
+Sessions aren't thread safe; use one per thread.
+
+Session example:
+
+    from biplist import PlistSession
+    session = PlistSession()
+    data = session.encode({'method':'ping', 'id':1})
+    message = session.decode(data)
+"""
+
+import datetime
+import math
+from struct import pack, unpack_from
+from struct import error as struct_error
+
+from biplist import (Data, PlistReader, PlistWriter, NotBinaryPlistException, Uid,
+                     apple_reference_date, long, unicode)
+
+__all__ = ['PlistSession']
+
+# The most values whose encoding or decoding a session keeps.
+CACHE_SIZE = 4096
+# The longest strings and data kept.
+CACHED_LENGTH = 64
+STRUCT_FORMATS = {1:'B', 2:'H', 4:'L', 8:'Q'}
+
+class OutputBuffer(object):
+    """Keeps what's written to it, rather than copying it."""
+    data = None
+
+    def write(self, data):
+        self.data = data
+
+class Unsupported(Exception):
+    """Raised when a plist can't be encoded or decoded directly."""
+
+class PlistSession(object):
+    def __init__(self, readOptions=None, writeOptions=None):
+        """readOptions and writeOptions are dicts of keyword options to pass
+           through to PlistReader and PlistWriter."""
+        self.output = OutputBuffer()
+        self.writer = writer = PlistWriter(self.output, **(writeOptions or {}))
+        writer.stringCache = {}
+        self.reader = PlistReader(None, **(readOptions or {}))
+        # Only the default layout and reading are done directly.
+        self.encodeDirectly = writer.dedup == 'scalars' and not (
+            writer.optimize or writer.canonical or writer.compactReals or writer.realTolerance is not None or
+            writer.hasEncoders)
+        self.decodeDirectly = not readOptions
+        # Encoded scalars, keyed by their type and value, and decoded ones,
+        # keyed by their encoding.
+        self.encoded = {}
+        self.decoded = {}
+        # Container markers and counts, by format and count.
+        self.headers = {}
+
+    def encode(self, rootObject):
+        """Returns rootObject as binary plist data.
+
+           Raises InvalidPlistException"""
+        if self.encodeDirectly:
+            try:
+                return self.encodeDirect(rootObject)
+            except (Unsupported, RuntimeError):
+                # Including plists nested too deeply to encode recursively.
+                pass
+        writer = self.writer
+        writer.reset()
+        writer.writeRoot(rootObject)
+        data = self.output.data
+        self.output.data = None
+        return bytes(data)
+
+    def decode(self, data):
+        """Returns the root object of the given binary plist data.
+
+           Raises NotBinaryPlistException, InvalidPlistException"""
+        if data[:7] != b'bplist0':
+            raise NotBinaryPlistException()
+        if self.decodeDirectly:
+            try:
+                return self.decodeDirect(data)
+            except Unsupported:
+                pass
+            except (IndexError, KeyError, TypeError, ValueError, RuntimeError, struct_error):
+                # Invalid or nested too deeply: the reader reports what's
+                # wrong with it.
+                pass
+        reader = self.reader
+        reader.reset()
+        try:
+            return reader.readContents(data)
+        finally:
+            reader.contents = ''
+
+    def scalarKey(self, value):
+        """Returns the key objects equal to value share an object number
+           and encoding by, as the writer's object table does, or raises
+           Unsupported."""
+        valueType = type(value)
+        if valueType is str or valueType is unicode:
+            return value
+        elif valueType is int or valueType is long:
+            return (int, value)
+        elif valueType is float:
+            if not value:
+                # 0.0 and -0.0 are equal, but are written differently.
+                return (float, value, math.copysign(1.0, value))
+            return (float, value)
+        elif valueType is bool or value is None:
+            return (valueType, value)
+        elif valueType is bytes or valueType is Data:
+            return (Data, value)
+        elif valueType is datetime.datetime and value.tzinfo is None:
+            return (datetime.datetime, value)
+        raise Unsupported()
+
+    def header(self, format, count):
+        """Returns the marker and count of a container."""
+        header = self.headers.get((format, count))
+        if header is None:
+            if count < 0b1111:
+                header = pack('!B', (format << 4) | count)
+            else:
+                header = pack('!B', (format << 4) | 0b1111) + bytes(self.writer.writeObject(count, bytearray()))
+            if len(self.headers) < CACHE_SIZE:
+                self.headers[(format, count)] = header
+        return header
+
+    def encodeDirect(self, root):
+        """Encodes a root made only of dicts, lists, tuples and the scalars
+           scalarKey accepts, in the order PlistWriter writes them. Raises
+           Unsupported for anything else."""
+        rootType = type(root)
+        if rootType is not dict and rootType is not list and rootType is not tuple:
+            raise Unsupported()
+        writer = self.writer
+        encoded = self.encoded
+        header = self.header
+        scalarKey = self.scalarKey
+        # The encoding of each object by object number: bytes for scalars,
+        # and (header, object references) for containers.
+        objects = [None]
+        # Object numbers in the order the objects are written.
+        order = []
+        numbers = {}
+
+        # Containers are written depth first, each followed by the new
+        # objects it refers to, as in PlistWriter.writeObject.
+        def visit(container, objectNumber):
+            order.append(objectNumber)
+            containerType = type(container)
+            if containerType is dict:
+                for key in container:
+                    keyType = type(key)
+                    if keyType is not str and keyType is not unicode:
+                        raise Unsupported()
+                children = list(container)
+                children.extend(container.values())
+                format = 0b1101
+                count = len(container)
+            else:
+                children = container
+                format = 0b1010
+                count = len(children)
+            refs = []
+            new = []
+            for child in children:
+                childType = type(child)
+                if childType is dict or childType is list or childType is tuple:
+                    childNumber = len(objects)
+                    objects.append(None)
+                    new.append((child, childNumber))
+                else:
+                    key = scalarKey(child)
+                    childNumber = numbers.get(key)
+                    if childNumber is None:
+                        childNumber = numbers[key] = len(objects)
+                        data = encoded.get(key)
+                        if data is None:
+                            data = bytes(writer.writeObject(writer.wrapRoot(child), bytearray()))
+                            if len(encoded) < CACHE_SIZE and len(data) <= CACHED_LENGTH + 3:
+                                encoded[key] = data
+                        objects.append(data)
+                        new.append((None, childNumber))
+                refs.append(childNumber)
+            objects[objectNumber] = (header(format, count), refs)
+            for child, childNumber in new:
+                if child is None:
+                    order.append(childNumber)
+                else:
+                    visit(child, childNumber)
+
+        visit(root, 0)
+        objectCount = len(objects)
+        refSize = writer.intSize(objectCount)
+        refFormat = STRUCT_FORMATS[refSize]
+        output = bytearray(writer.header)
+        offsets = [0] * objectCount
+        for objectNumber in order:
+            offsets[objectNumber] = len(output)
+            data = objects[objectNumber]
+            if type(data) is tuple:
+                output += data[0]
+                refs = data[1]
+                output += pack('>%d%s' % (len(refs), refFormat), *refs)
+            else:
+                output += data
+        offsetTableOffset = len(output)
+        offsetSize = writer.intSize(offsetTableOffset)
+        output += pack('>%d%s' % (objectCount, STRUCT_FORMATS[offsetSize]), *offsets)
+        output += pack('!xxxxxxBBQQQ', offsetSize, refSize, objectCount, 0, offsetTableOffset)
+        return bytes(output)
+
+    def decodeDirect(self, data):
+        """Decodes a plist as PlistReader does with its default options.
+           Raises Unsupported for anything other than the usual object
+           types and widths, and other exceptions for invalid plists."""
+        if len(data) < 32:
+            raise Unsupported()
+        offsetSize, refSize, objectCount, topObject, offsetTableOffset = unpack_from(
+            '!xxxxxxBBQQQ', data, len(data) - 32)
+        offsetFormat = STRUCT_FORMATS.get(offsetSize)
+        refFormat = STRUCT_FORMATS.get(refSize)
+        if (offsetFormat is None or refFormat is None or topObject >= objectCount or
+                offsetTableOffset + offsetSize * objectCount > len(data) - 32):
+            raise Unsupported()
+        offsets = unpack_from('>%d%s' % (objectCount, offsetFormat), data, offsetTableOffset)
+        markers = bytearray(data)
+        decoded = self.decoded
+        # Scalars decoded from this plist, by object number.
+        scalars = {}
+
+        def read(objectNumber):
+            value = scalars.get(objectNumber)
+            if value is not None:
+                return value
+            start = offsets[objectNumber]
+            marker = markers[start]
+            format = marker >> 4
+            extra = marker & 0b1111
+            if format == 0b1010 or format == 0b1101 or format == 0b1100:
+                contentStart = start + 1
+                if extra == 0b1111:
+                    intMarker = markers[contentStart]
+                    if intMarker >> 4 != 0b0001 or intMarker & 0b1111 > 3:
+                        raise Unsupported()
+                    size = 1 << (intMarker & 0b1111)
+                    extra = unpack_from('>' + STRUCT_FORMATS[size], data, contentStart + 1)[0]
+                    contentStart += 1 + size
+                if format == 0b1101:
+                    refs = unpack_from('>%d%s' % (2 * extra, refFormat), data, contentStart)
+                    return dict(zip([read(ref) for ref in refs[:extra]], [read(ref) for ref in refs[extra:]]))
+                refs = unpack_from('>%d%s' % (extra, refFormat), data, contentStart)
+                if format == 0b1100:
+                    return set([read(ref) for ref in refs])
+                return [read(ref) for ref in refs]
+            if format == 0b0000:
+                if extra == 0b1001:
+                    return True
+                elif extra == 0b1000:
+                    return False
+                elif extra == 0b0000:
+                    return None
+                raise Unsupported()
+            if format == 0b1000:
+                # Uids are mutable, so aren't kept.
+                if extra not in (0, 1, 3):
+                    raise Unsupported()
+                return Uid(unpack_from('>' + STRUCT_FORMATS[extra + 1], data, start + 1)[0])
+            # Other scalars are immutable, so are kept for the session.
+            headerLength = 1
+            if format == 0b0001 or format == 0b0010:
+                length = 1 + (1 << extra)
+            elif format == 0b0011:
+                length = 9
+            elif format == 0b0100 or format == 0b0101 or format == 0b0110:
+                if extra == 0b1111:
+                    intMarker = markers[start + 1]
+                    if intMarker >> 4 != 0b0001 or intMarker & 0b1111 > 3:
+                        raise Unsupported()
+                    size = 1 << (intMarker & 0b1111)
+                    extra = unpack_from('>' + STRUCT_FORMATS[size], data, start + 2)[0]
+                    headerLength = 2 + size
+                length = headerLength + (2 * extra if format == 0b0110 else extra)
+            else:
+                raise Unsupported()
+            encoding = data[start:start + length]
+            value = decoded.get(encoding)
+            if value is None:
+                if len(encoding) != length:
+                    raise Unsupported()
+                if format == 0b0001:
+                    if extra > 3:
+                        raise Unsupported()
+                    value = unpack_from('>' + 'BHLq'[extra], encoding, 1)[0]
+                elif format == 0b0010:
+                    if extra == 2:
+                        value = unpack_from('>f', encoding, 1)[0]
+                    elif extra == 3:
+                        value = unpack_from('>d', encoding, 1)[0]
+                    else:
+                        raise Unsupported()
+                elif format == 0b0011:
+                    if extra != 0b0011:
+                        raise Unsupported()
+                    value = datetime.timedelta(seconds=unpack_from('>d', encoding, 1)[0]) + apple_reference_date
+                elif format == 0b0100:
+                    value = Data(encoding[headerLength:])
+                elif format == 0b0101:
+                    value = str(encoding[headerLength:].decode('ascii'))
+                else:
+                    value = encoding[headerLength:].decode('utf_16_be')
+                if len(decoded) < CACHE_SIZE and length <= CACHED_LENGTH + 1:
+                    decoded[encoding] = value
+            scalars[objectNumber] = value
+            return value
+
+        return read(topObject)
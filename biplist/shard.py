@@ -0,0 +1,207 @@
+"""Writing large collections as binary plists of bounded size.
+
+writeSharded(records, directory, maxBytes) packs records, from any
+iterable, into successive binary plists in directory (shard-00000.plist,
+shard-00001.plist, ...), each holding an array of records in order. A new
+shard is started whenever the next record would take the current one over
+maxBytes bytes. A manifest, manifest.plist, lists the name, first record
+number, record count, size and CRC-32 of each shard, so readers can load
+only the shards holding the records they need, as readSharded() does.
+
+Shards are sized as records are added without encoding them, as
+estimateSize() does. For dicts, lists and tuples of strings, numbers,
+dates, data, Uids and None, with dedup 'scalars' or 'none', the sizes are
+exact. Otherwise, such as for records containing sets or objects converted
+by encoders, each record is counted as though it shared nothing with the
+rest of its shard, which can only overestimate, so shards may be smaller
+than they could be. Each shard's size is checked again once it's encoded,
+and ValueError raised, rather than the shard written, if it's over
+maxBytes.
+
+With workers, shards are encoded and written by that many processes while
+the next shards are packed. The records and keyword options for
+PlistWriter are pickled to be sent to the worker processes, so encoders
+and default must be functions defined at the top level of a module.
+
+Sharded example:
+
+    from biplist import writeSharded, readSharded
+    writeSharded(records, "records", maxBytes=32 << 20, workers=4)
+    page = readSharded("records", start=100000, stop=100100)
+"""
+
+from collections import deque
+import io
+import multiprocessing
+import os
+
+from biplist import PlistByteCounts, PlistWriter, InvalidPlistException, readPlist, writePlist, writePlistToString
+from biplist.index import sourceChecksum
+
+__all__ = ['writeSharded', 'readSharded']
+
+MANIFEST_NAME = 'manifest.plist'
+SHARD_NAME = 'shard-%05d.plist'
+ARRAY_BYTES = PlistByteCounts._fields.index('arrayBytes')
+
+class ShardCounter(object):
+    """Counts the size of a shard's plist as records are added to it."""
+    def __init__(self, options):
+        self.options = options
+        self.writer = writer = PlistWriter(None, **options)
+        # Whether the counts are exact, rather than an upper bound.
+        self.exact = writer.countObjects([])
+        writer.objectCount = 1
+        writer.byteTotals[ARRAY_BYTES] = 1
+        self.count = 0
+        # Counts for records which couldn't be counted exactly.
+        self.boundWriter = None
+        self.extraBytes = 0
+        self.extraObjects = 0
+        self.extraReferences = 0
+
+    def arrayHeaderSize(self, count):
+        if count < 0b1111:
+            return 1
+        return 2 + self.writer.intSize(count)
+
+    def add(self, record):
+        writer = self.writer
+        self.count += 1
+        writer.byteTotals[ARRAY_BYTES] += self.arrayHeaderSize(self.count) - self.arrayHeaderSize(self.count - 1)
+        writer.computedReferences += 1
+        if self.exact:
+            self.exact = writer.countValues([record])
+            if self.exact:
+                return
+        # Counted on its own, the record has at least as many objects and
+        # bytes as it adds to the shard.
+        if self.boundWriter is None:
+            self.boundWriter = PlistWriter(None, **self.options)
+        bound = self.boundWriter
+        bound.reset()
+        bound.computeOffsets(bound.wrapRoot(record), asReference=True, isRoot=True)
+        self.extraBytes += sum(bound.byteTotals)
+        self.extraObjects += bound.objectCount
+        self.extraReferences += bound.computedReferences
+
+    def size(self):
+        """Returns the size of the shard's plist, or an upper bound on it."""
+        writer = self.writer
+        if self.exact:
+            size = writer.countedSize(writer.deferredObject is not None)
+            if size is not None:
+                return size
+        objectCount = writer.objectCount + self.extraObjects
+        references = writer.computedReferences + self.extraReferences
+        length = len(writer.header) + sum(writer.byteTotals) + self.extraBytes
+        length += references * writer.intSize(objectCount)
+        return length + objectCount * writer.intSize(length) + 32
+
+def encodeShard(args):
+    """Writes a shard, returning its size and checksum. Raises ValueError,
+       without writing it, if it's larger than maxBytes."""
+    path, records, options, maxBytes = args
+    data = writePlistToString(records, **options)
+    # The shard was sized by counting, so this only happens if the count
+    # was wrong.
+    if len(data) > maxBytes:
+        raise ValueError("Shard %s takes %d bytes, more than maxBytes" % (os.path.basename(path), len(data)))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data), sourceChecksum(data)
+
+def writeSharded(records, directory, maxBytes, workers=None, **options):
+    """Writes the records from an iterable as binary plists of at most
+       maxBytes bytes each in directory, which is created if necessary,
+       along with a manifest of them. Returns the manifest. Additional
+       keyword options are passed through to PlistWriter.
+
+       Raises ValueError if a record is larger than maxBytes on its own, or
+       a shard is written larger than it was counted."""
+    # Checks the options before starting any processes.
+    PlistWriter(None, **options)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pool = None
+    if workers is not None and workers > 1:
+        pool = multiprocessing.Pool(workers)
+    shards = []
+    # Shards being written by the pool, oldest first.
+    pending = deque()
+
+    def finish(shard, result):
+        shard['size'], shard['crc32'] = result
+
+    def flush(shardRecords, start):
+        shard = {'name':SHARD_NAME % len(shards), 'start':start, 'count':len(shardRecords)}
+        shards.append(shard)
+        args = (os.path.join(directory, shard['name']), shardRecords, options, maxBytes)
+        if pool is None:
+            finish(shard, encodeShard(args))
+            return
+        # Only a few shards are kept in memory waiting to be written.
+        while len(pending) >= 2 * workers:
+            waiting, result = pending.popleft()
+            finish(waiting, result.get())
+        pending.append((shard, pool.apply_async(encodeShard, (args,))))
+
+    try:
+        counter = ShardCounter(options)
+        current = []
+        start = 0
+        for index, record in enumerate(records):
+            counter.add(record)
+            if counter.size() > maxBytes:
+                if current:
+                    flush(current, start)
+                    start += len(current)
+                    current = []
+                    counter = ShardCounter(options)
+                    counter.add(record)
+                if counter.size() > maxBytes:
+                    raise ValueError("Record %d takes %d bytes on its own, more than maxBytes" %
+                                     (index, counter.size()))
+            current.append(record)
+        if current:
+            flush(current, start)
+            start += len(current)
+        while pending:
+            shard, result = pending.popleft()
+            finish(shard, result.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    manifest = {'recordCount':start, 'maxBytes':maxBytes, 'shards':shards}
+    writePlist(manifest, os.path.join(directory, MANIFEST_NAME))
+    return manifest
+
+def readSharded(directory, start=0, stop=None, verify=False):
+    """Returns a list of the records numbered from start up to, but not
+       including, stop (or the end) from plists written by writeSharded,
+       loading only the shards holding them. If verify is True, the shards
+       loaded are checked against the sizes and checksums in the manifest.
+
+       Raises InvalidPlistException"""
+    manifest = readPlist(os.path.join(directory, MANIFEST_NAME))
+    records = []
+    for shard in manifest['shards']:
+        shardStart = shard['start']
+        count = shard['count']
+        if shardStart + count <= start or (stop is not None and shardStart >= stop):
+            continue
+        path = os.path.join(directory, shard['name'])
+        if verify:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) != shard['size'] or sourceChecksum(data) != shard['crc32']:
+                raise InvalidPlistException("Shard %s doesn't match the manifest." % shard['name'])
+            shardRecords = readPlist(io.BytesIO(data))
+        else:
+            shardRecords = readPlist(path)
+        if len(shardRecords) != count:
+            raise InvalidPlistException("Shard %s doesn't match the manifest." % shard['name'])
+        end = count if stop is None else min(stop - shardStart, count)
+        records.extend(shardRecords[max(start - shardStart, 0):end])
+    return records
@@ -0,0 +1,690 @@
+"""Converting plists between binary, XML and JSON without reading them.
+
+transcode() converts a plist from one format to another. It does not
+build the Python objects for the plist. Binary plists are mapped into
+memory, and their object table is walked from the root, writing XML or
+JSON text as it goes. XML and JSON are parsed a chunk at a time, and each
+object is written to a binary plist as soon as it's complete, so memory
+use depends on the number of objects (8 bytes each for the offset table)
+rather than on their contents.
+
+Objects are written in the order they're found, so dictionaries keep the
+order of their items rather than having their keys sorted. When a binary
+plist is written, strings of up to 64 characters are shared, up to 4096
+of them, rather than all equal strings and numbers. XML and JSON can't
+represent everything a binary plist can:
+
+- XML has no null, so a binary plist containing None can't be converted
+  to XML;
+- XML and JSON have no sets, so sets become arrays;
+- JSON has no dates or data, so they become ISO 8601 strings and base64
+  strings, and stay strings when converted back.
+
+Uids are written as {"CF$UID": n} dictionaries in XML and JSON, as
+plistlib does, and dictionaries of that form become Uids again in binary
+plists.
+
+Transcode example:
+
+    from biplist import transcode
+    transcode("large.plist", "large.json", to="json")
+"""
+
+from array import array
+import base64
+import codecs
+import datetime
+import json
+import os
+import re
+import shutil
+from struct import pack, unpack
+import sys
+import tempfile
+import xml.parsers.expat
+
+from biplist import Data, PlistReader, PlistWriter, Uid, InvalidPlistException, long, unicode
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET, openContents
+from biplist.schema import encodeBool, encodeData, encodeDate, encodeInt, encodeLength, encodeReal, encodeString
+
+__all__ = ['transcode']
+
+CHUNK_SIZE = 1 << 20
+XML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+              '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+              '<plist version="1.0">\n')
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# What JSONParser expects next.
+EXPECT_VALUE = 0
+EXPECT_KEY = 1
+EXPECT_VALUE_OR_END = 2
+EXPECT_KEY_OR_END = 3
+EXPECT_NEXT = 4
+
+def xmlEscape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def encodeJSONString(text):
+    return unicode(json.encoder.encode_basestring_ascii(text))
+
+def readOffsets(contents):
+    """Returns the offset table of a binary plist as an array, which takes
+       far less memory than PlistReader's list, or None if the offsets
+       aren't a size array supports."""
+    if len(contents) < 32:
+        raise InvalidPlistException("File is too short.")
+    offsetSize, objectRefSize, count, root, start = unpack('!xxxxxxBBQQQ', contents[-32:])
+    if start + offsetSize * count > len(contents) - 32 or root >= count:
+        raise InvalidPlistException("Invalid trailer.")
+    typecodes = [typecode for typecode in 'BHILQ' if array(typecode).itemsize == offsetSize]
+    if not typecodes:
+        return None
+    offsets = array(typecodes[0])
+    data = contents[start:start + offsetSize * count]
+    if hasattr(offsets, 'frombytes'):
+        offsets.frombytes(data)
+    else:
+        offsets.fromstring(data)
+    if sys.byteorder == 'little':
+        offsets.byteswap()
+    return offsets
+
+class ObjectTableWalker(object):
+    """Writes the objects in a binary plist as UTF-8 text to a file,
+       starting from the root."""
+    def __init__(self, contents, file):
+        self.reader = PlistReader(None)
+        self.reader.loadContents(contents, offsets=readOffsets(contents))
+        self.file = file
+        self.pieces = []
+        # Containers between the root and the current object.
+        self.path = set()
+        # The text of scalars which can be shared, and of dictionary keys,
+        # by object number. They're kept apart, as a string can be both.
+        self.rendered = {}
+        self.renderedKeys = {}
+
+    def walk(self):
+        self.writeObject(self.reader.trailer.topLevelObjectNumber, 0)
+        self.flush()
+
+    def flush(self):
+        self.file.write(u''.join(self.pieces).encode('utf-8'))
+        self.pieces = []
+
+    def writeObject(self, objectNumber, depth):
+        text = self.rendered.get(objectNumber)
+        if text is not None:
+            self.writeText(text, depth)
+            return
+        reader = self.reader
+        format, count = reader.readObjectHeader(objectNumber)
+        if format in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+            if objectNumber in self.path:
+                raise InvalidPlistException("Object %d contains itself." % objectNumber)
+            self.path.add(objectNumber)
+            if format == FORMAT_DICT:
+                keys = reader.readRefs(count)
+                values = reader.readRefs(count)
+                self.writeDict(keys, values, depth)
+            else:
+                self.writeArray(reader.readRefs(count), depth)
+            self.path.remove(objectNumber)
+            if len(self.pieces) > 65536:
+                self.flush()
+            return
+        reader.setCurrentOffsetToObjectNumber(objectNumber)
+        value = reader.readObject()
+        text = self.scalarText(value, depth)
+        if text is None:
+            return
+        if len(self.rendered) < 65536 and not (isinstance(value, (bytes, unicode)) and len(value) > 64):
+            self.rendered[objectNumber] = text
+        self.writeText(text, depth)
+
+    def readKey(self, objectNumber):
+        key = self.renderedKeys.get(objectNumber)
+        if key is None:
+            self.reader.setCurrentOffsetToObjectNumber(objectNumber)
+            key = self.reader.readObject()
+            if not isinstance(key, (bytes, unicode)):
+                raise InvalidPlistException("Dictionary keys must be strings.")
+            key = self.keyText(key)
+            if len(self.renderedKeys) < 65536 and len(key) <= 64:
+                self.renderedKeys[objectNumber] = key
+        return key
+
+class XMLWalker(ObjectTableWalker):
+    def walk(self):
+        self.pieces.append(XML_HEADER)
+        ObjectTableWalker.walk(self)
+        self.file.write(b'</plist>\n')
+
+    def writeText(self, text, depth):
+        self.pieces.append(u'\t' * depth + text)
+
+    def keyText(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('ascii')
+        return u'<key>%s</key>\n' % xmlEscape(key)
+
+    def writeDict(self, keys, values, depth):
+        indent = u'\t' * depth
+        if not keys:
+            self.pieces.append(indent + u'<dict/>\n')
+            return
+        self.pieces.append(indent + u'<dict>\n')
+        for key, value in zip(keys, values):
+            self.pieces.append(indent + u'\t' + self.readKey(key))
+            self.writeObject(value, depth + 1)
+        self.pieces.append(indent + u'</dict>\n')
+
+    def writeArray(self, refs, depth):
+        indent = u'\t' * depth
+        if not refs:
+            self.pieces.append(indent + u'<array/>\n')
+            return
+        self.pieces.append(indent + u'<array>\n')
+        for ref in refs:
+            self.writeObject(ref, depth + 1)
+        self.pieces.append(indent + u'</array>\n')
+
+    def scalarText(self, value, depth):
+        """Returns the XML for a scalar, or writes it and returns None if
+           it spans several lines."""
+        if value is True:
+            return u'<true/>\n'
+        elif value is False:
+            return u'<false/>\n'
+        elif isinstance(value, Uid):
+            indent = u'\t' * depth
+            self.pieces.append(u'%s<dict>\n%s\t<key>CF$UID</key>\n%s\t<integer>%d</integer>\n%s</dict>\n' %
+                               (indent, indent, indent, value.integer, indent))
+        elif isinstance(value, Data):
+            indent = u'\t' * depth
+            encoded = base64.b64encode(value).decode('ascii')
+            lines = [indent + encoded[i:i + 68] + u'\n' for i in range(0, len(encoded), 68)]
+            self.pieces.append(u'%s<data>\n%s%s</data>\n' % (indent, u''.join(lines), indent))
+        elif isinstance(value, float):
+            return u'<real>%s</real>\n' % repr(value)
+        elif isinstance(value, (int, long)):
+            return u'<integer>%d</integer>\n' % value
+        elif isinstance(value, datetime.datetime):
+            return u'<date>%s</date>\n' % value.strftime(DATE_FORMAT)
+        elif isinstance(value, (bytes, unicode)):
+            if isinstance(value, bytes):
+                value = value.decode('ascii')
+            return u'<string>%s</string>\n' % xmlEscape(value)
+        elif value is None:
+            raise InvalidPlistException("XML plists can't contain null.")
+        else:
+            raise InvalidPlistException("Unexpected object: %s" % repr(value))
+
+class JSONWalker(ObjectTableWalker):
+    def walk(self):
+        ObjectTableWalker.walk(self)
+        self.file.write(b'\n')
+
+    def writeText(self, text, depth):
+        self.pieces.append(text)
+
+    def keyText(self, key):
+        return encodeJSONString(key) + u': '
+
+    def writeDict(self, keys, values, depth):
+        self.pieces.append(u'{')
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if i:
+                self.pieces.append(u', ')
+            self.pieces.append(self.readKey(key))
+            self.writeObject(value, depth + 1)
+        self.pieces.append(u'}')
+
+    def writeArray(self, refs, depth):
+        self.pieces.append(u'[')
+        for i, ref in enumerate(refs):
+            if i:
+                self.pieces.append(u', ')
+            self.writeObject(ref, depth + 1)
+        self.pieces.append(u']')
+
+    def scalarText(self, value, depth):
+        if value is True:
+            return u'true'
+        elif value is False:
+            return u'false'
+        elif value is None:
+            return u'null'
+        elif isinstance(value, float):
+            if value != value:
+                return u'NaN'
+            elif value in (float('inf'), float('-inf')):
+                return u'Infinity' if value > 0 else u'-Infinity'
+            return repr(value)
+        elif isinstance(value, (int, long)):
+            return u'%d' % value
+        elif isinstance(value, (bytes, unicode)) and not isinstance(value, Data):
+            return encodeJSONString(value)
+        elif isinstance(value, Uid):
+            return u'{"CF$UID": %d}' % value.integer
+        elif isinstance(value, Data):
+            self.pieces.append(u'"%s"' % base64.b64encode(value).decode('ascii'))
+        elif isinstance(value, datetime.datetime):
+            return u'"%s"' % value.strftime(DATE_FORMAT)
+        else:
+            raise InvalidPlistException("Unexpected object: %s" % repr(value))
+
+class StreamingWriter(object):
+    """Writes a binary plist one object at a time, with containers written
+       after the objects they refer to."""
+    def __init__(self, file, objectRefSize):
+        self.file = file
+        self.objectRefSize = objectRefSize
+        self.refFormat = {1:'B', 2:'H', 4:'L', 8:'Q'}[objectRefSize]
+        self.writer = PlistWriter(None)
+        self.buffer = bytearray(self.writer.header)
+        self.position = 0
+        self.offsets = array('Q')
+        # Object numbers of short strings already written.
+        self.strings = {}
+        # Containers which haven't been closed yet, innermost last.
+        self.stack = []
+        self.root = None
+
+    def add(self, data):
+        """Writes an encoded object, returning its object number."""
+        number = len(self.offsets)
+        if number >> (8 * self.objectRefSize):
+            raise InvalidPlistException("Too many objects for %d byte references." % self.objectRefSize)
+        self.offsets.append(self.position + len(self.buffer))
+        self.buffer += data
+        if len(self.buffer) > CHUNK_SIZE:
+            self.flush()
+        return number
+
+    def addString(self, value):
+        number = self.strings.get(value)
+        if number is None:
+            try:
+                data = encodeString(value)
+            except UnicodeError as e:
+                # Such as unpaired surrogates from JSON escapes.
+                raise InvalidPlistException("Invalid string %s: %s" % (repr(value), e))
+            number = self.add(data)
+            if len(value) <= 64 and len(self.strings) < 4096:
+                self.strings[value] = number
+        return number
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.position += len(self.buffer)
+        self.buffer = bytearray()
+
+    def addValue(self, number):
+        if self.stack:
+            self.stack[-1].values.append(number)
+        elif self.root is None:
+            self.root = number
+        else:
+            raise InvalidPlistException("More than one root object.")
+
+    def scalar(self, data, integer=None):
+        """Adds an encoded object to the innermost open container. integer
+           is the value of integers, which might turn out to be a Uid."""
+        if self.stack:
+            top = self.stack[-1]
+            if top.uidKey and integer is not None and top.uid is None and not top.keys:
+                top.uid = integer
+                return
+            top.flushUid(self)
+        self.addValue(self.add(data))
+
+    def string(self, value):
+        if self.stack:
+            self.stack[-1].flushUid(self)
+        self.addValue(self.addString(value))
+
+    def key(self, value):
+        if not self.stack or self.stack[-1].format != FORMAT_DICT:
+            raise InvalidPlistException("Key outside a dictionary: %s" % repr(value))
+        top = self.stack[-1]
+        if value == 'CF$UID' and not top.keys and not top.values and not top.uidKey:
+            top.uidKey = True
+            return
+        top.flushUid(self)
+        top.keys.append(self.addString(value))
+
+    def start(self, format):
+        if self.stack:
+            self.stack[-1].flushUid(self)
+        self.stack.append(OpenContainer(format))
+
+    def end(self):
+        top = self.stack.pop()
+        if top.uidKey and top.uid is not None and top.uid >= 0:
+            self.addValue(self.add(bytes(self.writer.writeObject(Uid(top.uid), bytearray()))))
+            return
+        top.flushUid(self)
+        if len(top.keys) != len(top.values) and top.format == FORMAT_DICT:
+            raise InvalidPlistException("Dictionary keys and values don't match.")
+        refs = top.keys + top.values
+        data = encodeLength(top.format, len(top.values)) + pack('>%d%s' % (len(refs), self.refFormat), *refs)
+        self.addValue(self.add(data))
+
+    def finish(self):
+        if self.stack or self.root is None:
+            raise InvalidPlistException("The plist ended before its root object.")
+        offsetTableOffset = self.position + len(self.buffer)
+        offsetSize = self.writer.intSize(offsetTableOffset)
+        format = {1:'B', 2:'H', 4:'L', 8:'Q'}[offsetSize]
+        for start in range(0, len(self.offsets), 65536):
+            chunk = self.offsets[start:start + 65536]
+            self.buffer += pack('>%d%s' % (len(chunk), format), *chunk)
+            if len(self.buffer) > CHUNK_SIZE:
+                self.flush()
+        self.buffer += pack('!xxxxxxBBQQQ', offsetSize, self.objectRefSize, len(self.offsets), self.root,
+                            offsetTableOffset)
+        self.flush()
+
+class OpenContainer(object):
+    """An array or dictionary being parsed. The key and value of a
+       dictionary whose first key is CF$UID are held back until it's known
+       whether it's a Uid."""
+    __slots__ = ('format', 'keys', 'values', 'uidKey', 'uid')
+
+    def __init__(self, format):
+        self.format = format
+        self.keys = []
+        self.values = []
+        self.uidKey = False
+        self.uid = None
+
+    def flushUid(self, writer):
+        if self.uidKey:
+            self.keys.append(writer.addString('CF$UID'))
+            if self.uid is not None:
+                self.values.append(writer.add(encodeInt(self.uid)))
+            self.uidKey = False
+            self.uid = None
+
+def parseDate(text):
+    try:
+        return datetime.datetime.strptime(text.strip(), DATE_FORMAT)
+    except ValueError:
+        raise InvalidPlistException("Invalid date: %s" % repr(text))
+
+class XMLParser(object):
+    """Feeds the objects in an XML plist to a StreamingWriter."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.parser.CharacterDataHandler = self.characterData
+        self.text = []
+
+    def parse(self, file):
+        try:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                self.parser.Parse(chunk, not chunk)
+                if not chunk:
+                    break
+        except xml.parsers.expat.ExpatError as e:
+            raise InvalidPlistException(e)
+
+    def startElement(self, name, attributes):
+        self.text = []
+        if name == 'dict':
+            self.writer.start(FORMAT_DICT)
+        elif name == 'array':
+            self.writer.start(FORMAT_ARRAY)
+
+    def characterData(self, data):
+        self.text.append(data)
+
+    def endElement(self, name):
+        writer = self.writer
+        text = u''.join(self.text)
+        self.text = []
+        try:
+            if name in ('dict', 'array'):
+                writer.end()
+            elif name == 'key':
+                writer.key(text)
+            elif name == 'string':
+                writer.string(text)
+            elif name == 'integer':
+                value = int(text, 16) if text.strip().lower().startswith('0x') else int(text)
+                writer.scalar(encodeInt(value), value)
+            elif name == 'real':
+                writer.scalar(encodeReal(float(text)))
+            elif name in ('true', 'false'):
+                writer.scalar(encodeBool(name == 'true'))
+            elif name == 'date':
+                writer.scalar(encodeDate(parseDate(text)))
+            elif name == 'data':
+                writer.scalar(encodeData(base64.b64decode(re.sub(r'\s+', '', text).encode('ascii'))))
+            elif name != 'plist':
+                raise InvalidPlistException("Unknown element: %s" % name)
+        except (ValueError, TypeError, IndexError) as e:
+            raise InvalidPlistException("Invalid %s: %s" % (name, e))
+
+class JSONParser(object):
+    """Feeds the values in a JSON document to a StreamingWriter, reading it
+       a chunk at a time."""
+    number = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+    whitespace = re.compile(r'[ \t\n\r]*')
+    literals = [(u'true', encodeBool(True)), (u'false', encodeBool(False)), (u'null', b'\x00'),
+                (u'NaN', encodeReal(float('nan'))), (u'Infinity', encodeReal(float('inf'))),
+                (u'-Infinity', encodeReal(float('-inf')))]
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.position = 0
+        # The number of characters of the document before self.text.
+        self.base = 0
+        self.finished = False
+
+    def refill(self, file, size=None):
+        """Reads another chunk, returning False at the end of the file."""
+        if self.finished:
+            return False
+        chunk = file.read(size or CHUNK_SIZE)
+        self.finished = not chunk
+        self.base += self.position
+        self.text = self.text[self.position:] + self.decoder.decode(chunk, self.finished)
+        self.position = 0
+        return True
+
+    def offset(self, position=None):
+        """Returns the offset in the document, in characters, of a position
+           in the text read so far, by default the current one."""
+        return self.base + (self.position if position is None else position)
+
+    def parse(self, file):
+        writer = self.writer
+        # What may come next: a value; a key; a value or the end of the
+        # array just started; a key or the end of the dictionary just
+        # started; or, after a value, a comma or the end of its container.
+        expected = EXPECT_VALUE
+        while True:
+            self.position = self.whitespace.match(self.text, self.position).end()
+            if self.position == len(self.text):
+                if self.refill(file):
+                    continue
+                break
+            c = self.text[self.position]
+            if expected == EXPECT_NEXT:
+                if c in u']}' and writer.stack and (c == u'}') == (writer.stack[-1].format == FORMAT_DICT):
+                    writer.end()
+                    self.position += 1
+                elif c == u',' and writer.stack:
+                    expected = EXPECT_KEY if writer.stack[-1].format == FORMAT_DICT else EXPECT_VALUE
+                    self.position += 1
+                else:
+                    raise InvalidPlistException("Unexpected %s at %d." % (repr(c), self.offset()))
+            elif expected == EXPECT_KEY or expected == EXPECT_KEY_OR_END:
+                if c == u'"':
+                    writer.key(self.readString(file))
+                    self.expect(file, u':')
+                    expected = EXPECT_VALUE
+                elif c == u'}' and expected == EXPECT_KEY_OR_END:
+                    writer.end()
+                    self.position += 1
+                    expected = EXPECT_NEXT
+                else:
+                    raise InvalidPlistException("Expected a dictionary key at %d." % self.offset())
+            elif c == u']' and expected == EXPECT_VALUE_OR_END:
+                writer.end()
+                self.position += 1
+                expected = EXPECT_NEXT
+            elif c == u'{':
+                writer.start(FORMAT_DICT)
+                self.position += 1
+                expected = EXPECT_KEY_OR_END
+            elif c == u'[':
+                writer.start(FORMAT_ARRAY)
+                self.position += 1
+                expected = EXPECT_VALUE_OR_END
+            elif c == u'"':
+                writer.string(self.readString(file))
+                expected = EXPECT_NEXT
+            else:
+                self.readScalar(file)
+                expected = EXPECT_NEXT
+
+    def expect(self, file, c):
+        while True:
+            self.position = self.whitespace.match(self.text, self.position).end()
+            if self.position < len(self.text) or not self.refill(file):
+                break
+        if self.text[self.position:self.position + 1] != c:
+            raise InvalidPlistException("Expected %s at %d." % (c, self.offset()))
+        self.position += 1
+
+    def readString(self, file):
+        while True:
+            try:
+                value, self.position = json.decoder.scanstring(self.text, self.position + 1)
+                return value
+            except ValueError as e:
+                # The string might continue in the next chunk. Long strings
+                # are read in growing chunks so they're only scanned a few
+                # times.
+                if not self.refill(file, max(CHUNK_SIZE, len(self.text) - self.position)):
+                    raise InvalidPlistException("Invalid string at %d: %s" % (self.offset(), e))
+
+    def readScalar(self, file):
+        while True:
+            rest = self.text[self.position:self.position + 9]
+            match = self.number.match(self.text, self.position)
+            # Reads on if a literal or number might continue in the next
+            # chunk, including after a trailing '.', 'e' or 'e-'.
+            if (len(rest) < 9 or (match is not None and match.end() > len(self.text) - 3)) and self.refill(file):
+                continue
+            break
+        for literal, data in self.literals:
+            if rest.startswith(literal):
+                self.writer.scalar(data)
+                self.position += len(literal)
+                return
+        if match is None or match.end() == self.position:
+            raise InvalidPlistException("Unexpected %s at %d." % (repr(rest[:1]), self.offset()))
+        text = match.group()
+        self.position = match.end()
+        if self.text[self.position:self.position + 1].isdigit():
+            raise InvalidPlistException("Numbers can't have leading zeros, at %d." % self.offset(match.start()))
+        if match.group(1) or match.group(2):
+            self.writer.scalar(encodeReal(float(text)))
+        else:
+            value = int(text)
+            self.writer.scalar(encodeInt(value), value)
+
+def sourceSize(file):
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(position)
+        return size - position
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def sniffFormat(file):
+    """Returns the format of the plist in file, which is left where it
+       was."""
+    position = file.tell()
+    start = file.read(64)
+    file.seek(position)
+    if start.startswith(b'bplist0'):
+        return 'binary'
+    if start.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<'):
+        return 'xml'
+    return 'json'
+
+def textToBinary(src, format, dst):
+    size = sourceSize(src)
+    if size is None:
+        objectRefSize = 4
+    else:
+        # Every XML object takes at least 7 characters (<true/>) and every
+        # JSON value at least 2 (0,), so this many references are enough.
+        maxObjects = size // 7 + 1 if format == 'xml' else size // 2 + 2
+        objectRefSize = PlistWriter(None).intSize(maxObjects)
+    writer = StreamingWriter(dst, min(objectRefSize, 8))
+    if format == 'xml':
+        XMLParser(writer).parse(src)
+    else:
+        JSONParser(writer).parse(src)
+    writer.finish()
+
+def binaryToText(src, to, dst):
+    contents, toClose = openContents(src)
+    try:
+        walker = XMLWalker(contents, dst) if to == 'xml' else JSONWalker(contents, dst)
+        walker.walk()
+    finally:
+        for f in toClose:
+            f.close()
+
+def transcode(src, dst, to):
+    """Converts the plist in src, a path or file, to dst, a path or file,
+       in the format given by to: 'xml', 'json' or 'binary'. The format of
+       src is detected from its contents.
+
+       Raises ValueError, InvalidPlistException"""
+    if to not in ('xml', 'json', 'binary'):
+        raise ValueError("Unknown format: %s" % repr(to))
+    toClose = []
+    try:
+        if isinstance(src, (bytes, unicode)):
+            src = open(src, 'rb')
+            toClose.append(src)
+        if isinstance(dst, (bytes, unicode)):
+            dst = open(dst, 'wb')
+            toClose.append(dst)
+        format = sniffFormat(src)
+        if format == to:
+            shutil.copyfileobj(src, dst)
+        elif format == 'binary':
+            binaryToText(src, to, dst)
+        elif to == 'binary':
+            textToBinary(src, format, dst)
+        else:
+            # Between XML and JSON, through a temporary binary plist.
+            with tempfile.TemporaryFile() as temp:
+                textToBinary(src, format, temp)
+                temp.flush()
+                binaryToText(temp, to, dst)
+    finally:
+        for f in toClose:
+            f.close()
@@ -0,0 +1,229 @@
+"""Checking binary plists before reading them.
+
+validate() checks that a binary plist is well formed without building any
+of its objects, so untrusted plists can be rejected before they're read.
+It checks the header and trailer, that the offset table and every object
+lie within the object table, that every marker byte is one PlistReader
+understands, that strings are valid ASCII or UTF-16, that references refer
+to existing objects, that dictionary keys are strings and set members
+aren't containers, and that no container contains itself.
+
+The objects are checked in one pass over the object table, followed by one
+pass over the references reachable from the root, stopping at the first
+problem found, with InvalidPlistException, or PlistLimitExceeded if the
+plist exceeds one of these limits:
+
+    maxObjects      the number of objects in the object table
+    maxDepth        how deeply containers are nested
+    maxLength       the length of any string, data object or container
+    maxDecodedSize  the number of bytes read to decode the whole plist,
+                    counting objects once for every reference to them
+
+The last matters because PlistReader decodes objects again each time
+they're referred to, so a small plist with many references to the same
+containers can take a very long time and a lot of memory to read.
+
+Validate example:
+
+    from biplist import validate, readPlist, InvalidPlistException
+    try:
+        validate("untrusted.plist", limits={'maxDepth':32})
+    except InvalidPlistException as e:
+        print "Rejected:", e
+    else:
+        plist = readPlist("untrusted.plist")
+"""
+
+from struct import unpack_from
+
+from biplist import PlistReader, InvalidPlistException, NotBinaryPlistException, PlistLimitExceeded
+from biplist.index import FORMAT_ARRAY, FORMAT_DICT, FORMAT_SET, openPlistContents
+
+__all__ = ['validate']
+
+DEFAULT_LIMITS = {
+    'maxObjects':None,
+    'maxDepth':500,
+    'maxLength':None,
+    'maxDecodedSize':1 << 30,
+}
+
+class PlistValidator(object):
+    def __init__(self, contents, limits):
+        self.contents = contents
+        self.limits = dict(DEFAULT_LIMITS)
+        for name, value in (limits or {}).items():
+            if name not in DEFAULT_LIMITS:
+                raise ValueError("Unknown limit: %s" % repr(name))
+            self.limits[name] = value
+        self.reader = PlistReader(None)
+        # The encoded length of each object, and the references from each
+        # container, keyed by object number.
+        self.lengths = None
+        self.refs = {}
+
+    def checkLimit(self, name, value):
+        limit = self.limits[name]
+        if limit is not None and value > limit:
+            raise PlistLimitExceeded("%s of %d exceeded." % (name, limit))
+
+    def checkTrailer(self):
+        contents = self.contents
+        if contents[:7] != b'bplist0':
+            raise NotBinaryPlistException()
+        if len(contents) < 8 + 32:
+            raise InvalidPlistException("File is too short.")
+        self.reader.loadContents(contents, offsets=[])
+        trailer = self.reader.trailer
+        if not 1 <= trailer.offsetSize <= 8 or not 1 <= trailer.objectRefSize <= 8:
+            raise InvalidPlistException("Invalid offset or reference size.")
+        if trailer.offsetCount == 0 or trailer.topLevelObjectNumber >= trailer.offsetCount:
+            raise InvalidPlistException("Invalid object count or top level object.")
+        if trailer.offsetCount > 1 << (8 * trailer.objectRefSize):
+            raise InvalidPlistException("Too many objects for the reference size.")
+        self.checkLimit('maxObjects', trailer.offsetCount)
+        if (trailer.offsetTableOffset < 8 or
+                trailer.offsetTableOffset + trailer.offsetCount * trailer.offsetSize > len(contents) - 32):
+            raise InvalidPlistException("Offset table is outside the file.")
+        self.reader.loadContents(contents)
+        for offset in self.reader.offsets:
+            if not 8 <= offset < trailer.offsetTableOffset:
+                raise InvalidPlistException("Object offset %d is outside the object table." % offset)
+
+    def checkObject(self, objectNumber):
+        """Checks a single object, recording its length and any references
+           it makes."""
+        contents = self.contents
+        end = self.reader.trailer.offsetTableOffset
+        start = self.reader.offsets[objectNumber]
+        marker = unpack_from('>B', contents, start)[0]
+        format = marker >> 4
+        extra = marker & 0x0f
+        position = start + 1
+        if format in (0b0100, 0b0101, 0b0110, FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT) and extra == 0b1111:
+            # The length follows as an integer object.
+            if position >= end:
+                raise InvalidPlistException("Object %d is truncated." % objectNumber)
+            lengthMarker = unpack_from('>B', contents, position)[0]
+            if lengthMarker >> 4 != 0b0001 or lengthMarker & 0x0f > 3:
+                raise InvalidPlistException("Invalid length for object %d." % objectNumber)
+            size = 1 << (lengthMarker & 0x0f)
+            if position + 1 + size > end:
+                raise InvalidPlistException("Object %d is truncated." % objectNumber)
+            extra = unpack_from('>%s' % {1:'B', 2:'H', 4:'L', 8:'Q'}[size], contents, position + 1)[0]
+            position += 1 + size
+
+        if format == 0b0000:
+            if extra not in (0b0000, 0b1000, 0b1001, 0b1111):
+                raise InvalidPlistException("Invalid marker for object %d." % objectNumber)
+            size = 0
+        elif format == 0b0001:
+            if extra > 4:
+                raise InvalidPlistException("Invalid integer size for object %d." % objectNumber)
+            size = 1 << extra
+        elif format == 0b0010:
+            if extra not in (2, 3):
+                raise InvalidPlistException("Invalid real size for object %d." % objectNumber)
+            size = 1 << extra
+        elif format == 0b0011:
+            if extra != 0b0011:
+                raise InvalidPlistException("Invalid date for object %d." % objectNumber)
+            size = 8
+        elif format in (0b0100, 0b0101, 0b0110):
+            self.checkLimit('maxLength', extra)
+            size = extra * 2 if format == 0b0110 else extra
+        elif format == 0b1000:
+            size = extra + 1
+        elif format in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+            self.checkLimit('maxLength', extra)
+            count = extra * 2 if format == FORMAT_DICT else extra
+            size = count * self.reader.trailer.objectRefSize
+        else:
+            raise InvalidPlistException("Invalid marker for object %d." % objectNumber)
+        if position + size > end:
+            raise InvalidPlistException("Object %d is truncated." % objectNumber)
+
+        if format in (0b0101, 0b0110):
+            try:
+                contents[position:position + size].decode('ascii' if format == 0b0101 else 'utf_16_be')
+            except UnicodeError:
+                raise InvalidPlistException("Invalid string for object %d." % objectNumber)
+        elif format in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+            self.reader.currentOffset = position
+            refs = self.reader.readRefs(count)
+            if refs and max(refs) >= len(self.reader.offsets):
+                raise InvalidPlistException("Object %d refers to missing object %d." % (objectNumber, max(refs)))
+            self.refs[objectNumber] = refs
+        self.lengths[objectNumber] = position + size - start
+        return format
+
+    def checkContainers(self, formats):
+        """Checks that dictionary keys are strings and set members aren't
+           containers."""
+        for objectNumber, refs in self.refs.items():
+            format = formats[objectNumber]
+            if format == FORMAT_DICT:
+                for ref in refs[:len(refs) // 2]:
+                    if formats[ref] not in (0b0101, 0b0110):
+                        raise InvalidPlistException("Object %d has a key which isn't a string." % objectNumber)
+            elif format == FORMAT_SET:
+                for ref in refs:
+                    if formats[ref] in (FORMAT_ARRAY, FORMAT_SET, FORMAT_DICT):
+                        raise InvalidPlistException("Object %d has a container as a member." % objectNumber)
+
+    def checkGraph(self):
+        """Walks the containers reachable from the root, checking for
+           cycles, depth and decoded size."""
+        refs = self.refs
+        lengths = self.lengths
+        root = self.reader.trailer.topLevelObjectNumber
+        maxDepth = self.limits['maxDepth']
+        # Decoded sizes start as the objects' own lengths, and have the
+        # sizes of the objects containers refer to added once walked.
+        sizes = list(lengths)
+        done = bytearray(len(lengths))
+        # The containers on the path from the root to the one being walked.
+        walking = set()
+        # Object numbers to walk, and the complements of object numbers
+        # whose children have all been walked.
+        stack = [root] if root in refs else []
+        while stack:
+            objectNumber = stack.pop()
+            if objectNumber < 0:
+                objectNumber = ~objectNumber
+                walking.remove(objectNumber)
+                size = lengths[objectNumber] + sum(map(sizes.__getitem__, refs[objectNumber]))
+                self.checkLimit('maxDecodedSize', size)
+                sizes[objectNumber] = size
+                done[objectNumber] = 1
+            elif not done[objectNumber]:
+                children = refs[objectNumber]
+                if objectNumber in children or not walking.isdisjoint(children):
+                    raise InvalidPlistException("Object %d contains itself." % objectNumber)
+                walking.add(objectNumber)
+                if maxDepth is not None and len(walking) > maxDepth:
+                    raise PlistLimitExceeded("maxDepth of %d exceeded." % maxDepth)
+                stack.append(~objectNumber)
+                stack.extend([child for child in children if child in refs and not done[child]])
+        self.checkLimit('maxDecodedSize', sizes[root])
+
+    def validate(self):
+        self.checkTrailer()
+        self.lengths = [0] * len(self.reader.offsets)
+        formats = [self.checkObject(objectNumber) for objectNumber in range(len(self.reader.offsets))]
+        self.checkContainers(formats)
+        self.checkGraph()
+
+def validate(pathOrFile, limits=None):
+    """Checks that the binary plist at pathOrFile is well formed and within
+       the given limits, a dict which may contain any of the keys in
+       DEFAULT_LIMITS. A limit of None means no limit. pathOrFile may also
+       be the plist's data, such as an upload held in memory.
+
+       Raises NotBinaryPlistException, InvalidPlistException"""
+    contents, toClose = openPlistContents(pathOrFile)
+    try:
+        PlistValidator(contents, limits).validate()
+    finally:
+        for f in toClose:
+            f.close()
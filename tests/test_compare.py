@@ -0,0 +1,127 @@
+from biplist import *
+from biplist.compare import ObjectTable
+import copy
+import io
+import os
+import tempfile
+from test_utils import *
+import unittest
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.old = {
+            'version':'1.0.0',
+            'devices':[{'name':'d%d' % i, 'ports':list(range(i % 5))} for i in range(30)],
+            'settings':{'a':1, 'b':[1.5, 'x'], 'c':True},
+            'tags':set(['one', 'two'])
+        }
+        self.new = copy.deepcopy(self.old)
+    
+    def changes(self):
+        return diff(io.BytesIO(writePlistToString(self.old)), io.BytesIO(writePlistToString(self.new)))
+    
+    def assertApplies(self, changes):
+        merged = apply(io.BytesIO(writePlistToString(self.old)), changes)
+        self.assertEqual(readPlistFromString(merged), self.new)
+    
+    def testIdentical(self):
+        self.assertEqual(self.changes(), [])
+        # Same contents, different object numbering and key order.
+        shuffled = writePlistToString(dict(reversed(list(self.old.items()))), optimize=True)
+        self.assertEqual(diff(io.BytesIO(writePlistToString(self.old)), io.BytesIO(shuffled)), [])
+    
+    def testChanges(self):
+        self.new['version'] = '1.0.1'
+        self.new['devices'][3]['ports'].append(9)
+        self.new['devices'][4]['name'] = 'renamed'
+        del self.new['devices'][-2:]
+        del self.new['settings']['a']
+        self.new['settings']['d'] = {'x':[1]}
+        self.new['tags'].add('three')
+        changes = self.changes()
+        self.assertEqual(changes, [
+            Change('set', ('version',), '1.0.1'),
+            Change('set', ('devices', 3, 'ports', 3), 9),
+            Change('set', ('devices', 4, 'name'), 'renamed'),
+            Change('delete', ('devices', 29), None),
+            Change('delete', ('devices', 28), None),
+            Change('set', ('settings', 'd'), {'x':[1]}),
+            Change('delete', ('settings', 'a'), None),
+            Change('set', ('tags',), set(['one', 'two', 'three'])),
+        ])
+        self.assertApplies(changes)
+    
+    def testTypeChanges(self):
+        self.new['settings']['a'] = True
+        self.new['settings']['c'] = 1
+        self.new['settings']['b'] = {'now':'a dict'}
+        changes = self.changes()
+        self.assertEqual(len(changes), 3)
+        self.assertApplies(changes)
+    
+    def testRoot(self):
+        self.new = ['replaced']
+        self.assertEqual(self.changes(), [Change('set', (), ['replaced'])])
+        self.assertApplies(self.changes())
+    
+    def testSkipsIdenticalSubtrees(self):
+        self.new['version'] = '2'
+        old = ObjectTable(writePlistToString(self.old))
+        new = ObjectTable(writePlistToString(self.new))
+        for table in (old, new):
+            table.fingerprint(table.reader.trailer.topLevelObjectNumber)
+        decoded = []
+        for table in (old, new):
+            read = table.read
+            table.read = lambda n, read=read: decoded.append(n) or read(n)
+        from biplist.compare import diffObjects
+        changes = []
+        diffObjects(old, new, 0, 0, (), changes)
+        self.assertEqual(changes, [Change('set', ('version',), '2')])
+        # Once fingerprinted, only the changed key and value are decoded.
+        self.assertEqual(len(decoded), 2)
+    
+    def testFingerprint(self):
+        plist = io.BytesIO(writePlistToString(self.old))
+        # Same values, written in a different order with different widths.
+        shuffled = io.BytesIO(writePlistToString(dict(reversed(list(self.old.items()))), optimize=True))
+        self.assertEqual(fingerprint(plist), fingerprint(shuffled))
+        self.assertEqual(fingerprint(plist, perKey=True), fingerprint(shuffled, perKey=True))
+        self.assertEqual(sorted(fingerprint(plist, perKey=True).keys()), sorted(self.old.keys()))
+        
+        self.new['devices'][3]['name'] = 'changed'
+        changed = fingerprint(io.BytesIO(writePlistToString(self.new)), perKey=True)
+        self.assertNotEqual(changed['devices'], fingerprint(plist, perKey=True)['devices'])
+        self.assertEqual(changed['settings'], fingerprint(plist, perKey=True)['settings'])
+        
+        # Values which are equal in Python, but of different types, differ.
+        for a, b in ((1, True), (1, 1.0), ('a', Data(b'a')), (1, Uid(1))):
+            self.assertNotEqual(fingerprint(io.BytesIO(writePlistToString([a]))),
+                                fingerprint(io.BytesIO(writePlistToString([b]))))
+        self.assertRaises(KeyError, fingerprint, io.BytesIO(writePlistToString([1])), perKey=True)
+        # Data held in memory, rather than a path or file.
+        self.assertEqual(fingerprint(writePlistToString(self.old)), fingerprint(plist))
+        self.assertEqual(diff(writePlistToString(self.old), writePlistToString(self.old)), [])
+    
+    def testFiles(self):
+        self.new['version'] = '2'
+        paths = []
+        for root in (self.old, self.new):
+            f = tempfile.NamedTemporaryFile(suffix='.plist', delete=False)
+            f.close()
+            writePlist(root, f.name)
+            paths.append(f.name)
+        try:
+            changes = diff(paths[0], paths[1])
+            self.assertEqual(changes, [Change('set', ('version',), '2')])
+            self.assertEqual(readPlistFromString(apply(paths[0], changes)), self.new)
+        finally:
+            for path in paths:
+                os.unlink(path)
+    
+    def testNotBinary(self):
+        xml = io.BytesIO(b'<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict/></plist>')
+        self.assertRaises(NotBinaryPlistException, diff, xml, io.BytesIO(writePlistToString({'a':1})))
+
+if __name__ == '__main__':
+    unittest.main()
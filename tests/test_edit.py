@@ -0,0 +1,91 @@
+from biplist import *
+import io
+import os
+import tempfile
+from test_utils import *
+import unittest
+
+class TestPatch(unittest.TestCase):
+    def setUp(self):
+        self.root = {
+            'version':'1.0.0',
+            'counter':1,
+            'other':1,
+            'nested':{'a':{'b':'short'}, 'list':[1, 2, 3]},
+            'padding':['x' * 20 for i in range(50)]
+        }
+        self.plistFile = tempfile.NamedTemporaryFile(suffix='.plist', delete=False)
+        self.plistFile.close()
+        writePlist(self.root, self.plistFile.name)
+    
+    def tearDown(self):
+        os.unlink(self.plistFile.name)
+    
+    def patched(self, updates):
+        self.assertTrue(patch(self.plistFile.name, updates))
+        return readPlist(self.plistFile.name)
+    
+    def testInPlace(self):
+        size = os.path.getsize(self.plistFile.name)
+        result = self.patched({'version':'1.0.1', 'nested.a.b':'long!'})
+        self.root['version'] = '1.0.1'
+        self.root['nested']['a']['b'] = 'long!'
+        self.assertEqual(result, self.root)
+        # Nothing was added, so the file is the same size.
+        self.assertEqual(os.path.getsize(self.plistFile.name), size)
+    
+    def testSharedValue(self):
+        # 'counter' and 'other' share the object for 1, so it can't be
+        # overwritten.
+        result = self.patched({'counter':2})
+        self.root['counter'] = 2
+        self.assertEqual(result, self.root)
+        self.assertEqual(result['other'], 1)
+        self.assertEqual(result['nested']['list'], [1, 2, 3])
+    
+    def testSharedContainer(self):
+        # Adding a key copies the dictionary, so its values are referred to
+        # by the copy and the original, which is still used by 'b'.
+        shared = {'k':'value1'}
+        stream = io.BytesIO(writePlistToString({'a':shared, 'b':shared}))
+        self.assertTrue(patch(stream, {'a.new':1, 'a.k':'value2'}))
+        self.assertEqual(readPlistFromString(stream.getvalue()),
+                         {'a':{'k':'value2', 'new':1}, 'b':{'k':'value1'}})
+    
+    def testAppend(self):
+        result = self.patched({'nested.a.b':'a much longer string than before', 'nested.list.1':{'x':[True, None]}})
+        self.root['nested']['a']['b'] = 'a much longer string than before'
+        self.root['nested']['list'][1] = {'x':[True, None]}
+        self.assertEqual(result, self.root)
+    
+    def testNewItems(self):
+        result = self.patched({'nested.a.c':'new', 'nested.list.3':4, 'added':[1.5]})
+        self.root['nested']['a']['c'] = 'new'
+        self.root['nested']['list'].append(4)
+        self.root['added'] = [1.5]
+        self.assertEqual(result, self.root)
+        self.assertEqual(self.patched({'added.0':2.5})['added'], [2.5])
+    
+    def testRoot(self):
+        self.assertEqual(self.patched({'':[1, 2]}), [1, 2])
+    
+    def testRewrite(self):
+        # 256 objects use up every one byte object reference.
+        root = list(range(255))
+        writePlist(root, self.plistFile.name, optimize=True)
+        self.assertFalse(patch(self.plistFile.name, {'0':'a new string'}))
+        root[0] = 'a new string'
+        self.assertEqual(readPlist(self.plistFile.name), root)
+    
+    def testMissing(self):
+        self.assertRaises(KeyError, patch, self.plistFile.name, {'missing.key':1})
+        self.assertRaises(IndexError, patch, self.plistFile.name, {'nested.list.5':1})
+        self.assertEqual(readPlist(self.plistFile.name), self.root)
+    
+    def testStream(self):
+        stream = io.BytesIO(writePlistToString({'a':[1]}))
+        self.assertTrue(patch(stream, {'a.0':'changed'}))
+        self.assertEqual(readPlistFromString(stream.getvalue()), {'a':['changed']})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+from biplist import *
+import io
+import os
+import tempfile
+import threading
+from test_utils import *
+import unittest
+
+class TestBinaryPlistIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = {
+            'name':'config',
+            'version':3,
+            'servers':[{'host':'a.example.com', 'port':80}, {'host':'b.example.com', 'port':443}],
+            'limits':{'cpu':1.5, 'memory':{'soft':256, 'hard':512}},
+            'tags':set(['x', 'y'])
+        }
+        self.plistFile = tempfile.NamedTemporaryFile(suffix='.plist')
+        writePlist(self.root, self.plistFile)
+        self.plistFile.flush()
+    
+    def tearDown(self):
+        self.plistFile.close()
+    
+    def testLookups(self):
+        with BinaryPlistIndex(self.plistFile.name) as index:
+            self.assertEqual(index.get(), self.root)
+            self.assertEqual(index.get('name'), 'config')
+            self.assertEqual(index.get('servers.1.port'), 443)
+            self.assertEqual(index.get(('limits', 'memory', 'hard')), 512)
+            self.assertEqual(index['limits.memory'], {'soft':256, 'hard':512})
+            self.assertEqual(sorted(index.keys()), sorted(self.root.keys()))
+            self.assertEqual(sorted(index.keys('servers.0')), ['host', 'port'])
+            self.assertEqual(index.len(), 5)
+            self.assertEqual(index.len('servers'), 2)
+            self.assertEqual(index.len('tags'), 2)
+            self.assertTrue('limits.cpu' in index)
+            self.assertFalse('limits.gpu' in index)
+            self.assertEqual(index.get('servers.2'), None)
+            self.assertEqual(index.get('name.first', 'missing'), 'missing')
+            self.assertRaises(KeyError, lambda: index['nothing'])
+            self.assertRaises(KeyError, index.keys, 'servers')
+            
+            subtree = index.subtree('limits')
+            self.assertEqual(subtree.get('memory.soft'), 256)
+            self.assertEqual(subtree.len(), 2)
+    
+    def testViews(self):
+        sidecarPath = writeSidecar(self.plistFile.name)
+        try:
+            with BinaryPlistIndex(self.plistFile.name) as index:
+                root = index.view()
+                self.assertEqual(len(root), 5)
+                self.assertEqual(root['name'], 'config')
+                servers = root['servers']
+                self.assertEqual(len(servers), 2)
+                self.assertEqual(servers[-1]['port'], 443)
+                self.assertEqual(servers[0:1], [{'host':'a.example.com', 'port':80}])
+                self.assertEqual(root['tags'], set(['x', 'y']))
+                self.assertEqual(index.view('limits.memory'), {'soft':256, 'hard':512})
+                self.assertEqual(index.view('limits.cpu'), 1.5)
+                self.assertEqual(root, self.root)
+                self.assertEqual(sorted(root.keys()), sorted(self.root.keys()))
+                self.assertTrue('limits' in root)
+                self.assertFalse('other' in root)
+                self.assertRaises(KeyError, lambda: root['other'])
+                self.assertRaises(KeyError, lambda: root[1])
+                self.assertRaises(IndexError, lambda: servers[2])
+                self.assertEqual([server['host'] for server in servers], ['a.example.com', 'b.example.com'])
+                self.assertRaises(TypeError, lambda: servers['0'])
+                self.assertRaises(TypeError, lambda: servers[1.0])
+                # Iterating decodes the keys without indexing the dictionaries.
+                self.assertEqual(dict(root['limits'].items()), self.root['limits'])
+                self.assertEqual(list(root.values()), [self.root[key] for key in root])
+                self.assertEqual(index.dictIndexes, {})
+        finally:
+            os.unlink(sidecarPath)
+    
+    def testFromStream(self):
+        index = BinaryPlistIndex(io.BytesIO(writePlistToString([1, [2, 3]])))
+        self.assertEqual(index.get('1.0'), 2)
+        index.close()
+    
+    def testNotBinary(self):
+        self.assertRaises(NotBinaryPlistException, BinaryPlistIndex, io.BytesIO(b'<?xml version="1.0"?><plist></plist>'))
+    
+    def testThreads(self):
+        index = BinaryPlistIndex(self.plistFile.name)
+        errors = []
+        def lookup():
+            try:
+                for i in range(200):
+                    self.assertEqual(index.get('servers.%d.port' % (i % 2)), [80, 443][i % 2])
+                    self.assertEqual(index.get('limits.memory.hard'), 512)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=lookup) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        index.close()
+        self.assertEqual(errors, [])
+
+    def testSidecar(self):
+        sidecarPath = writeSidecar(self.plistFile.name)
+        try:
+            self.assertEqual(sidecarPath, self.plistFile.name + '.bpidx')
+            with BinaryPlistIndex(self.plistFile.name, verify=True) as index:
+                self.assertTrue(index.sidecar is not None)
+                self.assertEqual(index.get('servers.1.host'), 'b.example.com')
+                self.assertEqual(index.get(('limits', 'memory', 'soft')), 256)
+                self.assertEqual(index.get('limits.gpu'), None)
+                self.assertEqual(sorted(index.keys('limits')), ['cpu', 'memory'])
+                self.assertEqual(index.get(), self.root)
+            
+            # A rewrite of the same size which only changes the middle.
+            root = {'first':'a' * 5000, 'middle':'b', 'last':'c' * 5000}
+            writePlist(root, self.plistFile.name)
+            writeSidecar(self.plistFile.name)
+            root['middle'] = 'x'
+            writePlist(root, self.plistFile.name)
+            with BinaryPlistIndex(self.plistFile.name) as index:
+                self.assertTrue(index.sidecar is None)
+                self.assertEqual(index.get('middle'), 'x')
+            # Contents which still match are checked in full, and accepted,
+            # when the file's been touched.
+            writeSidecar(self.plistFile.name)
+            os.utime(self.plistFile.name, (1, 1))
+            with BinaryPlistIndex(self.plistFile.name) as index:
+                self.assertTrue(index.sidecar is not None)
+                self.assertEqual(index.get('middle'), 'x')
+            
+            # A sidecar for different contents is ignored.
+            writePlist({'name':'other'}, self.plistFile.name)
+            with BinaryPlistIndex(self.plistFile.name) as index:
+                self.assertTrue(index.sidecar is None)
+                self.assertEqual(index.get('name'), 'other')
+        finally:
+            os.unlink(sidecarPath)
+    
+    def testSidecarManyKeys(self):
+        root = dict(('key%d' % i, i) for i in range(2000))
+        writePlist(root, self.plistFile.name)
+        sidecarPath = writeSidecar(self.plistFile.name)
+        try:
+            with BinaryPlistIndex(self.plistFile.name) as index:
+                self.assertTrue(index.sidecar is not None)
+                for i in range(0, 2000, 7):
+                    self.assertEqual(index.get('key%d' % i), i)
+                self.assertFalse('key2000' in index)
+        finally:
+            os.unlink(sidecarPath)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from biplist import *
 import os
+from struct import pack
 from test_utils import *
 import unittest
 
@@ -28,6 +29,46 @@ class TestInvalidPlistFile(unittest.TestCase):
             self.fail("Should not successfully read invalid plist.")
         except InvalidPlistException as e:
             pass
+
+class TestReaderLimits(unittest.TestCase):
+    def testHostileLengths(self):
+        plist = bytearray(writePlistToString([Data(b'abc'), 'abc', [1, 2]]))
+        # Claim far more objects than the file could hold.
+        plist[-24:-16] = pack('>Q', 1 << 60)
+        self.assertRaises(InvalidPlistException, readPlistFromString, bytes(plist))
+        # Claim huge lengths for data, strings and arrays.
+        huge = b'\x13' + pack('>Q', 1 << 40)
+        for marker in (b'\x4f', b'\x5f', b'\x6f', b'\xaf', b'\xdf'):
+            plist = build_plist([marker + huge]).read()
+            self.assertRaises(InvalidPlistException, readPlistFromString, plist)
+        # Ints and reals carry their width in the marker, so can't have a
+        # length after it.
+        for marker in (b'\x1f', b'\x2f', b'\x15', b'\x24'):
+            plist = build_plist([marker + huge]).read()
+            self.assertRaises(InvalidPlistException, readPlistFromString, plist, limits={'maxTime':1})
+        # Lengths must be ints, not further lengths.
+        plist = build_plist([b'\x4f' * 5000 + b'\x10\x01' + b'a']).read()
+        self.assertRaises(InvalidPlistException, readPlistFromString, plist)
+        self.assertRaises(InvalidPlistException, readPlistFromString, plist, limits={'maxDepth':10})
+        # An array containing itself.
+        self.assertRaises(InvalidPlistException, readPlistFromString, build_plist([b'\xa1\x00']).read())
+    
+    def testLimits(self):
+        root = {'a':[[[1]]], 'b':'x' * 50, 'c':[1] * 10}
+        plist = writePlistToString(root)
+        self.assertEqual(readPlistFromString(plist, limits={}), root)
+        self.assertEqual(readPlistFromString(plist, limits={'maxDepth':4, 'maxLength':50}), root)
+        for limits in ({'maxDepth':3}, {'maxLength':49}, {'maxObjects':10}, {'maxDecodedSize':50}):
+            self.assertRaises(PlistLimitExceeded, readPlistFromString, plist, limits=limits)
+        self.assertRaises(ValueError, readPlistFromString, plist, limits={'maxBananas':1})
         
+        # Each array refers to the next one twice.
+        arrays = [[]]
+        for i in range(30):
+            arrays.append([arrays[-1], arrays[-1]])
+        plist = writePlistToString(arrays[-1], dedup='identity')
+        self.assertRaises(PlistLimitExceeded, readPlistFromString, plist, limits={'maxDecodedSize':1 << 12})
+        self.assertRaises(PlistLimitExceeded, readPlistFromString, plist, limits={'maxTime':0.01})
+
 if __name__ == '__main__':
     unittest.main()
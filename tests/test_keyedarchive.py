@@ -0,0 +1,130 @@
+from biplist import *
+from biplist import keyedarchive
+import datetime
+import io
+from test_utils import *
+import unittest
+import uuid
+
+def archive(objects, top):
+    return io.BytesIO(writePlistToString({'$archiver':'NSKeyedArchiver', '$version':100000,
+                                          '$objects':objects, '$top':top}))
+
+def classObject(*classes):
+    return {'$classname':classes[0], '$classes':list(classes)}
+
+class TestUnarchive(unittest.TestCase):
+    def testExample(self):
+        result = keyedarchive.unarchive(data_path('nskeyedarchiver_example.plist'))
+        self.assertTrue(isinstance(result, keyedarchive.ArchivedObject))
+        self.assertEqual(result.className, 'Archived')
+        self.assertEqual(result.classes, ['Archived', 'NSObject'])
+        self.assertEqual(result, {'somekey':'object value as string'})
+    
+    def testFoundation(self):
+        when = datetime.datetime(2020, 5, 17, 12, 30)
+        identifier = uuid.UUID('12345678-1234-5678-1234-567812345678')
+        objects = [
+            '$null',
+            {'$class':Uid(2), 'NS.keys':[Uid(3), Uid(4), Uid(9)], 'NS.objects':[Uid(5), Uid(6), Uid(0)]},
+            classObject('NSMutableDictionary', 'NSDictionary', 'NSObject'),
+            'list', 'when', 
+            {'$class':Uid(7), 'NS.objects':[Uid(3), Uid(8), Uid(3), Uid(10)]},
+            {'$class':Uid(11), 'NS.time':(when - datetime.datetime(2001, 1, 1)).total_seconds()},
+            classObject('NSArray', 'NSObject'),
+            {'$class':Uid(12), 'NS.data':Data(b'\x00\x01')},
+            {'$class':Uid(13), 'NS.string':'id'},
+            {'$class':Uid(14), 'NS.uuidbytes':Data(identifier.bytes)},
+            classObject('NSDate', 'NSObject'),
+            classObject('NSData', 'NSObject'),
+            classObject('NSMutableString', 'NSString', 'NSObject'),
+            classObject('NSUUID', 'NSObject'),
+        ]
+        result = keyedarchive.unarchive(archive(objects, {'root':Uid(1)}))
+        self.assertEqual(result, {'list':['list', Data(b'\x00\x01'), 'list', identifier], 'when':when, 'id':None})
+        self.assertEqual(keyedarchive.unarchive(archive(objects, {'root':Uid(1), 'other':Uid(3)}), topKey=None)['other'],
+                         'list')
+    
+    def testCustomDecoders(self):
+        class Node(object):
+            def __init__(self, fields):
+                self.name = fields['name']
+        objects = ['$null', {'$class':Uid(2), 'name':'a', 'parent':Uid(3)}, classObject('Child', 'Node', 'NSObject'),
+                   {'$class':Uid(4), 'name':'b', 'child':Uid(1)}, classObject('Parent', 'NSObject')]
+        plist = archive(objects, {'root':Uid(1)})
+        
+        # Undecoded objects can refer to each other in cycles.
+        result = keyedarchive.unarchive(plist)
+        self.assertTrue(result['parent']['child'] is result)
+        
+        result = keyedarchive.unarchive(plist, decoders={'Node':Node})
+        self.assertTrue(isinstance(result, Node))
+        self.assertEqual(result.name, 'a')
+        self.assertRaises(InvalidPlistException, keyedarchive.unarchive, plist,
+                          decoders={'Node':lambda fields: fields['parent'], 'Parent':lambda fields: fields['child']})
+    
+    def testInvalid(self):
+        self.assertRaises(InvalidPlistException, keyedarchive.unarchive, io.BytesIO(writePlistToString({'a':1})))
+        self.assertRaises(InvalidPlistException, keyedarchive.unarchive, archive(['$null'], {'root':Uid(5)}))
+        self.assertRaises(KeyError, keyedarchive.unarchive, archive(['$null'], {'other':Uid(0)}))
+
+class TestArchive(unittest.TestCase):
+    def testRoundTrip(self):
+        when = datetime.datetime(2020, 5, 17, 12, 30)
+        identifier = uuid.UUID('12345678-1234-5678-1234-567812345678')
+        root = {'list':['a', 1, 2.5, True, Data(b'\x00\x01'), None], 'set':set(['a', 'b']),
+                'when':when, 'id':identifier, 'a':'a'}
+        data = keyedarchive.archive(root)
+        self.assertEqual(keyedarchive.unarchive(io.BytesIO(data)), root)
+        plist = readPlistFromString(data)
+        self.assertEqual(plist['$archiver'], 'NSKeyedArchiver')
+        self.assertEqual(plist['$top'], {'root':Uid(1)})
+        # Equal strings and class descriptions are only archived once.
+        objects = plist['$objects']
+        self.assertEqual(objects.count('a'), 1)
+        self.assertEqual(len([o for o in objects if isinstance(o, dict) and o.get('$classname') == 'NSArray']), 1)
+        self.assertEqual(keyedarchive.unarchive(io.BytesIO(keyedarchive.archive([[1], [2]], topKey='other')),
+                                                topKey='other'), [[1], [2]])
+    
+    def testDedup(self):
+        root = {'a':['x', 'x', {'k':'x'}], 'b':[1, 2, 'x']}
+        for options in [{'dedup':'scalars'}, {'dedup':'identity'}, {'dedup':'deep'}, {'optimize':True},
+                        {'canonical':True}]:
+            data = keyedarchive.archive(root, **options)
+            validate(io.BytesIO(data))
+            self.assertEqual(keyedarchive.unarchive(io.BytesIO(data)), root)
+        self.assertRaises(ValueError, keyedarchive.archive, root, dedup='none')
+    
+    def testCustomEncoders(self):
+        class Node(object):
+            def __init__(self, name):
+                self.name = name
+                self.parent = None
+        def encodeNode(node):
+            fields = keyedarchive.ArchivedObject(name=node.name, parent=node.parent, weight=2)
+            fields.className = 'Node'
+            return fields
+        parent = Node('a')
+        child = Node('b')
+        child.parent = parent
+        parent.parent = child
+        self.assertRaises(InvalidPlistException, keyedarchive.archive, parent)
+        data = keyedarchive.archive([parent, child], encoders={Node:encodeNode})
+        result = keyedarchive.unarchive(io.BytesIO(data))
+        self.assertEqual(result[0].className, 'Node')
+        self.assertEqual(result[0].classes, ['Node', 'NSObject'])
+        self.assertEqual((result[0]['name'], result[0]['weight']), ('a', 2))
+        self.assertTrue(result[0]['parent'] is result[1])
+        self.assertTrue(result[1]['parent'] is result[0])
+        # Integer fields are stored inline.
+        objects = readPlistFromString(data)['$objects']
+        self.assertEqual(objects[2]['weight'], 2)
+        
+        keyedarchive.registerEncoder(Node, encodeNode)
+        try:
+            self.assertEqual(keyedarchive.archive([parent, child]), data)
+        finally:
+            del keyedarchive.typeEncoders[Node]
+
+if __name__ == '__main__':
+    unittest.main()
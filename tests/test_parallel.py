@@ -0,0 +1,41 @@
+from biplist import *
+from biplist.parallel import mergePartitions
+import io
+from test_utils import *
+import unittest
+
+class TestParallel(unittest.TestCase):
+    def testMerge(self):
+        parts = [writePlistToString([{'a':i, 'b':'shared'}, [i, 'x%d' % i]]) for i in range(3)]
+        data = mergePartitions(parts)
+        validate(io.BytesIO(data))
+        expected = [item for i in range(3) for item in [{'a':i, 'b':'shared'}, [i, 'x%d' % i]]]
+        self.assertEqual(readPlistFromString(data), expected)
+        # Equal leaves from different partitions are only kept once.
+        self.assertEqual(len(data), len(writePlistToString(expected)))
+        self.assertTrue(len(mergePartitions(parts, dedup='none')) > len(data))
+        
+        parts = [writePlistToString(dict(('k%d' % j, j) for j in range(i * 10, i * 10 + 10))) for i in range(3)]
+        data = mergePartitions(parts, isDict=True, optimize=True)
+        self.assertEqual(readPlistFromString(data), dict(('k%d' % j, j) for j in range(30)))
+    
+    def testWorkers(self):
+        root = [{'id':i, 'name':'n%d' % (i % 7), 'values':[i, float(i)]} for i in range(1000)]
+        output = io.BytesIO()
+        writePlist(root, output, workers=3)
+        self.assertEqual(readPlistFromString(output.getvalue()), root)
+        root = dict(('k%d' % i, i) for i in range(100))
+        output = io.BytesIO()
+        writePlist(root, output, workers=2, dedup='none')
+        self.assertEqual(readPlistFromString(output.getvalue()), root)
+        output = io.BytesIO()
+        writePlist([1], output, workers=2)
+        self.assertEqual(readPlistFromString(output.getvalue()), [1])
+        for empty in ([], {}, ()):
+            output = io.BytesIO()
+            writePlist(empty, output, workers=2)
+            self.assertEqual(output.getvalue(), writePlistToString(empty))
+        self.assertRaises(ValueError, writePlist, root, io.BytesIO(), workers=2, canonical=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+from biplist import *
+import datetime
+import os
+import shutil
+import tempfile
+from test_utils import *
+import unittest
+
+class TestRecordLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.bplog')
+        self.records = [{'id':i, 'name':'event %d' % i, 'tags':['a', 'tag%d' % (i % 10)],
+                         'when':datetime.datetime(2020, 1, 1, 0, 0, i % 60)} for i in range(3000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeLog(self, records, **options):
+        with PlistLogWriter(self.path, **options) as log:
+            for i, record in enumerate(records):
+                self.assertEqual(log.append(record), i)
+
+    def readAll(self):
+        with PlistLogReader(self.path) as log:
+            return list(log)
+
+    def testAppend(self):
+        self.writeLog(self.records[:1000])
+        with PlistLogWriter(self.path, syncInterval=None) as log:
+            self.assertEqual(len(log), 1000)
+            for record in self.records[1000:]:
+                log.append(record)
+        with PlistLogReader(self.path) as log:
+            self.assertEqual(len(log), len(self.records))
+            self.assertEqual(log[0], self.records[0])
+            self.assertEqual(log[1234], self.records[1234])
+            self.assertEqual(log[-1], self.records[-1])
+            self.assertRaises(IndexError, log.__getitem__, len(self.records))
+            self.assertEqual(list(log), self.records)
+            batches = list(log.scan(start=10, stop=2500, batchSize=1000))
+            self.assertEqual([len(batch) for batch in batches], [1000, 1000, 490])
+            self.assertEqual(sum(batches, []), self.records[10:2500])
+            self.assertEqual(list(log.scan(start=5000)), [])
+            self.assertEqual(sum(log.scan(start=-2), []), self.records[-2:])
+            self.assertEqual(sum(log.scan(start=-5000, stop=-2998), []), self.records[:2])
+            self.assertEqual(list(log.scan(start=-1, stop=-2)), [])
+
+    def testRefresh(self):
+        writer = PlistLogWriter(self.path)
+        writer.append(self.records[0])
+        writer.sync()
+        reader = PlistLogReader(self.path)
+        try:
+            self.assertEqual(len(reader), 1)
+            writer.append(self.records[1])
+            writer.close()
+            reader.refresh()
+            self.assertEqual(list(reader), self.records[:2])
+        finally:
+            writer.close()
+            reader.close()
+
+    def testTornRecord(self):
+        self.writeLog(self.records[:100])
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00garbage')
+        self.assertEqual(self.readAll(), self.records[:100])
+        # The reader leaves the files alone.
+        self.assertEqual(os.path.getsize(self.path), size + 11)
+        # Part of the last record, with the index referring to it.
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 5)
+        self.assertEqual(self.readAll(), self.records[:99])
+        # The writer truncates the log, and carries on after the last
+        # complete record.
+        with PlistLogWriter(self.path) as log:
+            self.assertEqual(len(log), 99)
+            self.assertEqual(log.append(self.records[99]), 99)
+        self.assertEqual(self.readAll(), self.records[:100])
+        self.assertEqual(os.path.getsize(self.path + '.index'), 800)
+
+    def testIndex(self):
+        self.writeLog(self.records[:100])
+        indexPath = self.path + '.index'
+        # Missing the last few records, and part of an entry.
+        with open(indexPath, 'r+b') as f:
+            f.truncate(8 * 90 + 3)
+        self.assertEqual(self.readAll(), self.records[:100])
+        os.remove(indexPath)
+        self.assertEqual(self.readAll(), self.records[:100])
+        with PlistLogWriter(self.path) as log:
+            self.assertEqual(len(log), 100)
+        self.assertEqual(os.path.getsize(indexPath), 800)
+        with PlistLogReader(self.path) as log:
+            self.assertEqual(log[50], self.records[50])
+
+    def testInvalid(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'bplist00')
+        self.assertRaises(InvalidPlistException, PlistLogReader, self.path)
+        self.assertRaises(InvalidPlistException, PlistLogWriter, self.path)
+        # No index is left next to a file which isn't a log.
+        self.assertFalse(os.path.exists(self.path + '.index'))
+        os.remove(self.path)
+        with PlistLogWriter(self.path) as log:
+            self.assertRaises(InvalidPlistException, log.append, object())
+            self.assertEqual(len(log), 0)
+        self.assertEqual(self.readAll(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from biplist import *
+import datetime
+import io
+from test_utils import *
+import unittest
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+class TestSchema(unittest.TestCase):
+    def testEncode(self):
+        record = {'id':12345, 'name':'sensor', 'value':3.25, 'ok':True, 'missing':None,
+                  'when':datetime.datetime(2020, 1, 1, 12), 'blob':Data(b'xyz' * 10),
+                  'position':{'x':1.5, 'y':-2.0, 'label':u'caf\xe9', 'inner':{'n':-5}}}
+        encoder = compileSchema(record)
+        for i in (0, 1, 300, 70000, 1 << 40, -1):
+            record['id'] = i
+            record['name'] = 'n' * (i % 40)
+            data = encoder.encode(record)
+            validate(io.BytesIO(data))
+            self.assertEqual(readPlistFromString(data), record)
+        spec = {'id':int, 'name':unicode, 'values':{'a':float, 'b':bool}}
+        record = {'id':1, 'name':'a', 'values':{'a':0.5, 'b':False}}
+        self.assertEqual(readPlistFromString(compileSchema(spec).encode(record)), record)
+    
+    def testLargeSchema(self):
+        # More than 255 objects need 2 byte references.
+        record = dict(('k%d' % i, i) for i in range(200))
+        self.assertEqual(readPlistFromString(compileSchema(record).encode(record)), record)
+    
+    def testMismatches(self):
+        encoder = compileSchema({'id':int, 'position':{'x':float}})
+        self.assertRaises(InvalidPlistException, encoder.encode, {'id':1})
+        self.assertRaises(InvalidPlistException, encoder.encode, {'id':1, 'other':{'x':1.0}})
+        self.assertRaises(InvalidPlistException, encoder.encode, {'id':'a', 'position':{'x':1.0}})
+        self.assertRaises(InvalidPlistException, encoder.encode, {'id':1, 'position':[1.0]})
+        # Values must have the schema's types, not just convert to them.
+        encoder = compileSchema({'id':int, 'ok':bool, 'score':float})
+        self.assertEqual(readPlistFromString(encoder.encode({'id':1, 'ok':True, 'score':0.5})),
+                         {'id':1, 'ok':True, 'score':0.5})
+        for record in [{'id':1, 'ok':'no', 'score':0.5}, {'id':1, 'ok':None, 'score':0.5},
+                       {'id':1, 'ok':True, 'score':1}, {'id':True, 'ok':True, 'score':0.5}]:
+            self.assertRaises(InvalidPlistException, encoder.encode, record)
+        self.assertRaises(ValueError, compileSchema, {'id':object})
+        self.assertRaises(ValueError, compileSchema, {1:int})
+        self.assertRaises(ValueError, compileSchema, [int])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from biplist import *
+import datetime
+from test_utils import *
+import unittest
+
+class TestSession(unittest.TestCase):
+    def testRoundTrip(self):
+        session = PlistSession()
+        messages = [{'method':'ping', 'id':i, 'params':['a', 'b' * i, 1.5, True]} for i in range(20)]
+        for message in messages:
+            data = session.encode(message)
+            self.assertEqual(data, writePlistToString(message))
+            self.assertEqual(session.decode(data), message)
+        self.assertEqual(session.decode(writePlistToString('root')), 'root')
+        self.assertRaises(NotBinaryPlistException, session.decode, b'<?xml')
+        self.assertRaises(InvalidPlistException, session.encode, {'a':object()})
+        # A failed plist doesn't affect the next.
+        self.assertEqual(session.decode(session.encode(messages[0])), messages[0])
+    
+    def testMixedValues(self):
+        session = PlistSession()
+        when = datetime.datetime(2020, 5, 17, 12, 30)
+        messages = [
+            {'items':list(range(20)), 'text':u'caf\xe9 ' * 10, 'long':'x' * 100, 'data':b'\x00\x01' * 20},
+            [1, True, 1.0, '1', b'1', 0, False, 0.0, -0.0, None, when, (2, 3), {}, []],
+            {'big':2 ** 40, 'negative':-5, 'nested':[{'a':[{'b':'a'}]}] * 3},
+            ['uid', Uid(3), Uid(300)],
+        ]
+        for message in messages * 2:
+            data = session.encode(message)
+            self.assertEqual(data, writePlistToString(message))
+            self.assertEqual(repr(session.decode(data)), repr(readPlistFromString(data)))
+        # Written by the writer, rather than directly.
+        class Offset(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=-5)
+            def dst(self, dt):
+                return datetime.timedelta(0)
+        for message in [set(['a', 'b']), ['aware', datetime.datetime(2020, 1, 1, tzinfo=Offset())]]:
+            self.assertEqual(session.encode(message), writePlistToString(message))
+        self.assertRaises(InvalidPlistException, session.encode, {1:'a'})
+        data = writePlistToString({'a':set([1, 2])})
+        self.assertEqual(session.decode(data), {'a':set([1, 2])})
+        self.assertRaises(InvalidPlistException, session.decode, data[:-40] + data[-32:])
+    
+    def testOptions(self):
+        when = datetime.datetime(2020, 5, 17)
+        session = PlistSession(readOptions={'dates':'apple'}, writeOptions={'dedup':'none'})
+        data = session.encode(['a', 'a', when])
+        self.assertEqual(data, writePlistToString(['a', 'a', when], dedup='none'))
+        self.assertEqual(session.decode(data), ['a', 'a', (when - datetime.datetime(2001, 1, 1)).total_seconds()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from biplist import *
+import os
+import shutil
+import sys
+import tempfile
+from test_utils import *
+import unittest
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.records = [{'id':i, 'name':'item %d' % i, 'tags':['a', 'tag%d' % (i % 10)], 'ok':i % 2 == 0}
+                        for i in range(2000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def shardSizes(self, manifest):
+        return [os.path.getsize(os.path.join(self.directory, shard['name'])) for shard in manifest['shards']]
+
+    def testWriteSharded(self):
+        for options in [{}, {'optimize':True}]:
+            manifest = writeSharded(iter(self.records), self.directory, maxBytes=10000, **options)
+            sizes = self.shardSizes(manifest)
+            self.assertTrue(len(sizes) > 1)
+            self.assertTrue(max(sizes) <= 10000)
+            self.assertEqual(sizes, [shard['size'] for shard in manifest['shards']])
+            self.assertEqual(manifest['recordCount'], len(self.records))
+            # Each shard is full: the next record wouldn't have fitted.
+            for shard in manifest['shards'][:-1]:
+                records = self.records[shard['start']:shard['start'] + shard['count'] + 1]
+                self.assertTrue(len(writePlistToString(records, **options)) > 10000)
+            self.assertEqual(readSharded(self.directory), self.records)
+            self.assertEqual(readSharded(self.directory, 123, 1456, verify=True), self.records[123:1456])
+
+    def testUpperBound(self):
+        # Sets can't be counted exactly, so are overestimated.
+        records = [{'id':i, 'set':set([i % 5, 'a'])} for i in range(500)]
+        manifest = writeSharded(records, self.directory, maxBytes=2000, dedup='deep')
+        self.assertTrue(max(self.shardSizes(manifest)) <= 2000)
+        self.assertEqual(readSharded(self.directory), records)
+
+    def testWorkers(self):
+        manifest = writeSharded(self.records, self.directory, maxBytes=10000, workers=2)
+        self.assertTrue(max(self.shardSizes(manifest)) <= 10000)
+        self.assertEqual(readSharded(self.directory), self.records)
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, writeSharded, ['x' * 100], self.directory, maxBytes=100)
+        writeSharded(self.records, self.directory, maxBytes=10000)
+        with open(os.path.join(self.directory, 'shard-00000.plist'), 'r+b') as f:
+            f.seek(100)
+            f.write(b'!')
+        self.assertRaises(InvalidPlistException, readSharded, self.directory, verify=True)
+        self.assertEqual(readSharded(self.directory, 1999, 2000), self.records[1999:])
+
+    def testWrittenSize(self):
+        # A shard counted smaller than it's written isn't written.
+        module = sys.modules['biplist.shard']
+        size = module.ShardCounter.size
+        try:
+            module.ShardCounter.size = lambda counter: 0
+            self.assertRaises(ValueError, writeSharded, self.records, os.path.join(self.directory, 'small'),
+                              maxBytes=10000)
+        finally:
+            module.ShardCounter.size = size
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'small')), [])
+
+if __name__ == '__main__':
+    unittest.main()
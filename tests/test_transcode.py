@@ -0,0 +1,98 @@
+from biplist import *
+import base64
+import datetime
+import io
+import json
+import plistlib
+import sys
+from test_utils import *
+import unittest
+
+def transcodeString(data, to):
+    output = io.BytesIO()
+    transcode(io.BytesIO(data), output, to=to)
+    return output.getvalue()
+
+class TestTranscode(unittest.TestCase):
+    def setUp(self):
+        self.root = {'list':[1, -2, 2.5, True, False, 'a<b&c', u'été', 'x' * 100, Data(b'\x00\xff' * 40)],
+                     'date':datetime.datetime(2020, 1, 2, 3, 4, 5), 'uid':Uid(7), 'empty':{}, 'none':[],
+                     'big':2**40}
+
+    def testXML(self):
+        xml = transcodeString(writePlistToString(self.root), 'xml')
+        if hasattr(plistlib, 'loads'):
+            expected = dict(self.root, uid={'CF$UID':7})
+            expected['list'] = expected['list'][:-1] + [b'\x00\xff' * 40]
+            self.assertEqual(plistlib.loads(xml), expected)
+        self.assertEqual(readPlistFromString(transcodeString(xml, 'binary')), self.root)
+        # None can't be written as XML.
+        self.assertRaises(InvalidPlistException, transcodeString, writePlistToString([None]), 'xml')
+
+    def testJSON(self):
+        converted = transcodeString(writePlistToString(self.root), 'json')
+        expected = dict(self.root, uid={'CF$UID':7}, date='2020-01-02T03:04:05Z')
+        expected['list'] = expected['list'][:-1] + [base64.b64encode(b'\x00\xff' * 40).decode('ascii')]
+        self.assertEqual(json.loads(converted.decode('utf-8')), expected)
+        expected['uid'] = Uid(7)
+        self.assertEqual(readPlistFromString(transcodeString(converted, 'binary')), expected)
+        # XML to JSON goes through a binary plist.
+        xml = transcodeString(writePlistToString(self.root), 'xml')
+        self.assertEqual(transcodeString(xml, 'json'), converted)
+
+    def testSharedStrings(self):
+        # A string used as both a key and a value is one object, but
+        # written differently as each.
+        root = {'a':'a', 'b':['b', {'b':'a'}]}
+        data = writePlistToString(root)
+        self.assertEqual(json.loads(transcodeString(data, 'json').decode('utf-8')), root)
+        self.assertEqual(readPlistFromString(transcodeString(transcodeString(data, 'xml'), 'binary')), root)
+        if hasattr(plistlib, 'loads'):
+            self.assertEqual(plistlib.loads(transcodeString(data, 'xml')), root)
+
+    def testChunks(self):
+        root = [{'id':i, 'name':u'né "%d"' % i * (i % 4 + 1), 'value':i * 1.5e10, 'none':None,
+                 'list':[True, 1e-5, 1234567890123456789]} for i in range(300)]
+        # The module, rather than the transcode function.
+        module = sys.modules['biplist.transcode']
+        chunkSize = module.CHUNK_SIZE
+        try:
+            for size in (1, 7, 64):
+                module.CHUNK_SIZE = size
+                data = transcodeString(json.dumps(root).encode('utf-8'), 'binary')
+                self.assertEqual(readPlistFromString(data), root)
+                self.assertEqual(json.loads(transcodeString(data, 'json').decode('utf-8')), root)
+        finally:
+            module.CHUNK_SIZE = chunkSize
+
+    def testInvalid(self):
+        for data in [b'[1,', b'{"a" 1}', b'{1:2}', b'[1]]', b'tru', b'[1] [2]', b'[1 2]', b'[1,,2]', b'[,1]',
+                     b'[1,]', b'{"a":1,}', b'[01]', b'[-01]', b'{"a":1 "b":2}', b'{,}', b'[}', b'1 2',
+                     b'<plist><dict><key>a</key></dict></plist>', b'<plist><foo/></plist>',
+                     b'<plist><array><key>a</key></array></plist>']:
+            self.assertRaises(InvalidPlistException, transcodeString, data, 'binary')
+        # Unpaired surrogates can't be written as UTF-16.
+        for data in [b'"\\ud800"', b'{"\\udc00":1}']:
+            self.assertRaises(InvalidPlistException, transcodeString, data, 'binary')
+        self.assertRaises(ValueError, transcodeString, b'[]', 'yaml')
+
+    def testErrorOffsets(self):
+        # Offsets are in the whole document, however it's read.
+        module = sys.modules['biplist.transcode']
+        chunkSize = module.CHUNK_SIZE
+        try:
+            for size in (1, 3, 1 << 20):
+                module.CHUNK_SIZE = size
+                for data, message in [(b'{"a":1}{}', "Unexpected '{' at 7."), (b'[1, 2, 03]', 'at 7.'),
+                                      (b'{"a":1, 2}', 'key at 8.'), (b'[1, 2 x]', "Unexpected 'x' at 6.")]:
+                    try:
+                        transcodeString(data, 'binary')
+                    except InvalidPlistException as e:
+                        self.assertTrue(str(e).endswith(message), (size, str(e)))
+                    else:
+                        self.fail(data)
+        finally:
+            module.CHUNK_SIZE = chunkSize
+
+if __name__ == '__main__':
+    unittest.main()
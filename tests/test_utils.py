@@ -1,10 +1,25 @@
+import io
 import os
+from struct import pack
 import subprocess
 import sys
 
 def data_path(path):
     return os.path.join(os.path.dirname(globals()["__file__"]), 'data', path)
 
+def build_plist(objects, top=0):
+    """Returns a file containing a binary plist made of the given encoded
+       objects, with two byte offsets and one byte references."""
+    output = bytearray(b'bplist00')
+    offsets = []
+    for obj in objects:
+        offsets.append(len(output))
+        output += obj
+    offsetTableOffset = len(output)
+    output += pack('>%dH' % len(offsets), *offsets)
+    output += pack('!xxxxxxBBQQQ', 2, 1, len(objects), top, offsetTableOffset)
+    return io.BytesIO(bytes(output))
+
 def run_command(args, verbose = False):
     """Runs the command and returns the status and the output."""
     if verbose:
@@ -6,6 +6,11 @@ import os
 from test_utils import *
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     unicode
     toUnicode = lambda x: x.decode('unicode-escape')
@@ -112,5 +117,37 @@ class TestValidPlistFile(unittest.TestCase):
         self.assertFalse(1 == Uid(1))
         self.assertFalse(Uid(0) == 0)
     
+    def testObjectHooks(self):
+        plist = writePlistToString({'a':{'b':1, 'c':[{'d':2}]}})
+        result = readPlistFromString(plist, objectHook=lambda d: sorted(d.items()))
+        self.assertEqual(result, [('a', [('b', 1), ('c', [[('d', 2)]])])])
+        pairs = []
+        def hook(items):
+            pairs.append(items)
+            return len(items)
+        self.assertEqual(readPlistFromString(plist, objectPairsHook=hook, objectHook=dict), 1)
+        self.assertEqual(pairs[0], [('d', 2)])
+        self.assertEqual(sorted(pairs[1]), [('b', 1), ('c', [1])])
+    
+    def testDateModes(self):
+        when = datetime.datetime(2020, 5, 17, 12, 30, 0, 250000)
+        plist = writePlistToString({'when':when, 'list':[when, 1]})
+        seconds = (when - datetime.datetime(2001, 1, 1)).total_seconds()
+        self.assertEqual(readPlistFromString(plist, dates='apple'), {'when':seconds, 'list':[seconds, 1]})
+        self.assertEqual(readPlistFromString(plist, dates='posix')['when'], seconds + 978307200)
+        self.assertRaises(ValueError, readPlistFromString, plist, dates='other')
+        self.assertRaises(ValueError, readPlistFromString, plist, dates='apple', trackChanges=True)
+    
+    @unittest.skipUnless(numpy, "NumPy isn't installed")
+    def testDatetime64(self):
+        when = datetime.datetime(2020, 5, 17, 12, 30, 0, 250000)
+        plist = writePlistToString({'when':when, 'dates':[when, datetime.datetime(1990, 1, 1)], 'mixed':[when, 1]})
+        result = readPlistFromString(plist, dates='datetime64')
+        self.assertEqual(result['when'], numpy.datetime64('2020-05-17T12:30:00.250000'))
+        self.assertTrue(isinstance(result['dates'], numpy.ndarray))
+        self.assertEqual(result['dates'].tolist(), [when, datetime.datetime(1990, 1, 1)])
+        self.assertEqual(result['mixed'], [numpy.datetime64(when), 1])
+        self.assertEqual(readPlistFromString(writePlistToString(result)), readPlistFromString(plist))
+    
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+from biplist import *
+import datetime
+import io
+from test_utils import *
+import unittest
+
+class TestValidate(unittest.TestCase):
+    def assertInvalid(self, plist, limits=None):
+        self.assertRaises(InvalidPlistException, validate, plist, limits)
+    
+    def testValid(self):
+        root = {'string':'abc', 'unicode':u'été', 'int':-5, 'big':1 << 40, 'real':1.5,
+                'date':datetime.datetime(2020, 1, 1), 'data':Data(b'\x00' * 20), 'uid':Uid(300),
+                'bools':[True, False], 'set':set([1, 2]), 'long':'x' * 100, 'nested':{'a':[[[]]]}}
+        validate(io.BytesIO(writePlistToString(root)))
+        validate(io.BytesIO(writePlistToString(root, optimize=True)))
+        validate(io.BytesIO(writePlistToString('scalar root')))
+        # Data held in memory, rather than a path or file.
+        validate(writePlistToString(root))
+        self.assertRaises(InvalidPlistException, validate, writePlistToString([1, 2])[:-10])
+        self.assertRaises(NotBinaryPlistException, validate, io.BytesIO(b'<?xml version="1.0"?>'))
+    
+    def testStructure(self):
+        self.assertInvalid(build_plist([b'\xa1\x05']))
+        self.assertInvalid(build_plist([b'\x7f']))
+        self.assertInvalid(build_plist([b'\x15\x00']))
+        self.assertInvalid(build_plist([b'\x5f\x10\x20abc']))
+        self.assertInvalid(build_plist([b'\x51\x80']))
+        self.assertInvalid(build_plist([b'\xd1\x01\x01', b'\x10\x01']))
+        self.assertInvalid(build_plist([b'\xc1\x01', b'\xa0']))
+        validate(build_plist([b'\xd1\x01\x02', b'\x51a', b'\xa0']))
+        truncated = bytearray(writePlistToString([1, 2]))
+        truncated[-8:] = pack('>Q', len(truncated))
+        self.assertInvalid(io.BytesIO(bytes(truncated)))
+        self.assertInvalid(io.BytesIO(b'bplist00' + b'\x00' * 20))
+    
+    def testCycles(self):
+        self.assertInvalid(build_plist([b'\xa1\x01', b'\xa1\x00']))
+        self.assertInvalid(build_plist([b'\xa1\x00']))
+        # Shared, but not cyclic.
+        validate(build_plist([b'\xa2\x01\x01', b'\xa1\x02', b'\x10\x01']))
+    
+    def testLimits(self):
+        plist = writePlistToString({'a':[[[1]]], 'b':'x' * 50})
+        validate(io.BytesIO(plist))
+        self.assertInvalid(io.BytesIO(plist), {'maxDepth':3})
+        validate(io.BytesIO(plist), {'maxDepth':4})
+        self.assertInvalid(io.BytesIO(plist), {'maxLength':49})
+        self.assertInvalid(io.BytesIO(plist), {'maxObjects':5})
+        self.assertRaises(ValueError, validate, io.BytesIO(plist), {'maxBananas':1})
+        
+        # Each array refers to the next one twice, so decoding reads 2 ** 40
+        # strings.
+        objects = [b'\xa2' + bytearray([i + 1, i + 1]) for i in range(40)] + [b'\x51a']
+        self.assertInvalid(build_plist(objects))
+        validate(build_plist(objects), {'maxDecodedSize':None})
+        deep = [b'\xa1' + bytearray([i + 1]) for i in range(200)] + [b'\xa0']
+        self.assertInvalid(build_plist(deep), {'maxDepth':100})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,10 @@
 #!/usr/local/env python
 # -*- coding: utf-8 -*-
 
-import datetime, io, os, subprocess, sys, tempfile, unittest
+import datetime, io, math, os, subprocess, sys, tempfile, unittest
 
 from biplist import *
-from biplist import PlistWriter
+from biplist import PlistWriter, FloatWrapper, TrackedDict, TrackedList, TrackedSet
 from test_utils import *
 
 try:
@@ -333,5 +333,255 @@ class TestWritePlist(unittest.TestCase):
         self.roundTrip([1, Uid(1)])
         self.roundTrip([Uid(1), Uid(1)])
 
+    def testOptimizedWidths(self):
+        # 256 unique objects need 2 byte references by default, but the
+        # largest reference, 255, fits in a single byte.
+        root = list(range(1000, 1255))
+        default = writePlistToString(root)
+        optimized = writePlistToString(root, optimize=True)
+        self.assertEqual(readPlistFromString(optimized), root)
+        self.assertTrue(len(optimized) < len(default))
+        self.assertEqual(bytearray(optimized)[-25], 1)
+        
+        # A large blob is written last so it doesn't widen the offsets.
+        root = {'blob':Data(b'x' * 300), 'list':[1, 2, 3]}
+        ioObject = io.BytesIO()
+        writer = PlistWriter(ioObject, optimize=True)
+        writer.writeRoot(root)
+        optimized = ioObject.getvalue()
+        self.assertEqual(readPlistFromString(optimized), root)
+        self.assertEqual(bytearray(optimized)[-26], 1)
+        self.assertEqual(len(writePlistToString(root)) - len(optimized), writer.bytesSaved)
+        self.assertTrue(writer.bytesSaved > 0)
+    
+    def testOptimizedRoundTrip(self):
+        root = {'preference':[1, 2, {'hi there':['a', 1, 2, {'yarrrr':123}]}], 'a':'a' * 70000}
+        result = readPlistFromString(writePlistToString(root, optimize=True))
+        self.assertEqual(result, root)
+        self.roundTrip(toUnicode('\u00b6'))
+
+    def testOptimizedSharedBlob(self):
+        # Equal blobs have different wrappers, but the deferred one is
+        # still only written once.
+        root = [[b'by'], b'by']
+        optimized = writePlistToString(root, optimize=True)
+        self.assertEqual(readPlistFromString(optimized), root)
+        self.assertEqual(optimized.count(b'Bby'), 1)
+        self.assertTrue(len(optimized) <= len(writePlistToString(root)))
+        self.assertEqual(estimateSize(root, optimize=True), len(optimized))
+
+    def testCompactReals(self):
+        root = [0.5, 1.25, -2.0, 0.1, 1e300, float('inf')]
+        default = writePlistToString(root)
+        compact = writePlistToString(root, compactReals=True)
+        self.assertEqual(readPlistFromString(compact), root)
+        # 0.5, 1.25, -2.0 and inf are exact in single precision.
+        self.assertEqual(len(default) - len(compact), 4 * 4)
+        
+        lossy = readPlistFromString(writePlistToString(root, realTolerance=1e-6))
+        self.assertEqual(lossy[:3], root[:3])
+        self.assertNotEqual(lossy[3], 0.1)
+        self.assertAlmostEqual(lossy[3], 0.1)
+        self.assertEqual(lossy[4], 1e300)
+        
+        writer = PlistWriter(io.BytesIO(), compactReals=True)
+        self.assertEqual(writer.realSize(FloatWrapper(0.75)), 4)
+        self.assertEqual(writer.realSize(FloatWrapper(0.1)), 8)
+
+    def testDedupPolicies(self):
+        shared = {'name':'value', 'list':[1, 2, 3]}
+        root = {'a':shared, 'b':shared, 'c':{'name':'value', 'list':[1, 2, 3]}, 'd':['x', 'x']}
+        sizes = {}
+        for dedup in ('none', 'scalars', 'identity', 'deep'):
+            plist = writePlistToString(root, dedup=dedup)
+            self.assertEqual(readPlistFromString(plist), root)
+            sizes[dedup] = len(plist)
+        self.assertTrue(sizes['none'] > sizes['scalars'] > sizes['identity'] > sizes['deep'])
+        
+        cases = [0, 1, 1.0, 0.0, True, False, None, Uid(1), [1], (1,), [True], {'a':[]}, {'a':()}]
+        for dedup in ('none', 'identity', 'deep'):
+            result = readPlistFromString(writePlistToString(cases, dedup=dedup))
+            self.assertEqual(result, [0, 1, 1.0, 0.0, True, False, None, Uid(1), [1], [1], [True], {'a':[]}, {'a':[]}])
+            self.assertEqual([type(x) for x in result[:8]], [type(x) for x in cases[:8]])
+            self.assertEqual(type(result[10][0]), bool)
+        
+        try:
+            writePlistToString(root, dedup='bogus')
+            self.fail("Unknown dedup policies should be rejected.")
+        except ValueError as e:
+            pass
+    
+    def testDedupNoneBadKeys(self):
+        try:
+            writePlistToString({1:1}, dedup='none')
+            self.fail("Number is not a valid key in Cocoa.")
+        except InvalidPlistException as e:
+            pass
+
+    def testCanonical(self):
+        def build(keys, members):
+            root = {}
+            for key in keys:
+                root[key] = {'tags':set(members), 'shared':'s%s' % key, 'data':Data(b'xx' + key.encode('ascii'))}
+            root['mixed'] = set(members + [1.5, float('nan'), -1, False, Uid(3)])
+            return root
+        keys = ['k%d' % i for i in range(40)]
+        members = ['m%d' % i for i in range(40)]
+        first = build(keys, members)
+        second = build(list(reversed(keys)), list(reversed(members)))
+        for options in ({}, {'optimize':True}, {'dedup':'deep'}, {'dedup':'none'}):
+            plist = writePlistToString(first, canonical=True, **options)
+            self.assertEqual(plist, writePlistToString(second, canonical=True, **options))
+            result = readPlistFromString(plist)
+            self.assertEqual(result['k3'], first['k3'])
+        self.assertRaises(ValueError, writePlistToString, first, canonical=True, dedup='identity')
+        
+        # Tracked containers are encoded again rather than copied.
+        tracked = readPlistFromString(writePlistToString(second), trackChanges=True)
+        self.assertEqual(writePlistToString(tracked, canonical=True), writePlistToString(first, canonical=True))
+
+    def testTrackedChanges(self):
+        root = {'config':{'name':'a', 'values':[1, 2.5, 'x']},
+                'items':[{'id':i, 'tags':['t%d' % i]} for i in range(20)],
+                'when':datetime.datetime(2020, 1, 1),
+                'empty':[]}
+        plist = writePlistToString(root)
+        result = readPlistFromString(plist, trackChanges=True)
+        self.assertEqual(result, root)
+        self.assertTrue(isinstance(result, TrackedDict))
+        self.assertFalse(result.dirty)
+        
+        # Untouched, the whole plist is copied.
+        self.assertEqual(writePlistToString(result), plist)
+        
+        result['items'][3]['tags'].append('new')
+        self.assertTrue(result.dirty)
+        self.assertTrue(result['items'].dirty)
+        self.assertFalse(result['items'][4].dirty)
+        self.assertFalse(result['config'].dirty)
+        root['items'][3]['tags'].append('new')
+        result['config']['values'] = ['replaced']
+        root['config']['values'] = ['replaced']
+        result['added'] = set([1, 2])
+        root['added'] = set([1, 2])
+        
+        rewritten = writePlistToString(result)
+        self.assertEqual(readPlistFromString(rewritten), root)
+        self.assertEqual(writePlistToString(result, reuseSource=False), writePlistToString(root))
+        
+        # Unmodified subtrees can also be moved into new plists.
+        self.assertEqual(readPlistFromString(writePlistToString([result['items'][5], result['items'][5]])),
+                         [root['items'][5], root['items'][5]])
+    
+    def testTrackedContainerTypes(self):
+        result = readPlistFromString(writePlistToString([set([1]), [], {}]), trackChanges=True)
+        self.assertEqual([type(x) for x in result], [TrackedSet, TrackedList, TrackedDict])
+        for container, change in ((result[0], lambda x: x.add(2)), (result[1], lambda x: x.extend([1])),
+                                  (result[2], lambda x: x.setdefault('a', 1))):
+            self.assertFalse(container.dirty)
+            change(container)
+            self.assertTrue(container.dirty)
+        self.assertEqual(readPlistFromString(writePlistToString(result)), [set([1, 2]), [1], {'a':1}])
+    
+    def testTrackedIncremental(self):
+        root = dict(('k%d' % i, {'a':[i, 'v%d' % i], 'b':'x%d' % i}) for i in range(200))
+        plist = writePlistToString(root)
+        for i in range(3):
+            result = readPlistFromString(plist, trackChanges=True)
+            result['k%d' % i]['b'] = 'changed'
+            result['k%d' % i]['a'].append(i)
+            root['k%d' % i]['b'] = 'changed'
+            root['k%d' % i]['a'].append(i)
+            rewritten = writePlistToString(result, reuseSource='append')
+            # The original object table is kept, with the changes after it.
+            self.assertEqual(rewritten[:len(plist) // 2], plist[:len(plist) // 2])
+            self.assertEqual(readPlistFromString(rewritten), root)
+            plist = rewritten
+        
+        # When the old versions would be a large part of the file, it's
+        # compacted instead.
+        plist = writePlistToString([[0] * 100, [1] * 100])
+        result = readPlistFromString(plist, trackChanges=True)
+        result[0].append(2)
+        result[1].append(2)
+        rewritten = writePlistToString(result, reuseSource='append')
+        self.assertEqual(readPlistFromString(rewritten), [[0] * 100 + [2], [1] * 100 + [2]])
+        self.assertTrue(len(rewritten) < len(plist) + 10)
+        self.assertEqual(writePlistToString(result), rewritten)
+        
+        # Unchanged values are matched by their encoding, not equality.
+        plist = writePlistToString({'a':[-0.0, 1], 'b':[0.0]})
+        for reuseSource in (True, 'append'):
+            result = readPlistFromString(plist, trackChanges=True)
+            result['b'].append(-0.0)
+            rewritten = readPlistFromString(writePlistToString(result, reuseSource=reuseSource))
+            self.assertEqual(rewritten, {'a':[-0.0, 1], 'b':[0.0, -0.0]})
+            self.assertEqual([math.copysign(1, x) for x in rewritten['a'] + rewritten['b']], [-1, 1, 1, -1])
+
+    def testTrackedCopy(self):
+        root = {'items':[{'id':i, 'tags':['t%d' % (i % 3)]} for i in range(50)], 'removed':['x' * 30]}
+        plist = writePlistToString(root)
+        result = readPlistFromString(plist, trackChanges=True)
+        del result['removed']
+        del root['removed']
+        result['items'][1]['id'] = 100
+        root['items'][1]['id'] = 100
+        rewritten = writePlistToString(result)
+        self.assertEqual(readPlistFromString(rewritten), root)
+        # Nothing which is no longer used is copied.
+        self.assertEqual(len(rewritten), len(writePlistToString(root)))
+        self.assertTrue(b'x' * 30 not in rewritten)
+        for options in ({'optimize':True}, {'dedup':'none'}):
+            self.assertEqual(readPlistFromString(writePlistToString(result, **options)), root)
+
+    def testEncoders(self):
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+        class Point3D(Point):
+            pass
+        root = {'a':Point(1, 2), 'b':[Point3D(3, 4)], 'c':None, 'd':1}
+        self.assertRaises(InvalidPlistException, writePlistToString, root)
+        expected = {'a':[1, 2], 'b':[[3, 4]], 'c':None, 'd':1}
+        plist = writePlistToString(root, encoders={Point:lambda p: [p.x, p.y]})
+        self.assertEqual(readPlistFromString(plist), expected)
+        plist = writePlistToString(root, default=lambda p: [p.x, p.y])
+        self.assertEqual(readPlistFromString(plist), expected)
+        # Encoders for the exact type are used before base classes' and default.
+        plist = writePlistToString(root, encoders={Point:lambda p: [p.x, p.y], Point3D:lambda p: 'p3'},
+                                   default=lambda p: None)
+        self.assertEqual(readPlistFromString(plist)['b'], ['p3'])
+        self.assertRaises(InvalidPlistException, writePlistToString, root, default=lambda p: p)
+
+    def testAwareDates(self):
+        class Offset(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=-5)
+            def dst(self, dt):
+                return datetime.timedelta(0)
+        when = datetime.datetime(2020, 5, 17, 7, 30, tzinfo=Offset())
+        self.assertEqual(readPlistFromString(writePlistToString([when])), [datetime.datetime(2020, 5, 17, 12, 30)])
+
+    def testEstimateSize(self):
+        roots = [
+            {'a':[1, -1, 2**40, 1.5, True, None, 'b' * 20, toUnicode('\\u00e9t\\u00e9'), Data(b'\x00' * 300)],
+             'b':datetime.datetime(2020, 1, 1), 'c':Uid(300), 'd':('b' * 20, 1.5, {})},
+            list(range(300)) + ['x' * 70000],
+            [set([1, 2]), {'a':'b'}],
+            'root',
+        ]
+        for root in roots:
+            for options in [{}, {'optimize':True}, {'dedup':'none'}, {'dedup':'deep'}, {'compactReals':True}]:
+                self.assertEqual(estimateSize(root, **options), len(writePlistToString(root, **options)))
+        self.assertEqual(estimateSizes(roots), [len(writePlistToString(root)) for root in roots])
+        writer = PlistWriter(None)
+        writer.computeSize(roots[0])
+        self.assertEqual(writer.byteCounts.dateBytes, 9)
+        self.assertRaises(InvalidPlistException, estimateSize, [object()])
+        root = readPlistFromString(writePlistToString({'a':[1, 2], 'b':['c']}), trackChanges=True)
+        root['a'].append(3)
+        self.assertEqual(estimateSize(root), len(writePlistToString(root)))
+
 if __name__ == '__main__':
     unittest.main()